@@ -153,16 +153,28 @@ ADJUSTABLE_SETTINGS = {
     'api_host': (str, 'localhost'),
 
     'api_port': (int, 5279),
+    # maximum number of blob hashes announced to the dht per second, 0 for no limit; to keep
+    # every blob announced this should be at least the number of blobs / 86400
+    'announce_rate': (float, 0.0),
     'bittrex_feed': (str, 'https://bittrex.com/api/v1.1/public/getmarkethistory'),
+    # maximum number of blob objects DiskBlobManager keeps loaded in memory
+    'blob_cache_size': (int, 10000),
     'cache_time': (int, 150),
     'check_ui_requirements': (bool, True),
     'data_dir': (str, default_data_dir),
     'data_rate': (float, .0001),  # points/megabyte
     'default_ui_branch': (str, 'master'),
     'delete_blobs_on_remove': (bool, True),
+    # number of disjoint paths followed by each dht lookup, if 0 the original lookup is used
+    'dht_lookup_paths': (int, 0),
     'dht_node_port': (int, 4444),
+    # the most udp packets the dht node sends per second
+    'dht_packets_per_second': (int, 1000),
     'download_directory': (str, default_download_directory),
     'download_timeout': (int, 30),
+    # number of blobs encrypted at once in threads when creating a stream, if 0 the
+    # blobs are encrypted on the reactor
+    'encryption_threads': (int, 2),
     'host_ui': (bool, True),
     'is_generous_host': (bool, True),
     'known_dht_nodes': (list, DEFAULT_DHT_NODES, server_port),
@@ -190,6 +202,13 @@ ADJUSTABLE_SETTINGS = {
     'min_valuable_hash_rate': (float, .05),  # points/1000 infos
     'min_valuable_info_rate': (float, .05),  # points/1000 infos
     'peer_port': (int, 3333),
+    # the chance of connecting to a random peer for a stream instead of the one expected
+    # to be fastest, so that new peers get tried
+    'peer_selection_epsilon': (float, 0.1),
+    # keep the peers announced to our dht node in dht_peers.db so they survive a restart
+    'persist_dht_peers': (bool, False),
+    # send the next request to a peer which supports it while a blob is still downloading
+    'pipeline_blob_requests': (bool, True),
     'pointtrader_server': (str, 'http://127.0.0.1:2424'),
     'reflector_port': (int, 5566),
     'reflector_reupload': (bool, True),
@@ -200,10 +219,15 @@ ADJUSTABLE_SETTINGS = {
     'peer_search_timeout': (int, 3),
     'search_servers': (list, ['lighthouse1.lbry.io:50005']),
     'search_timeout': (float, 5.0),
+    # store blobs in two levels of subdirectories (blobfiles/ab/cd/abcd...) instead of
+    # one flat directory, existing blobs are moved over in the background
+    'sharded_blob_dir': (bool, False),
     'startup_scripts': (list, []),
     'ui_branch': (str, 'master'),
     'upload_log': (bool, True),
     'use_auth_http': (bool, False),
+    # pack blobs into large segment files rather than storing a file per blob
+    'use_blob_packs': (bool, False),
     'use_upnp': (bool, True),
     'wallet': (str, LBRYUM_WALLET),
 }
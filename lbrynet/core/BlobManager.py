@@ -1,15 +1,21 @@
+import collections
 import logging
 import os
 import time
-import sqlite3
+import weakref
 
 from twisted.internet import threads, defer
 from twisted.python.failure import Failure
 from twisted.enterprise import adbapi
+from lbrynet import conf
+from lbrynet.core import utils
 from lbrynet.core.HashBlob import BlobFile, TempBlob, BlobFileCreator, TempBlobCreator
+from lbrynet.core.HashBlob import PackBlob, PackBlobCreator
+from lbrynet.core.PackStore import PackStore
 from lbrynet.core.server.DHTHashAnnouncer import DHTHashSupplier
 from lbrynet.core.Error import NoSuchBlobError
 from lbrynet.core.sqlite_helpers import rerun_if_locked
+from lbrynet.core.utils import is_valid_blobhash
 
 
 log = logging.getLogger(__name__)
@@ -74,28 +80,162 @@ class BlobManager(DHTHashSupplier):
             return self.hash_announcer.immediate_announce(blob_hashes)
 
 
+class BlobCache(object):
+    """A size bounded LRU mapping of blob hashes to blob objects
+
+    Blobs which have open readers or writers are pinned and are never
+    evicted. If every cached blob is pinned the cache is allowed to grow
+    past max_size until some of them are released.
+
+    Evicted blobs which are still referenced elsewhere (for instance by a
+    download manager) are remembered weakly, so that there is never more
+    than one live blob object for a hash.
+    """
+    def __init__(self, max_size):
+        assert max_size > 0
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blobs = collections.OrderedDict()
+        self._live_blobs = weakref.WeakValueDictionary()
+
+    def __contains__(self, blob_hash):
+        return blob_hash in self._blobs
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def __iter__(self):
+        return iter(self._blobs)
+
+    def iterkeys(self):
+        return self._blobs.iterkeys()
+
+    def itervalues(self):
+        return self._blobs.itervalues()
+
+    def get(self, blob_hash):
+        """Return the cached blob for blob_hash, or None, marking it as recently used"""
+        blob = self._blobs.pop(blob_hash, None)
+        if blob is None:
+            blob = self._live_blobs.get(blob_hash)
+            if blob is None:
+                self.misses += 1
+                return None
+            self._blobs[blob_hash] = blob
+            self.hits += 1
+            self._evict(blob_hash)
+            return blob
+        self._blobs[blob_hash] = blob
+        self.hits += 1
+        return blob
+
+    def get_live(self, blob_hash):
+        """Return the blob object for blob_hash if one exists, without affecting the LRU"""
+        return self._live_blobs.get(blob_hash)
+
+    def add(self, blob):
+        self._blobs.pop(blob.blob_hash, None)
+        self._blobs[blob.blob_hash] = blob
+        self._live_blobs[blob.blob_hash] = blob
+        self._evict(blob.blob_hash)
+
+    def remove(self, blob_hash):
+        self._live_blobs.pop(blob_hash, None)
+        return self._blobs.pop(blob_hash, None)
+
+    def get_stats(self):
+        return {
+            'size': len(self._blobs),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    @staticmethod
+    def is_pinned(blob):
+        return bool(blob.writers) or blob.readers > 0
+
+    def _evict(self, newest_blob_hash):
+        to_remove = len(self._blobs) - self.max_size
+        if to_remove <= 0:
+            return
+        evicted = []
+        pinned = []
+        for blob_hash, blob in self._blobs.iteritems():
+            if len(evicted) == to_remove or blob_hash == newest_blob_hash:
+                break
+            if self.is_pinned(blob):
+                pinned.append(blob_hash)
+            else:
+                evicted.append(blob_hash)
+        for blob_hash in evicted:
+            del self._blobs[blob_hash]
+        # pinned blobs are in use, so treat them as recently used rather
+        # than scanning past them again on the next eviction
+        for blob_hash in pinned:
+            self._blobs[blob_hash] = self._blobs.pop(blob_hash)
+        self.evictions += len(evicted)
+        if evicted:
+            log.debug("Evicted %i blobs from the blob cache, %i pinned", len(evicted), len(pinned))
+
+
 # TODO: Having different managers for different blobs breaks the
 #       abstraction of a HashBlob. Why should the management of blobs
 #       care what kind of Blob it has?
 class DiskBlobManager(BlobManager):
     """This class stores blobs on the hard disk"""
-    def __init__(self, hash_announcer, blob_dir, db_dir):
+
+    # inserts into blobs.db are queued and committed together in one
+    # transaction, either after this many seconds or once this many are queued
+    WRITE_BATCH_DELAY = 0.1
+    WRITE_BATCH_SIZE = 500
+    # maximum number of hashes handed to the announcer per call to hashes_to_announce
+    ANNOUNCE_BATCH_SIZE = 1000
+    # maximum number of blob files moved into the configured layout per manage call
+    MIGRATION_BATCH_SIZE = 200
+
+    def __init__(self, hash_announcer, blob_dir, db_dir, blob_cache_size=None,
+                 sharded_blob_dir=None):
         BlobManager.__init__(self, hash_announcer)
         self.blob_dir = blob_dir
         self.db_file = os.path.join(db_dir, "blobs.db")
         self.db_conn = None
         self.blob_type = BlobFile
         self.blob_creator_type = BlobFileCreator
-        # TODO: consider using an LRU for blobs as there could potentially
-        #       be thousands of blobs loaded up, many stale
-        self.blobs = {}
+        if blob_cache_size is None:
+            blob_cache_size = conf.settings['blob_cache_size']
+        self.blobs = BlobCache(blob_cache_size)
+        if sharded_blob_dir is None:
+            sharded_blob_dir = conf.settings['sharded_blob_dir']
+        # store blobs as blob_dir/ab/cd/abcd... rather than directly in blob_dir
+        self.sharded_blob_dir = sharded_blob_dir
+        self._shard_dirs = set()
         self.blob_hashes_to_delete = {} # {blob_hash: being_deleted (True/False)}
         self._next_manage_call = None
+        self._pending_writes = []  # [(query, args, deferred)]
+        self._next_write_call = None
+        # batches are committed one at a time, in the order they were queued
+        self._write_lock = defer.DeferredLock()
+        self._rows_written = 0
+        self._write_transactions = 0
+        # {blob_hash: length} of the blobs in the db which are in blob_dir, built
+        # by reconcile_blob_dir and kept up to date as blobs are added and deleted
+        self._verified_blobs = {}
+        # blob files in blob_dir with no row in the db
+        self._unrecorded_blob_files = set()
+        # {blob_hash: directory} of blob files which are not where the configured
+        # layout puts them, these are moved a batch at a time by _migrate_blob_files
+        self._misplaced_blob_files = {}
+        self._blob_index_complete = False
 
     def setup(self):
         log.info("Setting up the DiskBlobManager. blob_dir: %s, db_file: %s", str(self.blob_dir),
                  str(self.db_file))
         d = self._open_db()
+        d.addCallback(lambda _: self.reconcile_blob_dir())
         d.addCallback(lambda _: self._manage())
         return d
 
@@ -104,30 +244,89 @@ class DiskBlobManager(BlobManager):
         if self._next_manage_call is not None and self._next_manage_call.active():
             self._next_manage_call.cancel()
             self._next_manage_call = None
-        self.db_conn = None
-        return defer.succeed(True)
+
+        def close_db(result):
+            self.db_conn = None
+            return result
+
+        d = self._flush_writes()
+        d.addBoth(close_db)
+        # failures have already been logged and passed on to the queued writes
+        d.addBoth(lambda _: True)
+        return d
 
     def get_blob(self, blob_hash, length=None):
         """Return a blob identified by blob_hash, which may be a new blob or a
         blob that is already on the hard disk
         """
         assert length is None or isinstance(length, int)
-        if blob_hash in self.blobs:
-            return defer.succeed(self.blobs[blob_hash])
+        blob = self.blobs.get(blob_hash)
+        if blob is not None:
+            return defer.succeed(blob)
         return self._make_new_blob(blob_hash, length)
 
     def get_blob_creator(self):
         return self.blob_creator_type(self, self.blob_dir)
 
+    def get_blob_dir(self, blob_hash):
+        """Return the directory in which the file for blob_hash is, or is to be, saved"""
+        if blob_hash in self._misplaced_blob_files:
+            return self._misplaced_blob_files[blob_hash]
+        blob_dir = self._get_layout_blob_dir(blob_hash)
+        if not self._blob_index_complete and self.sharded_blob_dir:
+            # the blob files haven't been listed yet, so the blob may not have been
+            # moved into its shard yet
+            if not os.path.isfile(os.path.join(blob_dir, blob_hash)) and \
+                    os.path.isfile(os.path.join(self.blob_dir, blob_hash)):
+                return self.blob_dir
+        return blob_dir
+
+    def _get_layout_blob_dir(self, blob_hash):
+        if not self.sharded_blob_dir:
+            return self.blob_dir
+        shard_dir = os.path.join(self.blob_dir, blob_hash[:2], blob_hash[2:4])
+        if shard_dir not in self._shard_dirs:
+            if not os.path.isdir(shard_dir):
+                os.makedirs(shard_dir)
+            self._shard_dirs.add(shard_dir)
+        return shard_dir
+
+    def get_migration_status(self):
+        return {
+            'sharded_blob_dir': self.sharded_blob_dir,
+            'blobs_to_move': len(self._misplaced_blob_files),
+        }
+
+    def get_blob_cache_stats(self):
+        return self.blobs.get_stats()
+
+    def get_db_write_stats(self):
+        return {
+            'rows_written': self._rows_written,
+            'transactions': self._write_transactions,
+            'pending': len(self._pending_writes),
+        }
+
     def _make_new_blob(self, blob_hash, length=None):
         log.debug('Making a new blob for %s', blob_hash)
-        blob = self.blob_type(self.blob_dir, blob_hash, length)
-        self.blobs[blob_hash] = blob
+        if not self._blob_index_complete or blob_hash in self._unrecorded_blob_files:
+            blob = self._init_blob(blob_hash, length)
+        elif blob_hash in self._verified_blobs:
+            blob = self._init_blob(blob_hash, self._verified_blobs[blob_hash], verified=True)
+        else:
+            blob = self._init_blob(blob_hash, length, verified=False)
+        self.blobs.add(blob)
         return defer.succeed(blob)
 
+    def _init_blob(self, blob_hash, length, verified=None):
+        """Create a blob object, if verified is None the blob will check if it is stored"""
+        return self.blob_type(self.get_blob_dir(blob_hash), blob_hash, length, verified=verified)
+
     def blob_completed(self, blob, next_announce_time=None):
         if next_announce_time is None:
             next_announce_time = self.get_next_announce_time()
+        self._verified_blobs[blob.blob_hash] = blob.length
+        self._unrecorded_blob_files.discard(blob.blob_hash)
         d = self._add_completed_blob(blob.blob_hash, blob.length, next_announce_time)
         d.addCallback(lambda _: self._immediate_announce([blob.blob_hash]))
         return d
@@ -143,8 +342,8 @@ class DiskBlobManager(BlobManager):
         assert blob_creator.blob_hash is not None
         assert blob_creator.blob_hash not in self.blobs
         assert blob_creator.length is not None
-        new_blob = self.blob_type(self.blob_dir, blob_creator.blob_hash, blob_creator.length)
-        self.blobs[blob_creator.blob_hash] = new_blob
+        new_blob = self._init_blob(blob_creator.blob_hash, blob_creator.length, verified=True)
+        self.blobs.add(new_blob)
         self._immediate_announce([blob_creator.blob_hash])
         next_announce_time = self.get_next_announce_time()
         d = self.blob_completed(new_blob, next_announce_time)
@@ -155,6 +354,80 @@ class DiskBlobManager(BlobManager):
             if not blob_hash in self.blob_hashes_to_delete:
                 self.blob_hashes_to_delete[blob_hash] = False
 
+    def reconcile_blob_dir(self):
+        """Diff the files in blob_dir against blobs.db using a single listing of blob_dir
+
+        This builds the in-memory index of verified blobs which is used afterwards
+        instead of checking the file system for each blob.
+
+        @return: a deferred which fires with a dict of the blob files with no row in the
+            db ('files_without_rows') and of the rows with no blob file ('rows_without_files')
+        """
+        d = self.db_conn.runQuery("select blob_hash, blob_length from blobs")
+        d.addCallback(lambda rows: threads.deferToThread(self._diff_blob_dir, rows))
+        d.addCallback(self._set_blob_index)
+        return d
+
+    def _list_blob_files(self):
+        """Return {blob_hash: directory} for the blob files in blob_dir and its shards"""
+
+        def is_shard(name):
+            return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+        blob_files = {}
+        for name in os.listdir(self.blob_dir):
+            path = os.path.join(self.blob_dir, name)
+            if is_valid_blobhash(name):
+                blob_files[name] = self.blob_dir
+            elif is_shard(name) and os.path.isdir(path):
+                for sub_name in os.listdir(path):
+                    shard_dir = os.path.join(path, sub_name)
+                    if is_shard(sub_name) and os.path.isdir(shard_dir):
+                        for blob_hash in os.listdir(shard_dir):
+                            if is_valid_blobhash(blob_hash):
+                                blob_files[blob_hash] = shard_dir
+        return blob_files
+
+    def _diff_blob_dir(self, rows):
+        blob_files = self._list_blob_files()
+        if self.sharded_blob_dir:
+            layout_dir = lambda h: os.path.join(self.blob_dir, h[:2], h[2:4])
+        else:
+            layout_dir = lambda h: self.blob_dir
+        misplaced = {h: d for h, d in blob_files.iteritems() if d != layout_dir(h)}
+        verified_blobs = {}
+        rows_without_files = []
+        for blob_hash, length in rows:
+            if blob_hash in blob_files:
+                verified_blobs[blob_hash] = length
+            else:
+                rows_without_files.append(blob_hash)
+        files_without_rows = set(blob_files).difference(verified_blobs)
+        return verified_blobs, files_without_rows, rows_without_files, misplaced
+
+    def _set_blob_index(self, result):
+        verified_blobs, files_without_rows, rows_without_files, misplaced = result
+        self._misplaced_blob_files = misplaced
+        # keep anything which completed while blob_dir was being listed
+        verified_blobs.update(self._verified_blobs)
+        self._verified_blobs = verified_blobs
+        self._unrecorded_blob_files = files_without_rows.difference(verified_blobs)
+        self._blob_index_complete = True
+        log.info("Found %i verified blobs in %s", len(self._verified_blobs), self.blob_dir)
+        if self._unrecorded_blob_files:
+            log.warning("%i blob files are not in the blob db",
+                        len(self._unrecorded_blob_files))
+        if rows_without_files:
+            log.warning("%i blobs in the blob db are missing their files",
+                        len(rows_without_files))
+        if misplaced:
+            log.info("%i blob files will be moved to the %s blob directory layout",
+                     len(misplaced), "sharded" if self.sharded_blob_dir else "flat")
+        return {
+            'files_without_rows': sorted(self._unrecorded_blob_files),
+            'rows_without_files': rows_without_files,
+        }
+
     def immediate_announce_all_blobs(self):
         d = self._get_all_verified_blob_hashes()
         d.addCallback(self._immediate_announce)
@@ -177,16 +450,59 @@ class DiskBlobManager(BlobManager):
         from twisted.internet import reactor
 
         d = self._delete_blobs_marked_for_deletion()
+        d.addCallback(lambda _: self._migrate_blob_files())
 
         def set_next_manage_call():
             self._next_manage_call = reactor.callLater(1, self._manage)
 
         d.addCallback(lambda _: set_next_manage_call())
 
+    def _migrate_blob_files(self):
+        """Move a batch of blob files into the configured directory layout
+
+        The files are renamed from the reactor thread, and any blob object for a moved
+        blob is updated in the same call, so readers never see a stale path. Blobs which
+        are being read, written or deleted are skipped and retried later.
+        """
+        if not self._misplaced_blob_files:
+            return
+        to_move = []
+        for blob_hash, old_dir in self._misplaced_blob_files.iteritems():
+            if len(to_move) >= self.MIGRATION_BATCH_SIZE:
+                break
+            blob = self.blobs.get_live(blob_hash)
+            if blob_hash in self.blob_hashes_to_delete or \
+                    (blob is not None and BlobCache.is_pinned(blob)):
+                continue
+            to_move.append((blob_hash, old_dir, blob))
+        for blob_hash, old_dir, blob in to_move:
+            new_dir = self._get_layout_blob_dir(blob_hash)
+            old_path = os.path.join(old_dir, blob_hash)
+            new_path = os.path.join(new_dir, blob_hash)
+            try:
+                if os.path.isfile(new_path):
+                    os.remove(old_path)
+                else:
+                    os.rename(old_path, new_path)
+            except OSError as err:
+                log.warning("Failed to move blob %s to %s: %s", blob_hash, new_dir, err)
+                if not os.path.isfile(old_path):
+                    del self._misplaced_blob_files[blob_hash]
+                continue
+            del self._misplaced_blob_files[blob_hash]
+            if blob is not None:
+                blob.blob_dir = new_dir
+                blob.file_path = new_path
+        if not self._misplaced_blob_files:
+            log.info("Finished moving blob files to the configured layout")
+
     def _delete_blobs_marked_for_deletion(self):
 
         def remove_from_list(b_h):
             del self.blob_hashes_to_delete[b_h]
+            self._verified_blobs.pop(b_h, None)
+            self._unrecorded_blob_files.discard(b_h)
+            self._misplaced_blob_files.pop(b_h, None)
             return b_h
 
         def set_not_deleting(err, b_h):
@@ -197,7 +513,9 @@ class DiskBlobManager(BlobManager):
         def delete_from_db(result):
             b_hs = [r[1] for r in result if r[0] is True]
             if b_hs:
-                d = self._delete_blobs_from_db(b_hs)
+                # make sure a queued insert can't re-add a blob after it is deleted
+                d = self._flush_writes()
+                d.addCallback(lambda _: self._delete_blobs_from_db(b_hs))
             else:
                 d = defer.succeed(True)
 
@@ -233,7 +551,8 @@ class DiskBlobManager(BlobManager):
         # to a bug in twisted, where the connection is closed by a different thread than the
         # one that opened it. The individual connections in the pool are not used in multiple
         # threads.
-        self.db_conn = adbapi.ConnectionPool('sqlite3', self.db_file, check_same_thread=False)
+        self.db_conn = adbapi.ConnectionPool('sqlite3', self.db_file, check_same_thread=False,
+                                             cp_openfun=self._set_db_pragmas)
 
         def create_tables(transaction):
             transaction.execute("create table if not exists blobs (" +
@@ -242,6 +561,9 @@ class DiskBlobManager(BlobManager):
                                 "    last_verified_time real, " +
                                 "    next_announce_time real)")
 
+            transaction.execute("create index if not exists blobs_next_announce_time_idx " +
+                                "on blobs (next_announce_time, blob_hash)")
+
             transaction.execute("create table if not exists download (" +
                                 "    id integer primary key autoincrement, " +
                                 "    blob text, " +
@@ -258,21 +580,99 @@ class DiskBlobManager(BlobManager):
 
         return self.db_conn.runInteraction(create_tables)
 
+    @staticmethod
+    def _set_db_pragmas(connection):
+        # wal lets readers and the writer in the pool proceed concurrently, and
+        # with wal it is safe to only sync at checkpoints rather than every commit
+        connection.execute("pragma journal_mode=wal")
+        connection.execute("pragma synchronous=normal")
+        connection.execute("pragma temp_store=memory")
+
+    def _queue_write(self, query, args):
+        """Queue a write to be committed with the next batch
+
+        Returns a deferred which fires once the transaction containing the
+        write has been committed
+        """
+        d = defer.Deferred()
+        self._pending_writes.append((query, args, d))
+        if len(self._pending_writes) >= self.WRITE_BATCH_SIZE:
+            self._flush_writes_in_background()
+        elif self._next_write_call is None:
+            self._next_write_call = utils.call_later(self.WRITE_BATCH_DELAY,
+                                                     self._flush_writes_in_background)
+        return d
+
+    def _flush_writes_in_background(self):
+        d = self._flush_writes()
+        # a failure has been logged and passed on to the deferreds of the queued writes
+        d.addErrback(lambda _: None)
+
+    def _flush_writes(self):
+        """Commit the queued writes
+
+        Returns a deferred which fires once they, and any batch which was already being
+        committed, have been committed
+        """
+        if self._next_write_call is not None:
+            if self._next_write_call.active():
+                self._next_write_call.cancel()
+            self._next_write_call = None
+        if not self._pending_writes:
+            return self._write_lock.run(defer.succeed, True)
+        writes, self._pending_writes = self._pending_writes, []
+        return self._write_lock.run(self._commit_batch, writes)
+
+    def _commit_batch(self, writes):
+
+        def fire_deferreds(result):
+            self._rows_written += len(writes)
+            self._write_transactions += 1
+            for _, _, d in writes:
+                d.callback(True)
+            return True
+
+        def errback_deferreds(err):
+            log.warning("Failed to write %i rows to the blob db: %s",
+                        len(writes), err.getErrorMessage())
+            for _, _, d in writes:
+                d.errback(err)
+            return err
+
+        d = self._commit_writes([(query, args) for query, args, _ in writes])
+        d.addCallbacks(fire_deferreds, errback_deferreds)
+        return d
+
     @rerun_if_locked
+    def _commit_writes(self, writes):
+
+        def write_rows(transaction):
+            for query, args in writes:
+                transaction.execute(query, args)
+
+        return self.db_conn.runInteraction(write_rows)
+
     def _add_completed_blob(self, blob_hash, length, next_announce_time):
         log.debug("Adding a completed blob. blob_hash=%s, length=%s", blob_hash, str(length))
-        d = self.db_conn.runQuery(
-            "insert into blobs (blob_hash, blob_length, next_announce_time) values (?, ?, ?)",
+        # "or ignore" so that a duplicate doesn't roll back the rest of the batch
+        return self._queue_write(
+            "insert or ignore into blobs (blob_hash, blob_length, next_announce_time) "
+            "values (?, ?, ?)",
             (blob_hash, length, next_announce_time)
         )
-        d.addErrback(lambda err: err.trap(sqlite3.IntegrityError))
-        return d
 
     @defer.inlineCallbacks
     def _completed_blobs(self, blobhashes_to_check):
         """Returns of the blobhashes_to_check, which are valid"""
-        blobs = yield defer.DeferredList([self.get_blob(b) for b in blobhashes_to_check])
-        blob_hashes = [b.blob_hash for success, b in blobs if success and b.verified]
+        if self._blob_index_complete:
+            to_check = [b for b in blobhashes_to_check if b not in self._verified_blobs]
+        else:
+            to_check = blobhashes_to_check
+        blobs = yield defer.DeferredList([self.get_blob(b) for b in to_check])
+        verified = set(b.blob_hash for success, b in blobs if success and b.verified)
+        blob_hashes = [b for b in blobhashes_to_check
+                       if b in verified or (self._blob_index_complete and
+                                            b in self._verified_blobs)]
         defer.returnValue(blob_hashes)
 
     @rerun_if_locked
@@ -284,15 +684,21 @@ class DiskBlobManager(BlobManager):
     def _get_blobs_to_announce(self):
 
         def get_and_update(transaction):
+            # the blobs in a batch are moved out of the range by the update, so walking
+            # the (next_announce_time, blob_hash) index from the start each call pages
+            # through everything that is due and each call costs O(batch size)
             timestamp = time.time()
             r = transaction.execute("select blob_hash from blobs " +
-                                    "where next_announce_time < ? and blob_hash is not null",
-                                    (timestamp,))
+                                    "where next_announce_time < ? and blob_hash is not null " +
+                                    "order by next_announce_time, blob_hash limit ?",
+                                    (timestamp, self.ANNOUNCE_BATCH_SIZE))
             blobs = [b for b, in r.fetchall()]
+            if not blobs:
+                return blobs
             next_announce_time = self.get_next_announce_time(len(blobs))
-            transaction.execute(
-                "update blobs set next_announce_time = ? where next_announce_time < ?",
-                (next_announce_time, timestamp))
+            transaction.executemany(
+                "update blobs set next_announce_time = ? where blob_hash = ?",
+                [(next_announce_time, b) for b in blobs])
             log.debug("Got %s blobs to announce, next announce time is in %s seconds",
                         len(blobs), next_announce_time-time.time())
             return blobs
@@ -310,6 +716,8 @@ class DiskBlobManager(BlobManager):
 
     @rerun_if_locked
     def _get_all_verified_blob_hashes(self):
+        if self._blob_index_complete:
+            return defer.succeed(self._verified_blobs.keys())
         d = self.db_conn.runQuery("select blob_hash from blobs")
 
         def get_verified_blobs(blobs):
@@ -323,22 +731,121 @@ class DiskBlobManager(BlobManager):
         d.addCallback(lambda blobs: threads.deferToThread(get_verified_blobs, blobs))
         return d
 
-    @rerun_if_locked
     def _add_blob_to_download_history(self, blob_hash, host, rate):
         ts = int(time.time())
-        d = self.db_conn.runQuery(
+        return self._queue_write(
             "insert into download values (null, ?, ?, ?, ?) ",
             (blob_hash, str(host), float(rate), ts))
-        return d
 
-    @rerun_if_locked
     def _add_blob_to_upload_history(self, blob_hash, host, rate):
         ts = int(time.time())
-        d = self.db_conn.runQuery(
+        return self._queue_write(
             "insert into upload values (null, ?, ?, ?, ?) ",
             (blob_hash, str(host), float(rate), ts))
+
+
+class PackBlobManager(DiskBlobManager):
+    """This class stores blobs on the hard disk, appended to large segment files
+
+    Each blob saved as its own file costs an inode, a temporary file and a
+    rename, which dominates on nodes holding many small blobs such as stream
+    descriptors. Here blobs are packed into the segment files of a PackStore
+    in blob_dir and their locations are kept in the blob_packs table.
+    """
+
+    # compact at most one segment per this many seconds
+    COMPACTION_INTERVAL = 60
+
+    def __init__(self, hash_announcer, blob_dir, db_dir, blob_cache_size=None):
+        DiskBlobManager.__init__(self, hash_announcer, blob_dir, db_dir,
+                                 blob_cache_size=blob_cache_size, sharded_blob_dir=False)
+        self.blob_type = PackBlob
+        self.blob_creator_type = PackBlobCreator
+        self.pack_store = PackStore(blob_dir, self._pack_location_changed)
+        self._last_compaction = 0
+
+    def get_blob_creator(self):
+        return self.blob_creator_type(self, self.pack_store)
+
+    def get_pack_stats(self):
+        return self.pack_store.get_stats()
+
+    def _init_blob(self, blob_hash, length, verified=None):
+        if verified is None:
+            verified = self.pack_store.has_blob(blob_hash)
+            if verified:
+                length = self.pack_store.get_length(blob_hash)
+        return self.blob_type(self.pack_store, blob_hash, length, verified=verified)
+
+    def reconcile_blob_dir(self):
+        """Load the packed blob locations and diff them against the blobs table"""
+        d = self.db_conn.runQuery("select blob_hash, segment, offset, length from blob_packs")
+        d.addCallback(lambda locations: threads.deferToThread(self.pack_store.load, locations))
+        d.addCallback(lambda _: self.db_conn.runQuery("select blob_hash, blob_length from blobs"))
+        d.addCallback(self._diff_pack_store)
+        d.addCallback(self._set_blob_index)
         return d
 
+    def _diff_pack_store(self, rows):
+        verified_blobs = {}
+        rows_without_files = []
+        for blob_hash, length in rows:
+            if self.pack_store.has_blob(blob_hash):
+                verified_blobs[blob_hash] = length
+            else:
+                rows_without_files.append(blob_hash)
+        files_without_rows = set(self.pack_store.index).difference(verified_blobs)
+        return verified_blobs, files_without_rows, rows_without_files, {}
+
+    def _migrate_blob_files(self):
+        # every blob is in the pack store, there is no directory layout to migrate
+        pass
+
+    def _manage(self):
+        DiskBlobManager._manage(self)
+        now = time.time()
+        if now - self._last_compaction >= self.COMPACTION_INTERVAL:
+            self._last_compaction = now
+            self._compact_pack_store()
+
+    def _compact_pack_store(self):
+        segments = self.pack_store.segments_to_compact()
+        if not segments:
+            return defer.succeed(0)
+        d = self.pack_store.compact(segments[0])
+        d.addErrback(lambda err: log.warning("Failed to compact blob pack segment %i: %s",
+                                             segments[0], err.getErrorMessage()))
+        return d
+
+    def _pack_location_changed(self, blob_hash, location):
+        segment, offset, length = location
+        return self._queue_write(
+            "insert or replace into blob_packs (blob_hash, segment, offset, length) "
+            "values (?, ?, ?, ?)", (blob_hash, segment, offset, length))
+
+    def _open_db(self):
+        d = DiskBlobManager._open_db(self)
+
+        def create_tables(transaction):
+            transaction.execute("create table if not exists blob_packs (" +
+                                "    blob_hash text primary key, " +
+                                "    segment integer, " +
+                                "    offset integer, " +
+                                "    length integer)")
+
+        d.addCallback(lambda _: self.db_conn.runInteraction(create_tables))
+        return d
+
+    @rerun_if_locked
+    def _delete_blobs_from_db(self, blob_hashes):
+
+        def delete_blobs(transaction):
+            for b in blob_hashes:
+                transaction.execute("delete from blobs where blob_hash = ?", (b,))
+                transaction.execute("delete from blob_packs where blob_hash = ?", (b,))
+
+        return self.db_conn.runInteraction(delete_blobs)
+
 
 # TODO: Having different managers for different blobs breaks the
 #       abstraction of a HashBlob. Why should the management of blobs
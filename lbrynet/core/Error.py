@@ -76,6 +76,10 @@ class InvalidResponseError(MisbehavingPeerError):
     pass
 
 
+class InvalidMessageError(MisbehavingPeerError):
+    pass
+
+
 class NoSuchBlobError(Exception):
     pass
 
@@ -207,13 +207,20 @@ class HashBlob(object):
 class BlobFile(HashBlob):
     """A HashBlob which will be saved to the hard disk of the downloader"""
 
-    def __init__(self, blob_dir, *args):
-        HashBlob.__init__(self, *args)
+    def __init__(self, blob_dir, blob_hash, length=None, verified=None):
+        """
+        @param verified: if None the blob is looked for on disk. Otherwise, whether the
+            blob is already known to be saved in blob_dir with the given length, which
+            saves the stat calls when the caller has already listed blob_dir
+        """
+        HashBlob.__init__(self, blob_hash, length)
         self.blob_dir = blob_dir
         self.file_path = os.path.join(blob_dir, self.blob_hash)
         self.setting_verified_blob_lock = threading.Lock()
         self.moved_verified_blob = False
-        if os.path.isfile(self.file_path):
+        if verified is not None:
+            self._verified = verified
+        elif os.path.isfile(self.file_path):
             self.set_length(os.path.getsize(self.file_path))
             # This assumes that the hash of the blob has already been
             # checked as part of the blob creation process. It might
@@ -346,6 +353,66 @@ class TempBlob(HashBlob):
             return defer.fail(Failure(DownloadCanceledError()))
 
 
+class PackBlob(HashBlob):
+    """A HashBlob which is saved in a segment file of a PackStore along with other blobs"""
+    def __init__(self, pack_store, blob_hash, length=None, verified=False):
+        HashBlob.__init__(self, blob_hash, length)
+        self.pack_store = pack_store
+        self._verified = verified
+        self._saving_verified_blob = False
+
+    def open_for_writing(self, peer):
+        if not peer in self.writers:
+            temp_buffer = StringIO()
+            finished_deferred = defer.Deferred()
+            writer = HashBlobWriter(temp_buffer, self.get_length, self.writer_finished)
+
+            self.writers[peer] = (writer, finished_deferred)
+            return finished_deferred, writer.write, writer.cancel
+        log.warning("Tried to download the same file twice simultaneously from the same peer")
+        return None, None, None
+
+    def open_for_reading(self):
+        if self._verified is True:
+            try:
+                file_handle = self.pack_store.open_blob(self.blob_hash)
+            except (IOError, KeyError):
+                log.exception('Failed to open packed blob %s', self.blob_hash)
+                return None
+            self.readers += 1
+            return file_handle
+        return None
+
+    def delete(self):
+        if not self.writers and not self.readers:
+            self._verified = False
+            self._saving_verified_blob = False
+            self.pack_store.remove(self.blob_hash)
+            return defer.succeed(True)
+        else:
+            return defer.fail(Failure(
+                ValueError("Blob is currently being read or written and cannot be deleted")))
+
+    def close_read_handle(self, file_handle):
+        if file_handle is not None:
+            file_handle.close()
+            self.readers -= 1
+
+    def _close_writer(self, writer):
+        if writer.write_handle is not None:
+            writer.write_handle.close()
+            writer.write_handle = None
+
+    def _save_verified_blob(self, writer):
+        if self._saving_verified_blob:
+            return defer.fail(Failure(DownloadCanceledError()))
+        self._saving_verified_blob = True
+        data = writer.write_handle.getvalue()
+        writer.write_handle.close()
+        writer.write_handle = None
+        return self.pack_store.append(self.blob_hash, data)
+
+
 class HashBlobCreator(object):
     def __init__(self, blob_manager):
         self.blob_manager = blob_manager
@@ -393,7 +460,8 @@ class BlobFileCreator(HashBlobCreator):
         temp_file_name = self.out_file.name
         self.out_file.close()
         if self.blob_hash is not None:
-            shutil.move(temp_file_name, os.path.join(self.blob_dir, self.blob_hash))
+            blob_dir = self.blob_manager.get_blob_dir(self.blob_hash)
+            shutil.move(temp_file_name, os.path.join(blob_dir, self.blob_hash))
         else:
             os.remove(temp_file_name)
         return defer.succeed(True)
@@ -402,6 +470,23 @@ class BlobFileCreator(HashBlobCreator):
         self.out_file.write(data)
 
 
+class PackBlobCreator(HashBlobCreator):
+    def __init__(self, blob_manager, pack_store):
+        HashBlobCreator.__init__(self, blob_manager)
+        self.pack_store = pack_store
+        self.buff = StringIO()
+
+    def _close(self):
+        data = self.buff.getvalue()
+        self.buff.close()
+        if self.blob_hash is not None:
+            return self.pack_store.append(self.blob_hash, data)
+        return defer.succeed(True)
+
+    def _write(self, data):
+        self.buff.write(data)
+
+
 class TempBlobCreator(HashBlobCreator):
     def __init__(self, blob_manager):
         HashBlobCreator.__init__(self, blob_manager)
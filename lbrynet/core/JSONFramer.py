@@ -0,0 +1,133 @@
+import json
+import re
+
+from lbrynet.core.Error import InvalidMessageError
+
+
+# the characters which can change the nesting depth or start a string, outside of a string
+_OUTSIDE_STRING = re.compile(r'[{}"]')
+# the characters which can end a string, inside of a string
+_INSIDE_STRING = re.compile(r'["\\]')
+# the rest of a string, when it ends in the same chunk
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+
+
+class JSONFramer(object):
+    """Splits the JSON objects sent over a connection off the data received
+
+    The data is scanned once, as it arrives, for the braces and quotes which
+    delimit the objects. The scanner keeps track of the nesting depth and of
+    whether it is inside a string between calls, so finding the end of an
+    object that arrives a few bytes at a time doesn't mean re-parsing
+    everything received so far. Data after the end of an object is kept
+    until it is asked for.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        @param max_size: the largest message allowed, in bytes
+        """
+        self.max_size = max_size
+        self._chunks = []
+        self._buffered = 0
+        self._reset_scanner()
+
+    def __len__(self):
+        return self._buffered
+
+    def feed(self, data):
+        if data:
+            self._chunks.append(data)
+            self._buffered += len(data)
+
+    def next_message(self):
+        """Returns the next complete object, or None if it hasn't all arrived yet
+
+        @raise InvalidMessageError: if the data isn't a JSON object, or the
+            object is larger than max_size
+        """
+        while self._chunk_index < len(self._chunks):
+            chunk = self._chunks[self._chunk_index]
+            end = self._scan(chunk)
+            if end is not None:
+                message_chunks = self._chunks[:self._chunk_index]
+                message_chunks.append(chunk[:end])
+                rest = [chunk[end:]] if end < len(chunk) else []
+                self._chunks = rest + self._chunks[self._chunk_index + 1:]
+                message = ''.join(message_chunks)
+                self._buffered -= len(message)
+                self._reset_scanner()
+                try:
+                    return json.loads(message)
+                except ValueError:
+                    raise InvalidMessageError("Invalid message: %s" % message[:100])
+            self._chunk_index += 1
+            self._position = 0
+        if self.max_size is not None and self._buffered > self.max_size:
+            raise InvalidMessageError("Message is larger than %i bytes" % self.max_size)
+        return None
+
+    def pop_buffer(self):
+        """Returns the data received after the last complete object, and forgets it"""
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        self._reset_scanner()
+        return data
+
+    def _reset_scanner(self):
+        self._chunk_index = 0
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def _scan(self, chunk):
+        """Scan the chunk from where the last scan stopped
+
+        Returns the offset just past the end of the object, or None if the
+        object doesn't end in this chunk
+        """
+        position = self._position
+        if self._escaped:
+            # the last chunk ended with a backslash inside a string
+            position += 1
+            self._escaped = False
+        while True:
+            if self._in_string:
+                match = _STRING_END.match(chunk, position)
+                if match is not None:
+                    position = match.end()
+                    self._in_string = False
+                    continue
+                match = _INSIDE_STRING.search(chunk, position)
+                if match is None:
+                    break
+                position = match.end()
+                if match.group() == '"':
+                    self._in_string = False
+                elif position < len(chunk):
+                    position += 1
+                else:
+                    self._escaped = True
+                    break
+            else:
+                match = _OUTSIDE_STRING.search(chunk, position)
+                if self._depth == 0:
+                    start = len(chunk) if match is None else match.start()
+                    if chunk[position:start].strip() or (match and match.group() != '{'):
+                        raise InvalidMessageError("Expected a JSON object")
+                if match is None:
+                    break
+                position = match.end()
+                character = match.group()
+                if character == '"':
+                    self._in_string = True
+                elif character == '{':
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        return position
+        self._position = len(chunk)
+        return None
@@ -0,0 +1,327 @@
+import collections
+import logging
+import os
+import threading
+
+from twisted.internet import threads, defer
+
+
+log = logging.getLogger(__name__)
+
+MB = 2 ** 20
+
+
+class PackedBlobReader(object):
+    """A read only file-like view of one blob inside a segment file"""
+
+    def __init__(self, segment_file, offset, length, close_cb=None):
+        self._file = segment_file
+        self._file.seek(offset)
+        self._remaining = length
+        self._close_cb = close_cb
+        self.closed = False
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._file.close()
+            if self._close_cb is not None:
+                self._close_cb()
+
+
+class PackStore(object):
+    """Stores blobs back to back in large append-only segment files
+
+    The store keeps the location of each blob in memory as
+    {blob_hash: (segment, offset, length)}. Whoever owns the store is
+    responsible for persisting the locations, which are passed to
+    location_changed_cb whenever a blob is appended or moved by compaction.
+    The callback may return a deferred which fires once the location has
+    been persisted.
+
+    Deleting a blob only forgets its location. A segment is rewritten by
+    compact() once enough of it is dead. Its live blobs are copied to the
+    end of the active segment and the old segment file is removed, once
+    their new locations have been persisted.
+
+    The segment files are written in threads. The threads only touch the
+    files and the segment being written, which is guarded by a lock; the
+    segment sizes and the active segment seen by the reactor are updated
+    from what the threads return.
+    """
+
+    # start a new segment once the active one is at least this large
+    SEGMENT_SIZE = 256 * MB
+    # a segment with at least this fraction of dead bytes is compacted
+    COMPACTION_THRESHOLD = 0.5
+
+    def __init__(self, pack_dir, location_changed_cb=None):
+        self.pack_dir = pack_dir
+        self.location_changed_cb = location_changed_cb
+        self.index = {}  # {blob_hash: (segment, offset, length)}
+        self.segment_sizes = collections.defaultdict(int)
+        self.live_bytes = collections.defaultdict(int)
+        self.active_segment = 0
+        # the segment the next blob is written to, only used while holding the lock
+        self._write_segment = 0
+        self._append_lock = threading.Lock()
+        self._segment_readers = collections.defaultdict(int)
+        self._compacting = None
+        self._retired_segments = set()
+        # segments kept because the new locations of their blobs failed to persist
+        self._kept_segments = set()
+        self._pending_appends = []  # [(blob_hash, data, deferred)]
+        self._appending = False
+
+    def segment_path(self, segment):
+        return os.path.join(self.pack_dir, "segment-%06i.pack" % segment)
+
+    def load(self, locations):
+        """Load the blob locations persisted by the owner of the store
+
+        @param locations: iterable of (blob_hash, segment, offset, length)
+        """
+        self.segment_sizes = collections.defaultdict(int)
+        for name in os.listdir(self.pack_dir):
+            if name.startswith("segment-") and name.endswith(".pack"):
+                segment = int(name[len("segment-"):-len(".pack")])
+                self.segment_sizes[segment] = os.path.getsize(self.segment_path(segment))
+        self.index = {}
+        self.live_bytes = collections.defaultdict(int)
+        missing = 0
+        for blob_hash, segment, offset, length in locations:
+            if offset + length > self.segment_sizes.get(segment, 0):
+                missing += 1
+                continue
+            self.index[blob_hash] = (segment, offset, length)
+            self.live_bytes[segment] += length
+        if missing:
+            log.warning("%i packed blobs are missing from their segment files", missing)
+        if self.segment_sizes:
+            self.active_segment = max(self.segment_sizes)
+            if self.segment_sizes[self.active_segment] >= self.SEGMENT_SIZE:
+                self.active_segment += 1
+        with self._append_lock:
+            self._write_segment = self.active_segment
+        log.info("Loaded %i packed blobs in %i segments", len(self.index),
+                 len(self.segment_sizes))
+
+    def has_blob(self, blob_hash):
+        return blob_hash in self.index
+
+    def get_length(self, blob_hash):
+        return self.index[blob_hash][2]
+
+    def append(self, blob_hash, data):
+        """Append a blob to the active segment
+
+        Blobs appended while a previous append is being written are written
+        together afterwards, with a single fsync.
+
+        @return: a deferred which fires with the blob's location once it has been
+            written and synced
+        """
+        d = defer.Deferred()
+        self._pending_appends.append((blob_hash, data, d))
+        if not self._appending:
+            self._write_pending_appends()
+        return d
+
+    def _write_pending_appends(self):
+        appends, self._pending_appends = self._pending_appends, []
+        self._appending = True
+
+        def set_locations(result):
+            locations, sizes, write_segment = result
+            self._appended(sizes, write_segment)
+            for (blob_hash, _, append_deferred), location in zip(appends, locations):
+                # the owner of the store logs the locations which fail to persist
+                self._set_location(blob_hash, location).addErrback(lambda _: None)
+                append_deferred.callback(location)
+
+        def errback_appends(err):
+            log.warning("Failed to append %i blobs to the blob pack: %s", len(appends),
+                        err.getErrorMessage())
+            for _, _, append_deferred in appends:
+                append_deferred.errback(err)
+
+        def write_next_appends(_):
+            self._appending = False
+            if self._pending_appends:
+                self._write_pending_appends()
+
+        d = threads.deferToThread(self._append_many, [data for _, data, _ in appends])
+        d.addCallbacks(set_locations, errback_appends)
+        d.addCallback(write_next_appends)
+
+    def _append_many(self, datas):
+        """Write datas to the end of the segment being written, in a thread
+
+        @return: the locations of datas, the new sizes of the segments which were
+            written as {segment: size}, and the segment to write to next, for the
+            caller to apply with _appended in the reactor
+        """
+        locations = []
+        sizes = {}
+        with self._append_lock:
+            segment = self._write_segment
+            segment_file = None
+            try:
+                for data in datas:
+                    if segment_file is None:
+                        segment_file = open(self.segment_path(segment), 'ab')
+                        segment_file.seek(0, os.SEEK_END)
+                    offset = segment_file.tell()
+                    segment_file.write(data)
+                    locations.append((segment, offset, len(data)))
+                    sizes[segment] = offset + len(data)
+                    if sizes[segment] >= self.SEGMENT_SIZE:
+                        self._sync_and_close(segment_file)
+                        segment_file = None
+                        segment += 1
+            finally:
+                self._write_segment = segment
+                if segment_file is not None:
+                    self._sync_and_close(segment_file)
+        return locations, sizes, segment
+
+    def _appended(self, sizes, write_segment):
+        # appends and compactions write in separate threads, so their results may
+        # arrive out of order
+        for segment, size in sizes.iteritems():
+            self.segment_sizes[segment] = max(self.segment_sizes[segment], size)
+        self.active_segment = max(self.active_segment, write_segment)
+
+    @staticmethod
+    def _sync_and_close(segment_file):
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+        segment_file.close()
+
+    def _set_location(self, blob_hash, location):
+        old_location = self.index.get(blob_hash)
+        if old_location is not None:
+            self.live_bytes[old_location[0]] -= old_location[2]
+        self.index[blob_hash] = location
+        self.live_bytes[location[0]] += location[2]
+        if self.location_changed_cb is None:
+            return defer.succeed(None)
+        return defer.maybeDeferred(self.location_changed_cb, blob_hash, location)
+
+    def open_blob(self, blob_hash):
+        segment, offset, length = self.index[blob_hash]
+        segment_file = open(self.segment_path(segment), 'rb')
+        self._segment_readers[segment] += 1
+
+        def reader_closed():
+            self._segment_readers[segment] -= 1
+            if not self._segment_readers[segment]:
+                del self._segment_readers[segment]
+                if segment in self._retired_segments:
+                    self._remove_segment(segment)
+
+        return PackedBlobReader(segment_file, offset, length, reader_closed)
+
+    def remove(self, blob_hash):
+        location = self.index.pop(blob_hash, None)
+        if location is not None:
+            self.live_bytes[location[0]] -= location[2]
+        return location
+
+    def get_stats(self):
+        total_bytes = sum(self.segment_sizes.itervalues())
+        live_bytes = sum(self.live_bytes.itervalues())
+        return {
+            'blobs': len(self.index),
+            'segments': len(self.segment_sizes),
+            'total_bytes': total_bytes,
+            'dead_bytes': total_bytes - live_bytes,
+        }
+
+    def segments_to_compact(self):
+        segments = []
+        for segment, size in self.segment_sizes.iteritems():
+            if segment == self.active_segment or segment in self._retired_segments or \
+                    segment in self._kept_segments or not size:
+                continue
+            dead = size - self.live_bytes.get(segment, 0)
+            if float(dead) / size >= self.COMPACTION_THRESHOLD:
+                segments.append(segment)
+        return sorted(segments)
+
+    def compact(self, segment):
+        """Copy the live blobs of a segment to the active segment and remove it
+
+        @return: a deferred which fires with the number of bytes reclaimed
+        """
+        if self._compacting is not None:
+            return defer.succeed(0)
+        assert segment != self.active_segment
+        self._compacting = segment
+        to_copy = [(blob_hash, location) for blob_hash, location in self.index.iteritems()
+                   if location[0] == segment]
+        reclaimed = self.segment_sizes[segment] - self.live_bytes.get(segment, 0)
+
+        def copy_blobs():
+            datas = []
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                for blob_hash, (_, offset, length) in to_copy:
+                    segment_file.seek(offset)
+                    datas.append(segment_file.read(length))
+            new_locations, sizes, write_segment = self._append_many(datas)
+            copied = [(blob_hash, offset, new_location)
+                      for (blob_hash, (_, offset, _)), new_location in zip(to_copy, new_locations)]
+            return copied, sizes, write_segment
+
+        def update_locations(result):
+            copied, sizes, write_segment = result
+            self._appended(sizes, write_segment)
+            persisted = []
+            for blob_hash, old_offset, new_location in copied:
+                if self.index.get(blob_hash) == (segment, old_offset, new_location[2]):
+                    persisted.append(self._set_location(blob_hash, new_location))
+                else:
+                    # deleted while being copied, so the copy is dead already
+                    log.debug("Packed blob %s was removed during compaction", blob_hash)
+            # the old segment is only removed once nothing points at it anymore
+            d = defer.DeferredList(persisted, fireOnOneErrback=True, consumeErrors=True)
+            d.addCallbacks(lambda _: retire_segment(), keep_segment)
+            return d
+
+        def retire_segment():
+            self._retired_segments.add(segment)
+            if not self._segment_readers.get(segment):
+                self._remove_segment(segment)
+            log.info("Compacted blob pack segment %i, reclaimed %i bytes", segment, reclaimed)
+            return reclaimed
+
+        def keep_segment(err):
+            log.warning("Keeping blob pack segment %i, the new locations of its blobs "
+                        "failed to persist: %s", segment, err.value.subFailure.getErrorMessage())
+            self._kept_segments.add(segment)
+            return 0
+
+        def finished(result):
+            self._compacting = None
+            return result
+
+        d = threads.deferToThread(copy_blobs)
+        d.addCallback(update_locations)
+        d.addBoth(finished)
+        return d
+
+    def _remove_segment(self, segment):
+        self._retired_segments.discard(segment)
+        self.segment_sizes.pop(segment, None)
+        self.live_bytes.pop(segment, None)
+        try:
+            os.remove(self.segment_path(segment))
+        except OSError as err:
+            log.warning("Failed to remove blob pack segment %i: %s", segment, err)
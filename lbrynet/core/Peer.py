@@ -1,9 +1,13 @@
 import datetime
+import time
 from collections import defaultdict
 from lbrynet.core import utils
 
 # Do not create this object except through PeerManager
 class Peer(object):
+    # how much a new measurement of the download rate counts in the average
+    DOWNLOAD_RATE_WEIGHT = 0.3
+
     def __init__(self, host, port):
         self.host = host
         self.port = port
@@ -15,6 +19,10 @@ class Peer(object):
         self.success_count = 0
         self.score = 0
         self.stats = defaultdict(float)  # {string stat_type, float count}
+        # the average rate blobs have been downloaded from this peer at, in bytes per second,
+        # and when it was last measured
+        self.download_rate = None
+        self.download_rate_measured_at = None
 
     def is_available(self):
         if self.attempt_connection_at is None or utils.today() > self.attempt_connection_at:
@@ -39,6 +47,13 @@ class Peer(object):
     def update_stats(self, stat_type, count):
         self.stats[stat_type] += count
 
+    def report_download_rate(self, rate):
+        if self.download_rate is None:
+            self.download_rate = rate
+        else:
+            self.download_rate += (rate - self.download_rate) * self.DOWNLOAD_RATE_WEIGHT
+        self.download_rate_measured_at = time.time()
+
     def __str__(self):
         return '{}:{}'.format(self.host, self.port)
 
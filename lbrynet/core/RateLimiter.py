@@ -45,6 +45,9 @@ class DummyRateLimiter(object):
         self.ul_bytes_this_second += num_bytes
         self.total_ul_bytes += num_bytes
 
+    def is_ul_limited(self):
+        return False
+
 
 class RateLimiter(object):
     """This class ensures that upload and download rates don't exceed specified maximums"""
@@ -131,6 +134,10 @@ class RateLimiter(object):
                 protocol.unthrottle_upload()
             self.ul_throttled = False
 
+    def is_ul_limited(self):
+        """Whether uploads are currently throttled or subject to a maximum rate"""
+        return self.ul_throttled or self.max_ul_bytes is not None
+
     #called by protocols
 
     def report_dl_bytes(self, num_bytes):
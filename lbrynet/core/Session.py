@@ -1,6 +1,9 @@
 import logging
 import miniupnpc
-from lbrynet.core.BlobManager import DiskBlobManager, TempBlobManager
+import os
+from lbrynet import conf
+from lbrynet.core.BlobManager import DiskBlobManager, PackBlobManager, TempBlobManager
+from lbrynet.dht import datastore
 from lbrynet.dht import node
 from lbrynet.core.PeerManager import PeerManager
 from lbrynet.core.RateLimiter import RateLimiter
@@ -78,7 +81,8 @@ class Session(object):
         @param blob_manager: An object which keeps track of downloaded
             blobs and provides access to them. If None, and blob_dir
             is not None, a DiskBlobManager will be used, with the
-            given blob_dir.  If None and blob_dir is None, a
+            given blob_dir, or a PackBlobManager if the use_blob_packs
+            setting is on.  If None and blob_dir is None, a
             TempBlobManager will be used, which stores blobs in memory
             only.
 
@@ -275,14 +279,25 @@ class Session(object):
             d.addCallback(match_port, port)
             ds.append(d)
 
+        dht_node_kwargs = {'maxPacketsPerSecond': conf.settings['dht_packets_per_second']}
+        if self.db_dir is not None:
+            dht_node_kwargs['routingTableSnapshot'] = os.path.join(self.db_dir,
+                                                                   "dht_routing_table.json")
+        if conf.settings['dht_lookup_paths']:
+            dht_node_kwargs['disjointLookupPaths'] = conf.settings['dht_lookup_paths']
+        if conf.settings['persist_dht_peers'] and self.db_dir is not None:
+            dht_node_kwargs['dataStore'] = datastore.SQLitePeerDataStore(
+                os.path.join(self.db_dir, "dht_peers.db"))
         self.dht_node = self.dht_node_class(
             udpPort=self.dht_node_port,
             lbryid=self.lbryid,
-            externalIP=self.external_ip
+            externalIP=self.external_ip,
+            **dht_node_kwargs
         )
         self.peer_finder = DHTPeerFinder(self.dht_node, self.peer_manager)
         if self.hash_announcer is None:
-            self.hash_announcer = DHTHashAnnouncer(self.dht_node, self.peer_port)
+            self.hash_announcer = DHTHashAnnouncer(self.dht_node, self.peer_port,
+                                                   conf.settings['announce_rate'])
 
         dl = defer.DeferredList(ds)
         dl.addCallback(join_resolved_addresses)
@@ -298,6 +313,10 @@ class Session(object):
         if self.blob_manager is None:
             if self.blob_dir is None:
                 self.blob_manager = TempBlobManager(self.hash_announcer)
+            elif conf.settings['use_blob_packs']:
+                self.blob_manager = PackBlobManager(self.hash_announcer,
+                                                    self.blob_dir,
+                                                    self.db_dir)
             else:
                 self.blob_manager = DiskBlobManager(self.hash_announcer,
                                                     self.blob_dir,
@@ -146,8 +146,9 @@ class StreamDescriptorIdentifier(object):
         @param sd_info_validator: A class implementing the
             IStreamDescriptorValidator interface. This class's
             constructor will be passed the raw metadata in the stream
-            descriptor file and its 'validate' method will then be
-            called. If the validation step fails, an exception will be
+            descriptor file and the hash of the stream descriptor blob,
+            or None if it was read from a plain file, and its 'validate'
+            method will then be called. If the validation step fails, an exception will be
             thrown, preventing the stream descriptor from being
             further processed.
 
@@ -200,7 +201,7 @@ class StreamDescriptorIdentifier(object):
     def get_metadata_for_sd_blob(self, sd_blob):
         sd_reader = BlobStreamDescriptorReader(sd_blob)
         d = sd_reader.get_info()
-        d.addCallback(self._return_options_and_validator_and_factories)
+        d.addCallback(self._return_options_and_validator_and_factories, sd_blob.blob_hash)
         d.addCallback(self._return_metadata, StreamMetadata.FROM_BLOB, sd_blob.blob_hash)
         return d
 
@@ -219,11 +220,11 @@ class StreamDescriptorIdentifier(object):
             raise UnknownStreamTypeError(stream_type)
         return self._stream_options[stream_type]
 
-    def _return_options_and_validator_and_factories(self, sd_info):
+    def _return_options_and_validator_and_factories(self, sd_info, sd_hash=None):
         if not 'stream_type' in sd_info:
             raise InvalidStreamDescriptorError('No stream_type parameter in stream descriptor.')
         stream_type = sd_info['stream_type']
-        validator = self._get_validator(stream_type)(sd_info)
+        validator = self._get_validator(stream_type)(sd_info, sd_hash=sd_hash)
         factories = [f for f in self._get_factories(stream_type) if f.can_download(validator)]
 
         d = validator.validate()
@@ -1,4 +1,5 @@
 import logging
+import time
 from collections import defaultdict
 from decimal import Decimal
 
@@ -250,6 +251,9 @@ def _handle_incoming_blob(response_dict, peer, request):
         if response['error'] == "RATE_UNSET":
             # Stop the download with an error that won't penalize the peer
             request.cancel(PriceDisagreementError())
+        elif response['error'] == "BLOB_CANCELLED":
+            # the download was cancelled before the peer handled the request
+            pass
         else:
             # The peer has done something bad so we should get out of here
             return InvalidResponseError("Got an unknown error from the peer: %s" %
@@ -401,6 +405,7 @@ class PriceRequest(RequestHelper):
         else:
             log.warning("Price disagreement")
             self.requestor._price_disagreements.append(self.peer)
+            self.peer.update_stats('price_disagreements', 1)
             return False
 
 
@@ -448,6 +453,11 @@ class DownloadRequest(RequestHelper):
             if blob.is_validated():
                 log.debug('Skipping blob %s as its already validated', blob)
                 continue
+            if self.peer in blob.writers:
+                # a pipelined request is being made while this blob downloads from the peer
+                log.debug('Skipping blob %s as it is already being downloaded from %s',
+                          blob, self.peer)
+                continue
             d, write_func, cancel_func = blob.open_for_writing(self.peer)
             if d is not None:
                 return BlobDownloadDetails(blob, d, write_func, cancel_func, self.peer)
@@ -552,6 +562,8 @@ class DownloadRequest(RequestHelper):
     def _download_failed(self, reason):
         if not reason.check(DownloadCanceledError, PriceDisagreementError):
             self.update_local_score(-10.0)
+            if not reason.check(RequestCanceledError):
+                self.peer.update_stats('blob_downloads_failed', 1)
         return reason
 
 
@@ -563,7 +575,24 @@ class BlobDownloadDetails(object):
         self.write_func = write_func
         self.cancel_func = cancel_func
         self.peer = peer
+        self._bytes_written = 0
+        self._first_write = None  # (time, bytes)
 
     def counting_write_func(self, data):
         self.peer.update_stats('blob_bytes_downloaded', len(data))
+        self._measure_download_rate(len(data))
         return self.write_func(data)
+
+    def _measure_download_rate(self, num_bytes):
+        # the rate is measured from the first write, rather than from the request, so
+        # the time spent waiting for the response or for a pipelined request's turn
+        # doesn't count against the peer
+        now = time.time()
+        self._bytes_written += num_bytes
+        if self._first_write is None:
+            self._first_write = (now, num_bytes)
+        elif self._bytes_written == self.blob.length:
+            started, first_bytes = self._first_write
+            if now > started:
+                rate = (self._bytes_written - first_bytes) / (now - started)
+                self.peer.report_download_rate(rate)
@@ -9,7 +9,8 @@ from lbrynet import conf
 from lbrynet.core import utils
 from lbrynet.core.Error import ConnectionClosedBeforeResponseError, NoResponseError
 from lbrynet.core.Error import DownloadCanceledError, MisbehavingPeerError
-from lbrynet.core.Error import RequestCanceledError
+from lbrynet.core.Error import RequestCanceledError, InvalidMessageError
+from lbrynet.core.JSONFramer import JSONFramer
 from lbrynet.interfaces import IRequestSender, IRateLimited
 from zope.interface import implements
 
@@ -27,6 +28,15 @@ class ClientProtocol(Protocol, TimeoutMixin):
     implements(IRequestSender, IRateLimited)
     ######### Protocol #########
     PROTOCOL_TIMEOUT = 30
+    # asks the server whether the next request may be sent while a blob is downloading
+    PIPELINING_QUERY = 'pipelining'
+    # asks the server whether a blob can be cancelled without closing the connection. A
+    # CANCEL_QUERY stops the server from sending the blob if it hasn't handled the request
+    # for it yet. Otherwise the blob is sent in full and skipped by its length. The server
+    # acknowledges the cancel with a CANCELLED_RESPONSE of its own, which is ignored
+    CANCELLING_QUERY = 'blob_cancelling'
+    CANCEL_QUERY = 'cancel_blob'
+    CANCELLED_RESPONSE = 'cancelled_blob'
 
     def connectionMade(self):
         log.debug("Connection made to %s", self.factory.peer)
@@ -34,9 +44,17 @@ class ClientProtocol(Protocol, TimeoutMixin):
         self._rate_limiter = self.factory.rate_limiter
         self.peer = self.factory.peer
         self._response_deferreds = {}
-        self._response_buff = ''
+        self._response_framer = JSONFramer(conf.settings['MAX_RESPONSE_INFO_SIZE'])
         self._downloading_blob = False
         self._blob_download_request = None
+        # a blob request sent while the blob of _blob_download_request is downloading
+        self._pipelined_blob_request = None
+        # when pipelining or cancelling, the bytes of the blob left to download before the
+        # next response
+        self._blob_bytes_remaining = None
+        self._first_request_sent = False
+        self._pipelining = None
+        self._cancelling = None
         self._next_request = {}
         self.connection_closed = False
         self.connection_closing = False
@@ -50,20 +68,45 @@ class ClientProtocol(Protocol, TimeoutMixin):
         log.debug("Data receieved from %s", self.peer)
         self.setTimeout(None)
         self._rate_limiter.report_dl_bytes(len(data))
-        if self._downloading_blob is True:
-            self._blob_download_request.write(data)
-        else:
-            self._response_buff += data
-            if len(self._response_buff) > conf.settings['MAX_RESPONSE_INFO_SIZE']:
-                log.warning("Response is too large from %s. Size %s",
-                            self.peer, len(self._response_buff))
+        while data:
+            if self._downloading_blob is True:
+                data = self._write_blob_data(data)
+                continue
+            self._response_framer.feed(data)
+            try:
+                response = self._response_framer.next_message()
+            except InvalidMessageError as err:
+                log.warning("Bad response from %s: %s", self.peer, err)
                 self.transport.loseConnection()
-            response, extra_data = self._get_valid_response(self._response_buff)
-            if response is not None:
-                self._response_buff = ''
-                self._handle_response(response)
-                if self._downloading_blob is True and len(extra_data) != 0:
-                    self._blob_download_request.write(extra_data)
+                return
+            if response is None:
+                return
+            data = self._response_framer.pop_buffer()
+            self._handle_response(response)
+
+    def _write_blob_data(self, data):
+        """Write data to the blob being downloaded, and return what comes after the blob"""
+        blob_request = self._blob_download_request
+        if self._blob_bytes_remaining is None:
+            blob_request.write(data)
+            return ''
+        blob_data = data[:self._blob_bytes_remaining]
+        self._blob_bytes_remaining -= len(blob_data)
+        if self._blob_bytes_remaining == 0:
+            self._finish_blob_data()
+        if not blob_request.finished_deferred.called:
+            # the data of a blob which was cancelled is skipped
+            blob_request.write(blob_data)
+        return data[len(blob_data):]
+
+    def _finish_blob_data(self):
+        # what follows is the response to the pipelined request, if one was sent
+        self._blob_bytes_remaining = None
+        self._downloading_blob = False
+        self._blob_download_request = self._pipelined_blob_request
+        self._pipelined_blob_request = None
+        if self._response_deferreds:
+            self.setTimeout(self.PROTOCOL_TIMEOUT)
 
     def timeoutConnection(self):
         log.info("Connection timed out to %s", self.peer)
@@ -81,8 +124,9 @@ class ClientProtocol(Protocol, TimeoutMixin):
         for key, d in self._response_deferreds.items():
             del self._response_deferreds[key]
             d.errback(err)
-        if self._blob_download_request is not None:
-            self._blob_download_request.cancel(err)
+        for blob_request in (self._blob_download_request, self._pipelined_blob_request):
+            if blob_request is not None:
+                blob_request.cancel(err)
         self.factory.connection_was_made_deferred.callback(True)
 
     ######### IRequestSender #########
@@ -100,12 +144,16 @@ class ClientProtocol(Protocol, TimeoutMixin):
         if self._blob_download_request is None:
             d = self.add_request(blob_request)
             self._blob_download_request = blob_request
-            blob_request.finished_deferred.addCallbacks(self._downloading_finished,
-                                                        self._downloading_failed)
-            blob_request.finished_deferred.addErrback(self._handle_response_error)
-            return d
+        elif self._blob_bytes_remaining is not None and self._pipelined_blob_request is None:
+            d = self.add_request(blob_request)
+            self._pipelined_blob_request = blob_request
         else:
             raise ValueError("There is already a blob download request active")
+        blob_request.finished_deferred.addCallbacks(
+            self._downloading_finished, self._downloading_failed,
+            callbackArgs=(blob_request,), errbackArgs=(blob_request,))
+        blob_request.finished_deferred.addErrback(self._handle_response_error)
+        return d
 
     def cancel_requests(self):
         self.connection_closing = True
@@ -115,10 +163,12 @@ class ClientProtocol(Protocol, TimeoutMixin):
             del self._response_deferreds[key]
             d.errback(err)
             ds.append(d)
-        if self._blob_download_request is not None:
-            self._blob_download_request.cancel(err)
-            ds.append(self._blob_download_request.finished_deferred)
-            self._blob_download_request = None
+        for blob_request in (self._blob_download_request, self._pipelined_blob_request):
+            if blob_request is not None:
+                blob_request.cancel(err)
+                ds.append(blob_request.finished_deferred)
+        self._blob_download_request = None
+        self._pipelined_blob_request = None
         return defer.DeferredList(ds)
 
     ######### Internal request handling #########
@@ -129,14 +179,22 @@ class ClientProtocol(Protocol, TimeoutMixin):
             self.peer, err.getTraceback())
         self.transport.loseConnection()
 
-    def _ask_for_request(self):
+    def _ask_for_request(self, pipelined=False):
+        """Ask the connection manager for the next request and send it
+
+        @param pipelined: whether a blob is still downloading, in which case the connection
+            is left open if there is no request to send yet
+        @return: a deferred which fires with whether a request was sent
+        """
         if self.connection_closed is True or self.connection_closing is True:
-            return
+            return defer.succeed(None)
 
         def send_request_or_close(do_request):
             if do_request is True:
                 request_msg, self._next_request = self._next_request, {}
                 self._send_request_message(request_msg)
+            elif pipelined:
+                log.debug("No request to send to %s while the blob downloads", self.peer)
             else:
                 # The connection manager has indicated that this connection should be terminated
                 log.info(
@@ -144,36 +202,30 @@ class ClientProtocol(Protocol, TimeoutMixin):
                     self.peer)
                 self.peer.report_success()
                 self.transport.loseConnection()
+            return do_request
         d = self._connection_manager.get_next_request(self.peer, self)
         d.addCallback(send_request_or_close)
         d.addErrback(self._handle_request_error)
+        return d
+
+    def _ask_unless_sent(self, request_sent):
+        if request_sent is False:
+            log.debug("Asking for another request from %s", self.peer)
+            self._ask_for_request()
 
     def _send_request_message(self, request_msg):
         self.setTimeout(self.PROTOCOL_TIMEOUT)
+        if not self._first_request_sent:
+            # the server answers with the ones it supports
+            if conf.settings['pipeline_blob_requests']:
+                request_msg[self.PIPELINING_QUERY] = True
+            request_msg[self.CANCELLING_QUERY] = True
+            self._first_request_sent = True
         # TODO: compare this message to the last one. If they're the same,
         # TODO: incrementally delay this message.
         m = json.dumps(request_msg, default=encode_decimal)
         self.transport.write(m)
 
-    def _get_valid_response(self, response_msg):
-        extra_data = None
-        response = None
-        curr_pos = 0
-        while 1:
-            next_close_paren = response_msg.find('}', curr_pos)
-            if next_close_paren != -1:
-                curr_pos = next_close_paren + 1
-                try:
-                    response = json.loads(response_msg[:curr_pos])
-                except ValueError:
-                    pass
-                else:
-                    extra_data = response_msg[curr_pos:]
-                    break
-            else:
-                break
-        return response, extra_data
-
     def _handle_response_error(self, err):
         # If an error gets to this point, log it and kill the connection.
         expected_errors = (MisbehavingPeerError, ConnectionClosedBeforeResponseError,
@@ -187,7 +239,13 @@ class ClientProtocol(Protocol, TimeoutMixin):
             return err
 
     def _handle_response(self, response):
+        if self.CANCELLED_RESPONSE in response:
+            log.debug("%s acknowledged the cancel of a blob", self.peer)
+            return
         ds = []
+        if self._pipelining is None:
+            self._pipelining = response.pop(self.PIPELINING_QUERY, False) is True
+            self._cancelling = response.pop(self.CANCELLING_QUERY, False) is True
         log.debug(
             "Handling a response from %s. Expected responses: %s. Actual responses: %s",
             self.peer, self._response_deferreds.keys(), response.keys())
@@ -201,11 +259,29 @@ class ClientProtocol(Protocol, TimeoutMixin):
             d.errback(failure.Failure(NoResponseError()))
             ds.append(d)
 
+        pipelined = None
         if self._blob_download_request is not None:
             self._downloading_blob = True
             d = self._blob_download_request.finished_deferred
+            if self._pipelining or self._cancelling:
+                self._blob_bytes_remaining = self._get_incoming_blob_length(response)
+            incoming_blob = response.get('incoming_blob')
+            if d.called and self._blob_bytes_remaining is None and \
+                    isinstance(incoming_blob, dict):
+                if 'error' in incoming_blob:
+                    # no data follows, so the next response can be read
+                    self._finish_blob_data()
+                else:
+                    log.debug("Closing the connection to %s because the data of a cancelled "
+                              "blob can't be skipped", self.peer)
+                    self.transport.loseConnection()
+                    return
             d.addErrback(self._handle_response_error)
             ds.append(d)
+            if self._blob_bytes_remaining is not None:
+                # the blob ends where the response to the next request starts, so that
+                # request can be sent now instead of after the blob has arrived
+                pipelined = self._ask_for_request(pipelined=True)
 
         # TODO: are we sure we want to consume errors here
         dl = defer.DeferredList(ds, consumeErrors=True)
@@ -222,30 +298,57 @@ class ClientProtocol(Protocol, TimeoutMixin):
 
                         self.peer.report_down()
             if failed is False:
-                log.debug("Asking for another request from %s", self.peer)
-                self._ask_for_request()
+                if pipelined is None:
+                    log.debug("Asking for another request from %s", self.peer)
+                    self._ask_for_request()
+                else:
+                    pipelined.addCallback(self._ask_unless_sent)
             else:
                 log.debug("Not asking for another request from %s", self.peer)
                 self.transport.loseConnection()
 
         dl.addCallback(get_next_request)
 
-    def _downloading_finished(self, arg):
+    def _get_incoming_blob_length(self, response):
+        blob = self._blob_download_request.blob
+        incoming_blob = response.get('incoming_blob')
+        if not isinstance(incoming_blob, dict) or 'error' in incoming_blob:
+            return None
+        if not blob.length or incoming_blob.get('length') != blob.length:
+            return None
+        return blob.length
+
+    def _downloading_finished(self, arg, blob_request):
         log.debug("The blob has finished downloading from %s", self.peer)
-        self._blob_download_request = None
-        self._downloading_blob = False
+        if self._blob_download_request is blob_request:
+            self._blob_download_request = None
+            self._downloading_blob = False
         return arg
 
-    def _downloading_failed(self, err):
+    def _downloading_failed(self, err, blob_request):
         if err.check(DownloadCanceledError):
-            # TODO: (wish-list) it seems silly to close the connection over this, and it shouldn't
-            # TODO: always be this way. it's done this way now because the client has no other way
-            # TODO: of telling the server it wants the download to stop. It would be great if the
-            # TODO: protocol had such a mechanism.
+            # the data of a blob which is downloading can only be skipped if its length is known
+            can_skip = blob_request is self._pipelined_blob_request or (
+                blob_request is self._blob_download_request and
+                (not self._downloading_blob or self._blob_bytes_remaining is not None))
+            if self._cancelling and can_skip:
+                log.debug("The download of blob %s from %s was canceled",
+                          blob_request.blob, self.peer)
+                if blob_request is not self._blob_download_request or \
+                        not self._downloading_blob:
+                    # the server may not have handled the request yet
+                    self._send_cancel(blob_request)
+                # the blob's data, if it's sent, is skipped by its length, so the connection
+                # can be used for the next request
+                return None
             log.debug("Closing the connection to %s because the download of blob %s was canceled",
-                     self.peer, self._blob_download_request.blob)
+                     self.peer, blob_request.blob)
         return err
 
+    def _send_cancel(self, blob_request):
+        cancel = {'blob_hash': blob_request.blob.blob_hash}
+        self.transport.write(json.dumps({self.CANCEL_QUERY: cancel}))
+
     ######### IRateLimited #########
 
     def throttle_upload(self):
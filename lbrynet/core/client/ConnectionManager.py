@@ -4,6 +4,7 @@ from zope.interface import implements
 from lbrynet import interfaces
 from lbrynet import conf
 from lbrynet.core.client.ClientProtocol import ClientProtocolFactory
+from lbrynet.core.client.PeerScorer import PeerScorer
 from lbrynet.core.Error import InsufficientFundsError
 from lbrynet.core import utils
 
@@ -32,6 +33,7 @@ class ConnectionManager(object):
         self._next_manage_call = None
         # a deferred that gets fired when a _manage call is set
         self._manage_deferred = None
+        self._peer_scorer = PeerScorer()
         self.stopped = True
         log.info("%s initialized", self._get_log_name())
 
@@ -180,8 +182,6 @@ class ConnectionManager(object):
         defer.returnValue(new_peers)
 
     def _pick_best_peer(self, peers):
-        # TODO: Eventually rank them based on past performance/reputation. For now
-        # TODO: just pick the first to which we don't have an open connection
         log.debug("%s Got a list of peers to choose from: %s",
                     self._get_log_name(), peers)
         log.debug("%s Current connections: %s",
@@ -190,12 +190,13 @@ class ConnectionManager(object):
                     [p_c_h.connection.state for p_c_h in self._peer_connections.values()])
         if peers is None:
             return None
-        for peer in peers:
-            if not peer in self._peer_connections:
-                log.debug("%s Got a good peer %s", self._get_log_name(), peer)
-                return peer
-        log.debug("%s Couldn't find a good peer to connect to", self._get_log_name())
-        return None
+        candidates = [peer for peer in peers if not peer in self._peer_connections]
+        peer = self._peer_scorer.pick(candidates, conf.settings['peer_selection_epsilon'])
+        if peer is None:
+            log.debug("%s Couldn't find a good peer to connect to", self._get_log_name())
+        else:
+            log.debug("%s Got a good peer %s", self._get_log_name(), peer)
+        return peer
 
     def _connect_to_peer(self, peer):
         if peer is None or self.stopped:
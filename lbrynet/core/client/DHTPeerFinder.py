@@ -1,8 +1,10 @@
 import binascii
 import logging
+import time
 
 from zope.interface import implements
 from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 from lbrynet.interfaces import IPeerFinder
 from lbrynet.core.utils import short_hash
 
@@ -14,11 +16,23 @@ class DHTPeerFinder(object):
     """This class finds peers which have announced to the DHT that they have certain blobs"""
     implements(IPeerFinder)
 
+    # seconds the peers found for a blob are reused for, lookups which found no peers or
+    # failed are reused for less time so a blob that was just announced is found soon
+    PEER_CACHE_TIME = 60
+    EMPTY_PEER_CACHE_TIME = 10
+
     def __init__(self, dht_node, peer_manager):
         self.dht_node = dht_node
         self.peer_manager = peer_manager
         self.peers = []
         self.next_manage_call = None
+        # {blob hash: (expiry time, [(host, port)])}
+        self._peer_cache = {}
+        # {blob hash: [deferreds waiting for the lookup in progress]}
+        self._pending_lookups = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._coalesced_lookups = 0
 
     def run_manage_loop(self):
 
@@ -34,7 +48,60 @@ class DHTPeerFinder(object):
             self.next_manage_call = None
 
     def _manage_peers(self):
-        pass
+        now = time.time()
+        for bin_hash, (expiry_time, _) in self._peer_cache.items():
+            if expiry_time <= now:
+                del self._peer_cache[bin_hash]
+        log.debug("Peer cache stats: %s", self.get_cache_stats())
+
+    def get_cache_stats(self):
+        """
+        Returns the number of peer searches answered from the cache (hits), by joining a
+        lookup already in progress (coalesced), and by a new dht lookup (misses)
+        """
+        searches = self._cache_hits + self._coalesced_lookups + self._cache_misses
+        if searches:
+            hit_rate = float(self._cache_hits + self._coalesced_lookups) / searches
+        else:
+            hit_rate = 0.0
+        return {
+            'hits': self._cache_hits,
+            'coalesced': self._coalesced_lookups,
+            'misses': self._cache_misses,
+            'hit_rate': hit_rate,
+            'cached_blobs': len(self._peer_cache),
+        }
+
+    def _get_peer_addresses(self, bin_hash):
+        cached = self._peer_cache.get(bin_hash)
+        if cached is not None and cached[0] > time.time():
+            self._cache_hits += 1
+            return defer.succeed(list(cached[1]))
+        d = defer.Deferred()
+        if bin_hash in self._pending_lookups:
+            self._coalesced_lookups += 1
+            self._pending_lookups[bin_hash].append(d)
+            return d
+        self._cache_misses += 1
+        self._pending_lookups[bin_hash] = [d]
+        lookup = self.dht_node.getPeersForBlob(bin_hash)
+        lookup.addBoth(self._finish_lookup, bin_hash)
+        return d
+
+    def _finish_lookup(self, result, bin_hash):
+        waiting = self._pending_lookups.pop(bin_hash)
+        if isinstance(result, Failure):
+            # a failed lookup is cached as one which found no peers, so that a failing
+            # dht isn't searched again by every request for the blob
+            log.warning("Peer search for %s failed: %s", short_hash(binascii.hexlify(bin_hash)),
+                        result.getErrorMessage())
+            result = []
+        cache_time = self.PEER_CACHE_TIME if result else self.EMPTY_PEER_CACHE_TIME
+        self._peer_cache[bin_hash] = (time.time() + cache_time, result)
+        for d in waiting:
+            # a search which timed out has already been cancelled
+            if not d.called:
+                d.callback(list(result))
 
     @defer.inlineCallbacks
     def find_peers_for_blob(self, blob_hash, timeout=None):
@@ -44,7 +111,7 @@ class DHTPeerFinder(object):
                 finished_deferred.cancel()
 
         bin_hash = binascii.unhexlify(blob_hash)
-        finished_deferred = self.dht_node.getPeersForBlob(bin_hash)
+        finished_deferred = self._get_peer_addresses(bin_hash)
 
         if timeout is not None:
             reactor.callLater(timeout, _trigger_timeout)
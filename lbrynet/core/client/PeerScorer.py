@@ -0,0 +1,62 @@
+import logging
+import random
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class PeerScorer(object):
+    """Ranks peers by the rate blobs can be expected to download from them at
+
+    A peer's expected rate is the rate its blobs were last measured at. As the
+    measurement ages it drifts back toward the average of the measured peers, which
+    is also the rate expected from peers which haven't been measured, so a peer which
+    was slow a while ago gets another chance. The rate is scaled down by the share of
+    downloads from the peer which failed, by its failed connections and by price
+    disagreements.
+    """
+    # the age, in seconds, at which a measured rate counts as much as the average
+    RATE_HALF_LIFE = 600.0
+    # the rate expected when no peer has been measured, in bytes per second
+    DEFAULT_RATE = float(2**20)
+
+    def average_rate(self, peers):
+        rates = [peer.download_rate for peer in peers if peer.download_rate is not None]
+        if not rates:
+            return self.DEFAULT_RATE
+        return sum(rates) / len(rates)
+
+    def expected_rate(self, peer, average_rate):
+        if peer.download_rate is None:
+            return average_rate
+        age = max(time.time() - peer.download_rate_measured_at, 0)
+        weight = 0.5 ** (age / self.RATE_HALF_LIFE)
+        return average_rate + (peer.download_rate - average_rate) * weight
+
+    def reliability(self, peer):
+        """The estimated chance a download from the peer succeeds, from 0 to 1"""
+        downloaded = peer.stats['blobs_downloaded']
+        failed = peer.stats['blob_downloads_failed'] + peer.down_count
+        disagreements = peer.stats['price_disagreements']
+        return (downloaded + 1.0) / (downloaded + failed + 1.0) / (disagreements + 1.0)
+
+    def score(self, peer, average_rate):
+        return self.expected_rate(peer, average_rate) * self.reliability(peer)
+
+    def pick(self, peers, epsilon):
+        """Pick the peer with the best score, or a random one with probability epsilon
+
+        @param peers: the peers to choose from
+        @param epsilon: the probability of picking a random peer instead of the best
+            one, which keeps trying peers that are new or were unlucky before
+        @return: the chosen peer, or None if there are no peers
+        """
+        if not peers:
+            return None
+        if random.random() < epsilon:
+            peer = random.choice(peers)
+            log.debug("Trying %s at random", peer)
+            return peer
+        average_rate = self.average_rate(peers)
+        return max(peers, key=lambda peer: self.score(peer, average_rate))
@@ -1,9 +1,11 @@
 import logging
+import mmap
 
 from twisted.internet import defer
 from twisted.protocols.basic import FileSender
 from twisted.python.failure import Failure
 from zope.interface import implements
+from twisted.internet import interfaces
 
 
 from lbrynet.core.Offer import Offer
@@ -14,6 +16,69 @@ from lbrynet.interfaces import IQueryHandlerFactory, IQueryHandler, IBlobSender
 log = logging.getLogger(__name__)
 
 
+class MappedFileSender(object):
+    """A producer which memory maps a file and writes it to a consumer in large chunks
+
+    Compared to FileSender this skips the per chunk read calls, and a 2MB blob is
+    written in two pieces rather than 128. It should only be used when the consumer
+    can take the data at once, for instance when uploads are not rate limited.
+    """
+    implements(interfaces.IProducer)
+
+    CHUNK_SIZE = 2**20
+
+    lastSent = ''
+    deferred = None
+    consumer = None
+    mapped = None
+
+    def beginFileTransfer(self, file, consumer, transform=None):
+        """
+        @param file: a file object which has a fileno() and is not empty
+        @return: a deferred which fires with the last byte sent when the transfer
+            is complete, like FileSender.beginFileTransfer
+        """
+        self.mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.position = 0
+        self.consumer = consumer
+        self.transform = transform
+        self.deferred = deferred = defer.Deferred()
+        self.consumer.registerProducer(self, False)
+        return deferred
+
+    def resumeProducing(self):
+        if not self.consumer:
+            return
+        chunk = self.mapped[self.position:self.position + self.CHUNK_SIZE]
+        self.position += len(chunk)
+        if not chunk:
+            self.consumer.unregisterProducer()
+            self._finish()
+            if self.deferred:
+                self.deferred.callback(self.lastSent)
+                self.deferred = None
+            return
+        if self.transform:
+            chunk = self.transform(chunk)
+        self.consumer.write(chunk)
+        self.lastSent = chunk[-1:]
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        self._finish()
+        if self.deferred:
+            self.deferred.errback(Exception("Consumer asked us to stop producing"))
+            self.deferred = None
+
+    def _finish(self):
+        self.consumer = None
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
 class BlobRequestHandlerFactory(object):
     implements(IQueryHandlerFactory)
 
@@ -54,6 +119,8 @@ class BlobRequestHandler(object):
         self.read_handle = None
         self.currently_uploading = None
         self.file_sender = None
+        # blobs the client cancelled after sending the request being handled
+        self._cancelled_blobs = set()
         self.blob_bytes_uploaded = 0
         self._blobs_requested = []
 
@@ -85,16 +152,13 @@ class BlobRequestHandler(object):
     ######### IBlobSender #########
 
     def send_blob_if_requested(self, consumer):
+        self._cancelled_blobs.clear()
         if self.currently_uploading is not None:
             return self.send_file(consumer)
         return defer.succeed(True)
 
-    def cancel_send(self, err):
-        if self.currently_uploading is not None:
-            self.currently_uploading.close_read_handle(self.read_handle)
-        self.read_handle = None
-        self.currently_uploading = None
-        return err
+    def cancel_send(self, blob_hash):
+        self._cancelled_blobs.add(blob_hash)
 
     ######### internal #########
 
@@ -171,7 +235,11 @@ class BlobRequestHandler(object):
         response_fields = {}
         response['incoming_blob'] = response_fields
 
-        if self.blob_data_payment_rate is None:
+        if incoming in self._cancelled_blobs:
+            log.info("%s cancelled its request for %s", self.peer, incoming)
+            response['incoming_blob'] = {'error': 'BLOB_CANCELLED'}
+            return defer.succeed(response)
+        elif self.blob_data_payment_rate is None:
             log.debug("Rate not set yet")
             response['incoming_blob'] = {'error': 'RATE_UNSET'}
             return defer.succeed(response)
@@ -203,7 +271,10 @@ class BlobRequestHandler(object):
             return data
 
         def start_transfer():
-            self.file_sender = FileSender()
+            if self._can_send_mapped(consumer):
+                self.file_sender = MappedFileSender()
+            else:
+                self.file_sender = FileSender()
             log.debug("Starting the file upload")
             assert self.read_handle is not None, \
                 "self.read_handle was None when trying to start the transfer"
@@ -231,3 +302,16 @@ class BlobRequestHandler(object):
                 log.warning("Upload has failed. Reason: %s", reason.getErrorMessage())
 
         return _send_file()
+
+    def _can_send_mapped(self, consumer):
+        can_write_directly = getattr(consumer, 'can_write_directly', None)
+        if can_write_directly is None or not can_write_directly():
+            return False
+        if not self.currently_uploading.length:
+            # empty files can't be memory mapped
+            return False
+        try:
+            self.read_handle.fileno()
+        except (AttributeError, IOError):
+            return False
+        return True
@@ -5,6 +5,7 @@ import time
 
 from twisted.internet import defer
 from lbrynet.core import utils
+from lbrynet.dht import constants
 
 log = logging.getLogger(__name__)
 
@@ -12,15 +13,41 @@ log = logging.getLogger(__name__)
 class DHTHashAnnouncer(object):
     ANNOUNCE_CHECK_INTERVAL = 60
     CONCURRENT_ANNOUNCERS = 5
+    # maximum number of hashes taken from the queue and announced with one call to the node,
+    # neighbouring hashes in a group share node lookups
+    ANNOUNCE_GROUP_SIZE = 100
+    # conservative assumption of the time it takes to announce a single hash,
+    # until the time it takes to announce a group of hashes has been measured
+    SINGLE_HASH_ANNOUNCE_DURATION = 1
+    # weight of each newly measured group in the measured time per hash
+    ANNOUNCE_DURATION_SMOOTHING = 0.2
+    # suppliers hand out the hashes which are due in batches, another batch is fetched
+    # from a supplier which may have more once fewer hashes than this are queued
+    ANNOUNCE_QUEUE_REFILL_SIZE = 500
 
     """This class announces to the DHT that this peer has certain blobs"""
-    def __init__(self, dht_node, peer_port):
+    def __init__(self, dht_node, peer_port, announce_rate=0):
+        """
+        @param announce_rate: the maximum number of hashes to announce per second,
+            or 0 to announce them as fast as the concurrent announcers can
+        """
         self.dht_node = dht_node
         self.peer_port = peer_port
+        self.announce_rate = announce_rate
         self.suppliers = []
         self.next_manage_call = None
         self.hash_queue = collections.deque()
         self._concurrent_announcers = 0
+        # the earliest time the next group of hashes may be announced within the announce rate
+        self._next_announce_time = 0
+        # suppliers whose last batch wasn't empty, so they may have more hashes due
+        self._suppliers_with_more = set()
+        self._refill_call = None
+        # smoothed seconds each announced hash has added to the time it takes to empty
+        # the queue, or None until a group has been announced
+        self._measured_hash_duration = None
+        # whether the queue has been reported as too long since the last announce cycle
+        self._expiry_warned = False
 
     def run_manage_loop(self):
         if self.peer_port is not None:
@@ -32,6 +59,9 @@ class DHTHashAnnouncer(object):
         if self.next_manage_call is not None:
             self.next_manage_call.cancel()
             self.next_manage_call = None
+        if self._refill_call is not None:
+            self._refill_call.cancel()
+            self._refill_call = None
 
     def add_supplier(self, supplier):
         self.suppliers.append(supplier)
@@ -45,16 +75,54 @@ class DHTHashAnnouncer(object):
     def hash_queue_size(self):
         return len(self.hash_queue)
 
+    def hash_announce_duration(self):
+        """Returns the expected number of seconds announcing a hash adds to the queue"""
+        if self.announce_rate:
+            # hashes aren't announced faster than the rate, but may be announced slower
+            return max(1.0 / self.announce_rate, self._measured_hash_duration or 0)
+        if self._measured_hash_duration is None:
+            return self.SINGLE_HASH_ANNOUNCE_DURATION
+        return self._measured_hash_duration
+
+    def _record_group_duration(self, seconds, num_hashes):
+        # the groups are announced by CONCURRENT_ANNOUNCERS announcers in parallel
+        duration = float(seconds) / num_hashes / self.CONCURRENT_ANNOUNCERS
+        if self._measured_hash_duration is None:
+            self._measured_hash_duration = duration
+        else:
+            self._measured_hash_duration += (
+                self.ANNOUNCE_DURATION_SMOOTHING * (duration - self._measured_hash_duration))
+
     def _announce_available_hashes(self):
         log.debug('Announcing available hashes')
+        self._expiry_warned = False
         ds = []
         for supplier in self.suppliers:
-            d = supplier.hashes_to_announce()
-            d.addCallback(self._announce_hashes)
+            d = self._announce_supplier_hashes(supplier)
             ds.append(d)
         dl = defer.DeferredList(ds)
         return dl
 
+    def _announce_supplier_hashes(self, supplier):
+        def announce(hashes):
+            if hashes:
+                self._suppliers_with_more.add(supplier)
+            else:
+                self._suppliers_with_more.discard(supplier)
+            return self._announce_hashes(hashes)
+
+        d = defer.maybeDeferred(supplier.hashes_to_announce)
+        d.addCallback(announce)
+        return d
+
+    def _refill_hash_queue(self):
+        self._refill_call = None
+        if self.hash_queue_size() >= self.ANNOUNCE_QUEUE_REFILL_SIZE:
+            return
+        suppliers, self._suppliers_with_more = self._suppliers_with_more, set()
+        for supplier in suppliers:
+            self._announce_supplier_hashes(supplier)
+
     def _announce_hashes(self, hashes, immediate=False):
         if not hashes:
             return
@@ -63,22 +131,58 @@ class DHTHashAnnouncer(object):
         start = time.time()
         ds = []
 
-        for h in hashes:
+        # hashes next to each other in the queue are close in the keyspace, so they
+        # can be announced to the same nodes
+        queued = []
+        for h in sorted(hashes):
             announce_deferred = defer.Deferred()
             ds.append(announce_deferred)
-            if immediate:
-                self.hash_queue.appendleft((h, announce_deferred))
-            else:
-                self.hash_queue.append((h, announce_deferred))
+            queued.append((h, announce_deferred))
+        if immediate:
+            self.hash_queue.extendleft(reversed(queued))
+        else:
+            self.hash_queue.extend(queued)
         log.debug('There are now %s hashes remaining to be announced', self.hash_queue_size())
+        if (not self._expiry_warned and
+                self.hash_queue_size() * self.hash_announce_duration() >
+                constants.dataExpireTimeout):
+            # once per announce cycle, rather than for every batch of hashes
+            self._expiry_warned = True
+            log.warning('%s hashes are waiting to be announced, they will expire from the dht '
+                        'before they are reannounced at the current announce rate',
+                        self.hash_queue_size())
+
+        def announce_group(group):
+            log.debug('Announcing %s blobs to dht', len(group))
+            group_start = time.time()
+            d = self.dht_node.announceHaveBlobs(
+                [binascii.unhexlify(h) for h, _ in group], self.peer_port)
+            d.addCallbacks(lambda stored: finish_group(group, stored, group_start),
+                           lambda err: fail_group(group, err))
+            d.addBoth(lambda _: utils.call_later(0, announce))
+
+        def finish_group(group, stored, group_start):
+            self._record_group_duration(time.time() - group_start, len(group))
+            for h, announce_deferred in group:
+                announce_deferred.callback(stored.get(binascii.unhexlify(h), 0))
+
+        def fail_group(group, err):
+            for h, announce_deferred in group:
+                announce_deferred.errback(err)
 
         def announce():
             if len(self.hash_queue):
-                h, announce_deferred = self.hash_queue.popleft()
-                log.debug('Announcing blob %s to dht', h)
-                d = self.dht_node.announceHaveBlob(binascii.unhexlify(h), self.peer_port)
-                d.chainDeferred(announce_deferred)
-                d.addBoth(lambda _: utils.call_later(0, announce))
+                group = []
+                while self.hash_queue and len(group) < self.ANNOUNCE_GROUP_SIZE:
+                    group.append(self.hash_queue.popleft())
+                if (self._suppliers_with_more and self._refill_call is None and
+                        self.hash_queue_size() < self.ANNOUNCE_QUEUE_REFILL_SIZE):
+                    self._refill_call = utils.call_later(0, self._refill_hash_queue)
+                delay = self._reserve_announce_time(len(group))
+                if delay:
+                    utils.call_later(delay, announce_group, group)
+                else:
+                    announce_group(group)
             else:
                 self._concurrent_announcers -= 1
 
@@ -90,13 +194,19 @@ class DHTHashAnnouncer(object):
                                           time.time() - start, len(hashes)))
         return d
 
+    def _reserve_announce_time(self, num_hashes):
+        """Returns how long to wait before announcing num_hashes within the announce rate"""
+        if not self.announce_rate:
+            return 0
+        now = time.time()
+        start = max(now, self._next_announce_time)
+        self._next_announce_time = start + float(num_hashes) / self.announce_rate
+        return start - now
+
 
 class DHTHashSupplier(object):
     # 1 hour is the min time hash will be reannounced
     MIN_HASH_REANNOUNCE_TIME = 60*60
-    # conservative assumption of the time it takes to announce
-    # a single hash
-    SINGLE_HASH_ANNOUNCE_DURATION = 1
 
     """Classes derived from this class give hashes to a hash announcer"""
     def __init__(self, announcer):
@@ -123,7 +233,7 @@ class DHTHashSupplier(object):
         """
         queue_size = self.hash_announcer.hash_queue_size()+num_hashes_to_announce
         reannounce = max(self.MIN_HASH_REANNOUNCE_TIME,
-                            queue_size*self.SINGLE_HASH_ANNOUNCE_DURATION)
+                            queue_size*self.hash_announcer.hash_announce_duration())
         return time.time() + reannounce
 
 
@@ -77,6 +77,9 @@ class ServerProtocol(Protocol):
         if self.request_handler is not None:
             self.request_handler.resumeProducing()
 
+    def is_upload_limited(self):
+        return self.factory.rate_limiter.is_ul_limited()
+
     def throttle_download(self):
         self.transport.pauseProducing()
 
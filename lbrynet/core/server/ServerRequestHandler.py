@@ -1,7 +1,11 @@
+import collections
 import json
 import logging
 from twisted.internet import interfaces, defer
 from zope.interface import implements
+from lbrynet import conf
+from lbrynet.core.Error import InvalidMessageError
+from lbrynet.core.JSONFramer import JSONFramer
 from lbrynet.interfaces import IRequestHandler
 
 
@@ -15,13 +19,34 @@ class ServerRequestHandler(object):
     """
     implements(interfaces.IPushProducer, interfaces.IConsumer, IRequestHandler)
 
+    # a client which sends this query with its request may send its next request before the
+    # response to the current one, including any blob, has been received
+    PIPELINING_QUERY = 'pipelining'
+    # the most requests a client may send ahead of the one being handled
+    MAX_QUEUED_REQUESTS = 8
+    # a client which sends this query with its request may cancel a blob it requested with a
+    # CANCEL_QUERY, instead of closing the connection
+    CANCELLING_QUERY = 'blob_cancelling'
+    # {'cancel_blob': {'blob_hash': <blob hash>}} is answered with
+    # {'cancelled_blob': <blob hash>} once the requests received before it have been answered
+    CANCEL_QUERY = 'cancel_blob'
+    CANCELLED_RESPONSE = 'cancelled_blob'
+
     def __init__(self, consumer):
         self.consumer = consumer
         self.production_paused = False
-        self.request_buff = ''
-        self.response_buff = ''
+        self.request_framer = JSONFramer(conf.settings['MAX_REQUEST_SIZE'])
+        # data waiting to be written to the consumer, and how much of the first piece
+        # has been written already
+        self._response_chunks = collections.deque()
+        self._response_offset = 0
+        self._produce_call = None
         self.producer = None
         self.request_received = False
+        # requests are handled one at a time, in the order they were received. Each one is
+        # queued with the blobs the client cancelled after sending it, and each cancel with None
+        self._request_queue = collections.deque()
+        self._handling_request = False
         self.CHUNK_SIZE = 2**14
         self.query_handlers = {}  # {IQueryHandler: [query_identifiers]}
         self.blob_sender = None
@@ -37,6 +62,12 @@ class ServerRequestHandler(object):
             self.producer.stopProducing()
             self.producer = None
         self.production_paused = True
+        if self._produce_call is not None and self._produce_call.active():
+            self._produce_call.cancel()
+        self._produce_call = None
+        self._response_chunks.clear()
+        self._response_offset = 0
+        self._request_queue.clear()
         self.consumer.unregisterProducer()
 
     def resumeProducing(self):
@@ -45,22 +76,56 @@ class ServerRequestHandler(object):
 
         self.production_paused = False
         self._produce_more()
-        if self.producer is not None:
-            reactor.callLater(0, self.producer.resumeProducing)
+        reactor.callLater(0, self._request_more_data)
 
     def _produce_more(self):
+        """Write the queued data to the consumer until it has all been written or
+        production is paused
+
+        Each piece of queued data is written as it is, unless uploads are limited. Then
+        it is written CHUNK_SIZE bytes per reactor turn, which gives the rate limiter a
+        chance to pause production in between.
+        """
 
         from twisted.internet import reactor
 
-        if self.production_paused:
-            return
-        chunk = self.response_buff[:self.CHUNK_SIZE]
-        self.response_buff = self.response_buff[self.CHUNK_SIZE:]
-        if chunk == '':
-            return
-        log.trace("writing %s bytes to the client", len(chunk))
-        self.consumer.write(chunk)
-        reactor.callLater(0, self._produce_more)
+        limited = self.consumer.is_upload_limited()
+        while self._response_chunks and not self.production_paused:
+            data = self._response_chunks[0]
+            if limited:
+                chunk = data[self._response_offset:self._response_offset + self.CHUNK_SIZE]
+            else:
+                chunk = data[self._response_offset:]
+            self._response_offset += len(chunk)
+            if self._response_offset >= len(data):
+                self._response_chunks.popleft()
+                self._response_offset = 0
+            log.trace("writing %s bytes to the client", len(chunk))
+            self.consumer.write(chunk)
+            if limited:
+                break
+        if (self._response_chunks and not self.production_paused and
+                self._produce_call is None):
+            self._produce_call = reactor.callLater(0, self._produce_queued)
+
+    def _produce_queued(self):
+        self._produce_call = None
+        self._produce_more()
+        if not self._response_chunks:
+            self._request_more_data()
+
+    def _request_more_data(self):
+        # the producer is only asked for more once the queued data has been written, so
+        # a paused or rate limited upload doesn't read the whole blob into memory
+        if self.producer is not None and not self.production_paused and \
+                not self._response_chunks:
+            log.trace("Requesting more data from the producer")
+            self.producer.resumeProducing()
+
+    def _queue_response(self, data):
+        if data:
+            self._response_chunks.append(data)
+            self._produce_more()
 
     #IConsumer stuff
 
@@ -72,19 +137,26 @@ class ServerRequestHandler(object):
     def unregisterProducer(self):
         self.producer = None
 
-    def write(self, data):
+    def can_write_directly(self):
+        """Whether written data can skip the response buffer and go straight to the consumer
 
-        from twisted.internet import reactor
+        This is only the case when nothing is waiting in the buffer and uploads are not
+        being paused or rate limited, since the data is then written in one piece
+        """
+        return (not self.production_paused and not self._response_chunks and
+                not self.consumer.is_upload_limited())
 
-        self.response_buff = self.response_buff + data
-        self._produce_more()
+    def write(self, data):
 
-        def get_more_data():
-            if self.producer is not None:
-                log.trace("Requesting more data from the producer")
-                self.producer.resumeProducing()
+        from twisted.internet import reactor
 
-        reactor.callLater(0, get_more_data)
+        if self.can_write_directly():
+            log.trace("writing %s bytes directly to the client", len(data))
+            self.consumer.write(data)
+        else:
+            self._queue_response(data)
+        if not self._response_chunks:
+            reactor.callLater(0, self._request_more_data)
 
     #From Protocol
 
@@ -98,16 +170,69 @@ class ServerRequestHandler(object):
                 "The client sent data when we were uploading a file. This should not happen")
 
     def _parse_data_and_maybe_send_blob(self, data):
-        self.request_buff = self.request_buff + data
-        msg = self.try_to_parse_request(self.request_buff)
-        if msg:
-            self.request_buff = ''
-            self._process_msg(msg)
-        else:
-            log.debug("Request buff not a valid json message")
-            log.debug("Request buff: %s", self.request_buff)
+        self.request_framer.feed(data)
+        while True:
+            try:
+                msg = self.request_framer.next_message()
+            except InvalidMessageError as err:
+                log.warning("Bad request from the client: %s", err)
+                self.stopProducing()
+                return
+            if msg is None:
+                break
+            if self.CANCEL_QUERY in msg:
+                if not self._cancel_blob(msg):
+                    self.stopProducing()
+                    return
+                continue
+            if len(self._request_queue) >= self.MAX_QUEUED_REQUESTS:
+                log.warning("The client sent more than %i requests ahead",
+                            self.MAX_QUEUED_REQUESTS)
+                self.stopProducing()
+                return
+            self._request_queue.append((msg, set()))
+        if len(self.request_framer):
+            log.debug("Request buff not a complete json message, %i bytes so far",
+                      len(self.request_framer))
+        self._process_next_msg()
+
+    def _process_next_msg(self):
+        while not self._handling_request and self._request_queue:
+            msg, cancelled_blobs = self._request_queue.popleft()
+            if cancelled_blobs is None:
+                # the requests received before the cancel have been answered
+                self.send_response({self.CANCELLED_RESPONSE: msg[self.CANCEL_QUERY]['blob_hash']})
+                continue
+            self._handling_request = True
+            self._process_msg(msg, cancelled_blobs)
+
+    def _cancel_blob(self, msg):
+        """Don't send the blob named in a cancel request in answer to the requests which
+        were received before it and haven't been handled yet
+
+        A blob which is being sent, or whose response has been sent, is sent in full,
+        so that the client can skip it by its length.
+
+        @return: False if the cancel request is invalid
+        """
+        cancel = msg[self.CANCEL_QUERY]
+        if not isinstance(cancel, dict) or not isinstance(cancel.get('blob_hash'), basestring):
+            log.warning("Bad cancel request from the client: %s", str(msg)[:100])
+            return False
+        for _, cancelled_blobs in self._request_queue:
+            if cancelled_blobs is not None:
+                cancelled_blobs.add(cancel['blob_hash'])
+        if len(self._request_queue) >= self.MAX_QUEUED_REQUESTS:
+            log.warning("The client sent more than %i requests ahead", self.MAX_QUEUED_REQUESTS)
+            return False
+        self._request_queue.append((msg, None))
+        self._process_next_msg()
+        return True
 
-    def _process_msg(self, msg):
+    def _process_msg(self, msg, cancelled_blobs):
+        if self.blob_sender:
+            for blob_hash in cancelled_blobs:
+                self.blob_sender.cancel_send(blob_hash)
         d = self.handle_request(msg)
         if self.blob_sender:
             d.addCallback(lambda _: self.blob_sender.send_blob_if_requested(self))
@@ -131,14 +256,15 @@ class ServerRequestHandler(object):
 
     def finished_response(self):
         self.request_received = False
+        self._handling_request = False
         self._produce_more()
+        self._process_next_msg()
 
     def send_response(self, msg):
         m = json.dumps(msg)
         log.debug("Sending a response of length %s", str(len(m)))
         log.debug("Response: %s", str(m))
-        self.response_buff = self.response_buff + m
-        self._produce_more()
+        self._queue_response(m)
         return True
 
     def handle_request(self, msg):
@@ -147,6 +273,10 @@ class ServerRequestHandler(object):
 
         def create_response_message(results):
             response = {}
+            if msg.get(self.PIPELINING_QUERY) is True:
+                response[self.PIPELINING_QUERY] = True
+            if msg.get(self.CANCELLING_QUERY) is True:
+                response[self.CANCELLING_QUERY] = True
             for success, result in results:
                 if success is True:
                     response.update(result)
@@ -177,10 +307,3 @@ class ServerRequestHandler(object):
         dl.addCallback(create_response_message)
         dl.addCallback(send_response)
         return dl
-
-    def try_to_parse_request(self, request_buff):
-        try:
-            msg = json.loads(request_buff)
-            return msg
-        except ValueError:
-            return None
@@ -8,21 +8,85 @@ from lbrynet.core.BlobInfo import BlobInfo
 log = logging.getLogger(__name__)
 
 
+def _cipher_accepts_buffers():
+    # PyCrypto takes any read only buffer, but pycryptodome, which is often installed in
+    # its place, raises a TypeError for anything but strings, bytearrays and memoryviews
+    try:
+        AES.new('\x00' * 16, AES.MODE_CBC, '\x00' * 16).encrypt(buffer('\x00' * 16))
+    except TypeError:
+        return False
+    return True
+
+
+CIPHER_ACCEPTS_BUFFERS = _cipher_accepts_buffers()
+
+
 class CryptBlobInfo(BlobInfo):
     def __init__(self, blob_hash, blob_num, length, iv):
         BlobInfo.__init__(self, blob_hash, blob_num, length)
         self.iv = iv
 
 
+class BlockBuffer(object):
+    """Passes written data on to process_func in whole cipher blocks
+
+    The block aligned part of each write is passed on as a read only buffer into
+    the written string rather than a copy of it, if the cipher takes buffers. Only
+    the bytes that don't make up a whole block are kept until the next write.
+    """
+    def __init__(self, block_size, process_func, hold_last_block=False):
+        """
+        @param hold_last_block: if True, the last block written is always kept back,
+            for instance because it holds the padding and has to be handled by the
+            caller once all of the data has been written
+        """
+        self.block_size = block_size
+        self.process_func = process_func
+        self.hold_last_block = hold_last_block
+        self.buff = bytearray()
+
+    def __len__(self):
+        return len(self.buff)
+
+    def write(self, data):
+        held = len(self.buff)
+        available = held + len(data)
+        if self.hold_last_block:
+            available -= 1
+        num_bytes = greatest_multiple(available, self.block_size)
+        if num_bytes <= 0:
+            self.buff += data
+            return
+        offset = 0
+        if held:
+            # complete the block left over from the previous write
+            offset = self.block_size - held
+            self.buff += data[:offset]
+            self.process_func(str(self.buff))
+            self.buff = bytearray()
+            num_bytes -= self.block_size
+        if num_bytes:
+            if CIPHER_ACCEPTS_BUFFERS:
+                self.process_func(buffer(data, offset, num_bytes))
+            else:
+                self.process_func(data[offset:offset + num_bytes])
+        self.buff += data[offset + num_bytes:]
+
+    def flush(self):
+        """Return and forget the bytes which haven't been passed on"""
+        data, self.buff = str(self.buff), bytearray()
+        return data
+
+
 class StreamBlobDecryptor(object):
     def __init__(self, blob, key, iv, length):
         self.blob = blob
         self.key = key
         self.iv = iv
         self.length = length
-        self.buff = b''
         self.len_read = 0
         self.cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
+        self.buff = None
 
     def decrypt(self, write_func):
 
@@ -33,22 +97,20 @@ class StreamBlobDecryptor(object):
                 assert ord(c) == pad_len
             return data
 
-        def write_bytes():
-            if self.len_read < self.length:
-                num_bytes_to_decrypt = greatest_multiple(len(self.buff), self.cipher.block_size)
-                data_to_decrypt, self.buff = split(self.buff, num_bytes_to_decrypt)
-                write_func(self.cipher.decrypt(data_to_decrypt))
+        def write_bytes(data_to_decrypt):
+            write_func(self.cipher.decrypt(data_to_decrypt))
 
         def finish_decrypt():
             assert len(self.buff) % self.cipher.block_size == 0
-            data_to_decrypt, self.buff = self.buff, b''
+            data_to_decrypt = self.buff.flush()
             write_func(remove_padding(self.cipher.decrypt(data_to_decrypt)))
 
         def decrypt_bytes(data):
-            self.buff += data
             self.len_read += len(data)
-            write_bytes()
+            self.buff.write(data)
 
+        # the last block holds the padding, so it is decrypted by finish_decrypt
+        self.buff = BlockBuffer(self.cipher.block_size, write_bytes, hold_last_block=True)
         d = self.blob.read(decrypt_bytes)
         d.addCallback(lambda _: finish_decrypt())
         return d
@@ -62,7 +124,7 @@ class CryptStreamBlobMaker(object):
         self.blob_num = blob_num
         self.blob = blob
         self.cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-        self.buff = b''
+        self.buff = BlockBuffer(AES.block_size, self._encrypt_blocks)
         self.length = 0
 
     def write(self, data):
@@ -74,9 +136,9 @@ class CryptStreamBlobMaker(object):
         else:
             num_bytes_to_write = len(data)
         self.length += num_bytes_to_write
-        data_to_write = data[:num_bytes_to_write]
-        self.buff += data_to_write
-        self._write_buffer()
+        if num_bytes_to_write < len(data):
+            data = buffer(data, 0, num_bytes_to_write)
+        self.buff.write(data)
         return done, num_bytes_to_write
 
     def close(self):
@@ -88,14 +150,12 @@ class CryptStreamBlobMaker(object):
         log.debug("called the finished_callback from CryptStreamBlobMaker.close")
         return d
 
-    def _write_buffer(self):
-        num_bytes_to_encrypt = (len(self.buff) // AES.block_size) * AES.block_size
-        data_to_encrypt, self.buff = split(self.buff, num_bytes_to_encrypt)
+    def _encrypt_blocks(self, data_to_encrypt):
         encrypted_data = self.cipher.encrypt(data_to_encrypt)
         self.blob.write(encrypted_data)
 
     def _close_buffer(self):
-        data_to_encrypt, self.buff = self.buff, b''
+        data_to_encrypt = self.buff.flush()
         assert len(data_to_encrypt) < AES.block_size
         pad_len = AES.block_size - len(data_to_encrypt)
         padded_data = data_to_encrypt + chr(pad_len) * pad_len
@@ -111,7 +171,3 @@ class CryptStreamBlobMaker(object):
 def greatest_multiple(a, b):
     """return the largest value `c`, that is a multiple of `b` and is <= `a`"""
     return (a // b) * b
-
-
-def split(buff, cutoff):
-    return buff[:cutoff], buff[cutoff:]
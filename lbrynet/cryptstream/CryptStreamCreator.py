@@ -7,7 +7,8 @@ import logging
 from Crypto import Random
 from Crypto.Cipher import AES
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from lbrynet import conf
 from lbrynet.core.StreamCreator import StreamCreator
 from lbrynet.cryptstream.CryptBlob import CryptStreamBlobMaker
 
@@ -22,6 +23,9 @@ class CryptStreamCreator(StreamCreator):
     own initialization vector which is associated with the blob when
     the blob is associated with the stream.
     """
+    # bytes encrypted at a time by write_file_in_threads
+    THREAD_WRITE_SIZE = 2**16
+
     def __init__(self, blob_manager, name=None, key=None, iv_generator=None):
         """@param blob_manager: Object that stores and provides access to blobs.
         @type blob_manager: BlobManager
@@ -80,17 +84,87 @@ class CryptStreamCreator(StreamCreator):
             d.addCallback(self._blob_finished)
             self.finished_deferreds.append(d)
 
-        while len(data) > 0:
+        offset = 0
+        while offset < len(data):
             if self.current_blob is None:
                 next_blob_creator = self.blob_manager.get_blob_creator()
                 self.blob_count += 1
                 iv = self.iv_generator.next()
                 self.current_blob = self._get_blob_maker(iv, next_blob_creator)
-            done, num_bytes_written = self.current_blob.write(data)
-            data = data[num_bytes_written:]
+            # pass a view of the rest of the data rather than a copy of it
+            remaining = buffer(data, offset) if offset else data
+            done, num_bytes_written = self.current_blob.write(remaining)
+            offset += num_bytes_written
             if done is True:
                 close_blob(self.current_blob)
                 self.current_blob = None
 
+    @defer.inlineCallbacks
+    def write_file_in_threads(self, file_handle, num_threads):
+        """Read a file in blob sized pieces and encrypt and hash them in threads
+
+        The blobs are numbered and given ivs in the order they are read, so the
+        stream is the same as if the file had been written to this creator by a
+        producer. Call stop() once the returned deferred has fired to finish the stream.
+
+        @param file_handle: the file-like object to read. It is only ever read from
+            one thread at a time
+        @param num_threads: the number of blobs to encrypt at once
+
+        @return: a deferred which fires when every blob read from the file has been
+            closed, or fails with the first error
+        """
+        blob_plaintext_size = conf.settings['BLOB_SIZE'] - 1
+        semaphore = defer.DeferredSemaphore(num_threads)
+        failures = []
+        blob_ds = []
+
+        def read_piece():
+            pieces = []
+            remaining = blob_plaintext_size
+            while remaining:
+                data = file_handle.read(remaining)
+                if not data:
+                    break
+                pieces.append(data)
+                remaining -= len(data)
+            return ''.join(pieces)
+
+        def encrypt_piece(blob, data):
+            # encrypt a slice at a time so that the reactor thread can take the GIL
+            # in between, the cipher holds it for as long as it runs
+            for offset in xrange(0, len(data), self.THREAD_WRITE_SIZE):
+                blob.write(buffer(data, offset, self.THREAD_WRITE_SIZE))
+
+        def release(result):
+            semaphore.release()
+            return result
+
+        def encrypt_blob(data):
+            self.blob_count += 1
+            iv = self.iv_generator.next()
+            blob = self._get_blob_maker(iv, self.blob_manager.get_blob_creator())
+            d = threads.deferToThread(encrypt_piece, blob, data)
+            # closing the blob can wait on the blob manager, so the next piece
+            # is read as soon as this one has been encrypted
+            d.addBoth(release)
+            d.addCallback(lambda _: blob.close())
+            d.addCallback(self._blob_finished)
+            d.addErrback(failures.append)
+            return d
+
+        while not failures:
+            yield semaphore.acquire()
+            data = yield threads.deferToThread(read_piece)
+            if not data:
+                semaphore.release()
+                break
+            d = encrypt_blob(data)
+            self.finished_deferreds.append(d)
+            blob_ds.append(d)
+        yield defer.DeferredList(blob_ds)
+        if failures:
+            failures[0].raiseException()
+
     def _get_blob_maker(self, iv, blob_creator):
         return CryptStreamBlobMaker(self.key, iv, self.blob_count, blob_creator)
@@ -0,0 +1,33 @@
+import sqlite3
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def do_migration(db_dir):
+    log.info("Doing the migration")
+    migrate_blobs_db(db_dir)
+    log.info("Migration succeeded")
+
+
+def migrate_blobs_db(db_dir):
+    blobs_db = os.path.join(db_dir, "blobs.db")
+    # skip migration on fresh installs
+    if not os.path.isfile(blobs_db):
+        return
+    db_file = sqlite3.connect(blobs_db)
+    file_cursor = db_file.cursor()
+
+    # the announce loop selects and updates blobs by next_announce_time, without an
+    # index each of those queries is a full table scan
+    file_cursor.execute("create index if not exists blobs_next_announce_time_idx "
+                        "on blobs (next_announce_time, blob_hash)")
+    db_file.commit()
+
+    # write ahead logging lets the announce queries run without blocking the other
+    # connections in the pool, the journal mode is stored in the database file
+    file_cursor.execute("pragma journal_mode=wal")
+    file_cursor.execute("analyze")
+    db_file.commit()
+    db_file.close()
@@ -24,9 +24,32 @@ k = 8
 #: Timeout for network operations (in seconds)
 rpcTimeout = 5
 
+#: Number of times a RPC is sent before giving up on the contact answering it
+rpcAttempts = 2
+#: The longest time to wait for the answer to one attempt of a RPC (in seconds); the
+#: timeout of each attempt is worked out from the contact's round trip times, and
+#: attempts to contacts with no round trip time yet wait this long
+rpcAttemptTimeout = float(rpcTimeout) / rpcAttempts
+#: The shortest time to wait for the answer to one attempt of a RPC (in seconds)
+rpcMinTimeout = 0.5
+#: Weights of each new round trip time in a contact's smoothed round trip time and
+#: round trip time variance
+rttSmoothing = 0.125
+rttVarianceSmoothing = 0.25
+
 # Delay between iterations of iterative node lookups (for loose parallelism)  (in seconds)
 iterativeLookupDelay = rpcTimeout / 2
 
+#: Disjoint path lookups stop counting a probe towards alpha once it has taken this many
+#: times the smoothed round trip time (but at least lookupMinSlowProbeDelay seconds, and
+#: at most iterativeLookupDelay)
+lookupSlowProbeFactor = 2
+lookupMinSlowProbeDelay = 0.1
+#: The maximum number of probes in flight on one path of a disjoint path lookup
+lookupMaxAlpha = 2 * alpha
+#: Weight of each new round trip time in the smoothed round trip time
+lookupRttSmoothing = 0.125
+
 #: If a k-bucket has not been used for this amount of time, refresh it (in seconds)
 refreshTimeout = 3600 # 1 hour
 #: The interval at which nodes replicate (republish/refresh) data they are holding
@@ -35,18 +58,44 @@ replicateInterval = refreshTimeout
 # will also republish the data at this time if it is still valid
 dataExpireTimeout = 86400 # 24 hours
 
+#: The maximum number of peers a node stores for a single blob
+maxPeersPerBlob = 1000
+#: The maximum number of peers a node stores for all blobs
+maxStoredPeers = 250000
+
 tokenSecretChangeInterval = 300 # 5 minutes
 
 peer_request_timeout = 10
 
 ######## IMPLEMENTATION-SPECIFIC CONSTANTS ###########
 
+#: Contacts in a saved routing table which weren't seen within this time are dropped
+#: when it is restored (in seconds); those seen within refreshTimeout are trusted and
+#: the rest are pinged
+snapshotContactMaxAge = 86400 # 24 hours
+
 #: The interval in which the node should check its whether any buckets need refreshing,
 #: or whether any data needs to be republished (in seconds)
 checkRefreshInterval = refreshTimeout/5
 
+#: The number of contacts the protocol keeps round trip times and failure counts for
+maxContactStats = 10000
+
+#: The most UDP packets sent per second, and the most sent at once after being idle
+maxPacketsPerSecond = 1000
+sendBurstSize = 20
+#: The most UDP packets waiting to be sent; messages which don't fit are dropped
+maxSendQueueSize = 20000
+
 #: Max size of a single UDP datagram, in bytes. If a message is larger than this, it will
 #: be spread accross several UDP packets.
 udpDatagramMaxSize = 8192 # 8 KB
 
+#: The largest message received over several UDP packets, the most memory used by all the
+#: messages being received (in bytes), and how long the packets of a message may take to
+#: arrive (in seconds)
+maxMultiPacketMessageSize = 512 * 1024
+maxReassemblyBufferSize = 4 * 1024 * 1024
+reassemblyTimeout = 2 * rpcTimeout
+
 key_bits = 384
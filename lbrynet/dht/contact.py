@@ -16,10 +16,15 @@ class Contact(object):
     """
     def __init__(self, id, ipAddress, udpPort, networkProtocol, firstComm=0):
         self.id = id
+        # the numeric value of the id, used to find the contact's k-bucket
+        # and its distance to keys without converting the id every time
+        self.id_int = long(id.encode('hex'), 16) if isinstance(id, str) else id
         self.address = ipAddress
         self.port = udpPort
         self._networkProtocol = networkProtocol
         self.commTime = firstComm
+        # the last time a message was received from the contact
+        self.lastSeen = 0
 
     def __eq__(self, other):
         if isinstance(other, Contact):
@@ -8,10 +8,18 @@
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
 import UserDict
+import collections
+import heapq
+import logging
+import sqlite3
+import threading
 import time
+from twisted.internet import threads
 import constants
 
 
+log = logging.getLogger(__name__)
+
 
 class DataStore(UserDict.DictMixin):
     """ Interface for classes implementing physical storage (for data
@@ -25,6 +33,9 @@ class DataStore(UserDict.DictMixin):
     def addPeerToBlob(self, key, value, lastPublished, originallyPublished, originalPublisherID):
         pass
 
+    def stop(self):
+        """ Called when the node is stopped """
+
 class DictDataStore(DataStore):
     """ A datastore using an in-memory Python dictionary """
     def __init__(self):
@@ -60,3 +71,251 @@ class DictDataStore(DataStore):
     def getPeersForBlob(self, key):
         if key in self._dict:
             return [val[0] for val in self._dict[key]]
+
+
+class PeerDataStore(DataStore):
+    """ An in-memory datastore which keeps a peer once per blob and bounds its size
+
+    A peer is identified by its compact address (which includes its lbryid)
+    along with the id of the node that published it; announcing it again
+    refreshes it rather than adding another copy. Peers are expired from a
+    heap ordered by expiry time, so removing them doesn't scan the store.
+
+    Once a blob has C{maxPeersPerBlob} peers, the peer that was announced
+    least recently is dropped to make room for a new one. Once the store holds
+    C{maxPeers} peers, the peer which would expire soonest is dropped.
+    """
+    def __init__(self, maxPeersPerBlob=constants.maxPeersPerBlob,
+                 maxPeers=constants.maxStoredPeers):
+        self.maxPeersPerBlob = maxPeersPerBlob
+        self.maxPeers = maxPeers
+        # { <key>: OrderedDict({ (<value>, <originalPublisherID>):
+        #     (<value>, <lastPublished>, <originallyPublished>, <originalPublisherID>) }) }
+        # each blob's peers are ordered from least to most recently announced
+        self._dict = {}
+        self._peerCount = 0
+        # (<expiry time>, <key>, <value>, <originalPublisherID>), an entry is stale
+        # if the peer has since been removed or announced again
+        self._expiryHeap = []
+
+    def keys(self):
+        """ Return a list of the keys in this data store """
+        return self._dict.keys()
+
+    def __getitem__(self, key):
+        if key not in self._dict:
+            raise KeyError(key)
+        return self.getPeersForBlob(key)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def peerCount(self):
+        """ Return the number of peers stored for all blobs """
+        return self._peerCount
+
+    def hasPeersForBlob(self, key):
+        return key in self._dict
+
+    def getPeersForBlob(self, key):
+        if key in self._dict:
+            return [peer[0] for peer in self._dict[key].itervalues()]
+
+    def addPeerToBlob(self, key, value, lastPublished, originallyPublished, originalPublisherID):
+        peerID = (value, originalPublisherID)
+        peer = (value, lastPublished, originallyPublished, originalPublisherID)
+        peers = self._dict.get(key)
+        if peers is None:
+            peers = self._dict[key] = collections.OrderedDict()
+        elif peerID in peers:
+            del peers[peerID]
+            self._peerCount -= 1
+        elif len(peers) >= self.maxPeersPerBlob:
+            oldestID = next(iter(peers))
+            self._removePeer(key, oldestID)
+        peers[peerID] = peer
+        self._peerCount += 1
+        heapq.heappush(self._expiryHeap, (self._expiryTime(peer), key, value, originalPublisherID))
+        self._peerStored(key, peer)
+        while self._peerCount > self.maxPeers:
+            self._popExpiringPeer()
+        if len(self._expiryHeap) > 2 * self._peerCount + 1024:
+            self._compactExpiryHeap()
+
+    def removeExpiredPeers(self):
+        now = int(time.time())
+        heap = self._expiryHeap
+        while heap and heap[0][0] < now:
+            self._popExpiringPeer()
+
+    @staticmethod
+    def _expiryTime(peer):
+        return peer[2] + constants.dataExpireTimeout
+
+    def _popExpiringPeer(self):
+        """ Remove the peer which expires soonest, discarding stale heap entries """
+        heap = self._expiryHeap
+        while heap:
+            expiryTime, key, value, originalPublisherID = heapq.heappop(heap)
+            peers = self._dict.get(key)
+            if peers is None:
+                continue
+            peer = peers.get((value, originalPublisherID))
+            if peer is not None and self._expiryTime(peer) == expiryTime:
+                self._removePeer(key, (value, originalPublisherID))
+                return
+
+    def _removePeer(self, key, peerID):
+        peers = self._dict[key]
+        del peers[peerID]
+        self._peerCount -= 1
+        if not peers:
+            del self._dict[key]
+        self._peerRemoved(key, peerID)
+
+    def _compactExpiryHeap(self):
+        self._expiryHeap = [
+            (self._expiryTime(peer), key, peer[0], peer[3])
+            for key, peers in self._dict.iteritems() for peer in peers.itervalues()
+        ]
+        heapq.heapify(self._expiryHeap)
+
+    def _peerStored(self, key, peer):
+        """ Called after a peer has been added or refreshed """
+
+    def _peerRemoved(self, key, peerID):
+        """ Called after a peer has been expired or evicted """
+
+
+class SQLitePeerDataStore(PeerDataStore):
+    """ A L{PeerDataStore} which also keeps its peers in a SQLite database
+
+    The unexpired peers in the database are loaded when the store is created,
+    so a restarted node keeps the announcements it was holding. Changes are
+    written in a single transaction, in a thread, once C{FLUSH_SIZE} are
+    waiting or C{FLUSH_INTERVAL} seconds after the last write, and when expired
+    peers are removed. Whatever hasn't been written when the store is stopped
+    is written before L{stop} returns.
+    """
+    FLUSH_SIZE = 500
+    FLUSH_INTERVAL = 30
+
+    def __init__(self, dbFile, maxPeersPerBlob=constants.maxPeersPerBlob,
+                 maxPeers=constants.maxStoredPeers):
+        PeerDataStore.__init__(self, maxPeersPerBlob, maxPeers)
+        # { (<key>, <value>, <originalPublisherID>): <peer tuple> or None if removed }
+        self._pending = {}
+        # the changes being written in a thread, or None
+        self._writing = None
+        self._flushAgain = False
+        self._lastFlush = time.time()
+        # the connection is used by the thread doing a flush and by stop(), one at a time
+        self._dbLock = threading.Lock()
+        self._db = sqlite3.connect(dbFile, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("pragma synchronous=normal")
+        self._db.execute("create table if not exists peers (" +
+                         "    blob_hash blob not null, " +
+                         "    value blob not null, " +
+                         "    publisher_id blob not null, " +
+                         "    last_published integer, " +
+                         "    originally_published integer, " +
+                         "    primary key (blob_hash, value, publisher_id))")
+        self._db.commit()
+        self._load()
+
+    def _load(self):
+        cutoff = int(time.time()) - constants.dataExpireTimeout
+        self._db.execute("delete from peers where originally_published < ?", (cutoff,))
+        self._db.commit()
+        rows = self._db.execute("select blob_hash, value, last_published, originally_published, " +
+                                "publisher_id from peers order by last_published")
+        for key, value, lastPublished, originallyPublished, originalPublisherID in rows:
+            PeerDataStore.addPeerToBlob(self, str(key), str(value), lastPublished,
+                                        originallyPublished, str(originalPublisherID))
+        # loading the peers doesn't need to write them again, but anything evicted
+        # while loading (if the limits were lowered) does need deleting
+        for pendingID in self._pending.keys():
+            if self._pending[pendingID] is not None:
+                del self._pending[pendingID]
+        self.flush()
+        log.info("Loaded %i stored peers for %i blobs", self.peerCount(), len(self))
+
+    def addPeerToBlob(self, key, value, lastPublished, originallyPublished, originalPublisherID):
+        PeerDataStore.addPeerToBlob(self, key, value, lastPublished, originallyPublished,
+                                    originalPublisherID)
+        if (len(self._pending) >= self.FLUSH_SIZE or
+                time.time() - self._lastFlush >= self.FLUSH_INTERVAL):
+            self.flush()
+
+    def removeExpiredPeers(self):
+        PeerDataStore.removeExpiredPeers(self)
+        self.flush()
+
+    def stop(self):
+        """ Write the waiting changes, and any being written in a thread, and close
+        the database """
+        with self._dbLock:
+            changes = dict(self._writing or {})
+            changes.update(self._pending)
+            self._pending = {}
+            self._writeChanges(changes)
+            self._db.close()
+            self._db = None
+
+    def flush(self):
+        """ Write the waiting changes to the database in a thread
+
+        Only one write runs at a time so that changes reach the database in
+        order, a flush while one is running starts once it has finished.
+        """
+        self._lastFlush = time.time()
+        if self._writing is not None:
+            self._flushAgain = True
+            return
+        if not self._pending:
+            return
+        self._writing, self._pending = self._pending, {}
+        d = threads.deferToThread(self._write, self._writing)
+        d.addCallbacks(self._flushed, self._flushFailed)
+
+    def _flushed(self, _):
+        self._writing = None
+        if self._flushAgain:
+            self._flushAgain = False
+            self.flush()
+
+    def _flushFailed(self, err):
+        log.error("Failed to write stored peers: %s", err.getErrorMessage())
+        # keep the changes which haven't been superseded since, for the next flush
+        for pendingID, peer in self._writing.iteritems():
+            self._pending.setdefault(pendingID, peer)
+        self._flushed(None)
+
+    def _write(self, changes):
+        with self._dbLock:
+            # once stopped, the changes have been written by stop()
+            if self._db is not None:
+                self._writeChanges(changes)
+
+    def _writeChanges(self, changes):
+        if not changes:
+            return
+        stored = []
+        removed = []
+        for (key, value, originalPublisherID), peer in changes.iteritems():
+            if peer is None:
+                removed.append((buffer(key), buffer(value), buffer(originalPublisherID)))
+            else:
+                stored.append((buffer(key), buffer(value), buffer(originalPublisherID),
+                               peer[1], peer[2]))
+        with self._db:
+            self._db.executemany("delete from peers where blob_hash = ? and value = ? " +
+                                 "and publisher_id = ?", removed)
+            self._db.executemany("insert or replace into peers values (?, ?, ?, ?, ?)", stored)
+
+    def _peerStored(self, key, peer):
+        self._pending[(key, peer[0], peer[3])] = peer
+
+    def _peerRemoved(self, key, peerID):
+        self._pending[(key,) + peerID] = None
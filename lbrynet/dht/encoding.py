@@ -58,33 +58,9 @@ class Bencode(Encoding):
         @return: The encoded data
         @rtype: str
         """
-        if type(data) in (int, long):
-            return 'i%de' % data
-        elif type(data) == str:
-            return '%d:%s' % (len(data), data)
-        elif type(data) in (list, tuple):
-            encodedListItems = ''
-            for item in data:
-                encodedListItems += self.encode(item)
-            return 'l%se' % encodedListItems
-        elif type(data) == dict:
-            encodedDictItems = ''
-            keys = data.keys()
-            keys.sort()
-            for key in keys:
-                encodedDictItems += self.encode(key)
-                encodedDictItems += self.encode(data[key])
-            return 'd%se' % encodedDictItems
-        elif type(data) == float:
-            # This (float data type) is a non-standard extension to the original Bencode algorithm
-            return 'f%fe' % data
-        elif data == None:
-            # This (None/NULL data type) is a non-standard extension
-            # to the original Bencode algorithm
-            return 'n'
-        else:
-            print data
-            raise TypeError, "Cannot bencode '%s' object" % type(data)
+        encodedParts = []
+        _encodeItem(data, encodedParts)
+        return ''.join(encodedParts)
 
     def decode(self, data):
         """ Decoder implementation of the Bencode algorithm
@@ -111,39 +87,125 @@ class Bencode(Encoding):
 
         Do not call this; use C{decode()} instead
         """
-        if data[startIndex] == 'i':
-            endPos = data[startIndex:].find('e')+startIndex
-            return (int(data[startIndex+1:endPos]), endPos+1)
-        elif data[startIndex] == 'l':
-            startIndex += 1
-            decodedList = []
-            while data[startIndex] != 'e':
-                listData, startIndex = Bencode._decodeRecursive(data, startIndex)
-                decodedList.append(listData)
-            return (decodedList, startIndex+1)
-        elif data[startIndex] == 'd':
-            startIndex += 1
-            decodedDict = {}
-            while data[startIndex] != 'e':
-                key, startIndex = Bencode._decodeRecursive(data, startIndex)
-                value, startIndex = Bencode._decodeRecursive(data, startIndex)
-                decodedDict[key] = value
-            return (decodedDict, startIndex)
-        elif data[startIndex] == 'f':
-            # This (float data type) is a non-standard extension to the original Bencode algorithm
-            endPos = data[startIndex:].find('e')+startIndex
-            return (float(data[startIndex+1:endPos]), endPos+1)
-        elif data[startIndex] == 'n':
-            # This (None/NULL data type) is a non-standard extension
-            # to the original Bencode algorithm
-            return (None, startIndex+1)
-        else:
-            splitPos = data[startIndex:].find(':')+startIndex
-            try:
-                length = int(data[startIndex:splitPos])
-            except ValueError, e:
-                raise DecodeError, e
-            startIndex = splitPos+1
-            endPos = startIndex+length
-            bytes = data[startIndex:endPos]
-            return (bytes, endPos)
+        return _decoders.get(data[startIndex], _decodeString)(data, startIndex)
+
+
+# The encoders append the encoded parts of an item to a list, which is joined
+# once the whole message has been encoded. The decoders take the index of an
+# item in the encoded data and return the item along with the index following
+# it, so the data is only ever sliced to extract integers and strings.
+
+def _encodeItem(data, encodedParts):
+    try:
+        encoder = _encoders[type(data)]
+    except KeyError:
+        raise TypeError, "Cannot bencode '%s' object" % type(data)
+    encoder(data, encodedParts)
+
+
+def _encodeInt(data, encodedParts):
+    encodedParts.append('i%de' % data)
+
+
+def _encodeString(data, encodedParts):
+    encodedParts.extend((str(len(data)), ':', data))
+
+
+def _encodeList(data, encodedParts):
+    encodedParts.append('l')
+    for item in data:
+        _encodeItem(item, encodedParts)
+    encodedParts.append('e')
+
+
+def _encodeDict(data, encodedParts):
+    encodedParts.append('d')
+    for key in sorted(data):
+        _encodeItem(key, encodedParts)
+        _encodeItem(data[key], encodedParts)
+    encodedParts.append('e')
+
+
+def _encodeFloat(data, encodedParts):
+    # This (float data type) is a non-standard extension to the original Bencode algorithm
+    encodedParts.append('f%fe' % data)
+
+
+def _encodeNone(data, encodedParts):
+    # This (None/NULL data type) is a non-standard extension
+    # to the original Bencode algorithm
+    encodedParts.append('n')
+
+
+def _decodeInt(data, startIndex):
+    endIndex = data.index('e', startIndex)
+    return (int(data[startIndex+1:endIndex]), endIndex+1)
+
+
+def _decodeString(data, startIndex):
+    splitIndex = data.find(':', startIndex)
+    if splitIndex == -1:
+        raise DecodeError('String length is not followed by ":"')
+    try:
+        length = int(data[startIndex:splitIndex])
+    except ValueError, e:
+        raise DecodeError, e
+    startIndex = splitIndex+1
+    endIndex = startIndex+length
+    return (data[startIndex:endIndex], endIndex)
+
+
+def _decodeList(data, startIndex):
+    startIndex += 1
+    decodedList = []
+    while data[startIndex] != 'e':
+        item, startIndex = _decoders.get(data[startIndex], _decodeString)(data, startIndex)
+        decodedList.append(item)
+    return (decodedList, startIndex+1)
+
+
+def _decodeDict(data, startIndex):
+    startIndex += 1
+    decodedDict = {}
+    while data[startIndex] != 'e':
+        key, startIndex = _decoders.get(data[startIndex], _decodeString)(data, startIndex)
+        value, startIndex = _decoders.get(data[startIndex], _decodeString)(data, startIndex)
+        decodedDict[key] = value
+    # The index of the dict's closing 'e' is returned rather than the index
+    # following it, so a dict ends the list or dict which contains it. Earlier
+    # versions decoded messages this way, and Node.store relies on it to drop
+    # the extra arguments which are sent with store requests.
+    return (decodedDict, startIndex)
+
+
+def _decodeFloat(data, startIndex):
+    # This (float data type) is a non-standard extension to the original Bencode algorithm
+    endIndex = data.index('e', startIndex)
+    return (float(data[startIndex+1:endIndex]), endIndex+1)
+
+
+def _decodeNone(data, startIndex):
+    # This (None/NULL data type) is a non-standard extension
+    # to the original Bencode algorithm
+    return (None, startIndex+1)
+
+
+_encoders = {
+    int: _encodeInt,
+    long: _encodeInt,
+    str: _encodeString,
+    list: _encodeList,
+    tuple: _encodeList,
+    dict: _encodeDict,
+    float: _encodeFloat,
+    type(None): _encodeNone,
+}
+
+# anything else is decoded as a string
+_decoders = {
+    'i': _decodeInt,
+    'l': _decodeList,
+    'd': _decodeDict,
+    'f': _decodeFloat,
+    'n': _decodeNone,
+}
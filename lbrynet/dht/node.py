@@ -9,7 +9,9 @@
 import argparse
 import binascii
 import hashlib
+import json
 import operator
+import os
 import random
 import struct
 import time
@@ -21,7 +23,6 @@ import routingtable
 import datastore
 import protocol
 import twisted.internet.reactor
-import twisted.internet.threads
 import twisted.python.log
 from contact import Contact
 from hashwatcher import HashWatcher
@@ -53,7 +54,8 @@ class Node(object):
     """
     def __init__(self, id=None, udpPort=4000, dataStore=None,
                  routingTableClass=None, networkProtocol=None, lbryid=None,
-                 externalIP=None):
+                 externalIP=None, routingTableSnapshot=None, disjointLookupPaths=0,
+                 maxPacketsPerSecond=constants.maxPacketsPerSecond):
         """
         @param dataStore: The data store to use. This must be class inheriting
                           from the C{DataStore} interface (or providing the
@@ -75,9 +77,26 @@ class Node(object):
                                 change the format of the physical RPC messages
                                 being transmitted.
         @type networkProtocol: entangled.kademlia.protocol.KademliaProtocol
+        @param routingTableSnapshot: The path of a file to save this node's id
+                                     and contacts to when it is stopped. If the
+                                     file exists, they are restored from it so
+                                     the node can rejoin the network quickly.
+        @type routingTableSnapshot: str
+        @param disjointLookupPaths: If this is more than 0, iterative lookups
+                                    follow this many disjoint paths in parallel
+                                    (see C{_DisjointPathFindHelper}) instead of
+                                    using the original lookup
+        @type disjointLookupPaths: int
+        @param maxPacketsPerSecond: The most UDP packets the default network
+                                    protocol sends per second
+        @type maxPacketsPerSecond: int
         """
+        self._routingTableSnapshot = routingTableSnapshot
+        snapshot = self._readRoutingTableSnapshot()
         if id != None:
             self.id = id
+        elif snapshot is not None:
+            self.id = str(snapshot['id']).decode('hex')
         else:
             self.id = self._generateID()
         self.lbryid = lbryid
@@ -99,7 +118,8 @@ class Node(object):
 
         # Initialize this node's network access mechanisms
         if networkProtocol == None:
-            self._protocol = protocol.KademliaProtocol(self)
+            self._protocol = protocol.KademliaProtocol(
+                self, maxPacketsPerSecond=maxPacketsPerSecond)
         else:
             self._protocol = networkProtocol
         # Initialize the data storage mechanism used by this node
@@ -107,7 +127,7 @@ class Node(object):
         self.old_token_secret = None
         self.change_token()
         if dataStore == None:
-            self._dataStore = datastore.DictDataStore()
+            self._dataStore = datastore.PeerDataStore()
         else:
             self._dataStore = dataStore
             # Try to restore the node's state...
@@ -120,6 +140,14 @@ class Node(object):
                     self._routingTable.addContact(contact)
         self.externalIP = externalIP
         self.hash_watcher = HashWatcher()
+        self.disjointLookupPaths = disjointLookupPaths
+        # smoothed round trip time of the RPCs sent by disjoint path lookups
+        self.lookupRtt = None
+        # contacts from the snapshot which haven't been seen recently, they are
+        # pinged when the node joins the network
+        self._staleContacts = []
+        if snapshot is not None:
+            self._restoreContacts(snapshot['contacts'])
 
     def __del__(self):
         if self._listeningPort is not None:
@@ -136,6 +164,63 @@ class Node(object):
         if self._listeningPort is not None:
             self._listeningPort.stopListening()
         self.hash_watcher.stop()
+        self._dataStore.stop()
+        self._writeRoutingTableSnapshot()
+
+    def _readRoutingTableSnapshot(self):
+        if self._routingTableSnapshot is None or not os.path.isfile(self._routingTableSnapshot):
+            return None
+        try:
+            with open(self._routingTableSnapshot, 'r') as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, ValueError):
+            log.warning("Ignoring unreadable routing table snapshot %s",
+                        self._routingTableSnapshot)
+            return None
+
+    def _restoreContacts(self, contacts):
+        """ Add the recently seen contacts from a snapshot to the routing table,
+        and keep the others to be pinged when joining the network """
+        now = int(time.time())
+        restored = 0
+        for contact_id, address, port, last_seen in contacts:
+            age = now - last_seen
+            if age > constants.snapshotContactMaxAge:
+                continue
+            contact = Contact(str(contact_id).decode('hex'), str(address), port, self._protocol)
+            contact.lastSeen = last_seen
+            if age <= constants.refreshTimeout:
+                self._routingTable.addContact(contact)
+                restored += 1
+            else:
+                self._staleContacts.append(contact)
+        log.info("Restored %i contacts from the routing table snapshot, %i need to be pinged",
+                 restored, len(self._staleContacts))
+
+    def _writeRoutingTableSnapshot(self):
+        if self._routingTableSnapshot is None:
+            return
+        contacts = []
+        for bucket in self._routingTable._buckets:
+            for contact in bucket._contacts:
+                contacts.append((contact.id.encode('hex'), contact.address, contact.port,
+                                 contact.lastSeen))
+        # the stale contacts are kept in case the node is restarted again before they are pinged
+        for contact in self._staleContacts:
+            contacts.append((contact.id.encode('hex'), contact.address, contact.port,
+                             contact.lastSeen))
+        # the snapshot is written to a temporary file first, so that the previous one is
+        # left as it is if writing fails part of the way through
+        tmp_path = self._routingTableSnapshot + '.tmp'
+        try:
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump({'id': self.id.encode('hex'), 'contacts': contacts}, snapshot_file)
+            if os.path.isfile(self._routingTableSnapshot):
+                os.remove(self._routingTableSnapshot)
+            os.rename(tmp_path, self._routingTableSnapshot)
+        except (IOError, OSError) as err:
+            log.warning("Failed to save the routing table snapshot %s: %s",
+                        self._routingTableSnapshot, err)
 
 
     def joinNetwork(self, knownNodeAddresses=None):
@@ -165,6 +250,15 @@ class Node(object):
                 bootstrapContacts.append(contact)
         else:
             bootstrapContacts = None
+        # Check the contacts from the snapshot which haven't been seen recently, the ones
+        # which reply are added to the routing table by the protocol
+        staleContacts, self._staleContacts = self._staleContacts, []
+        for contact in staleContacts:
+            contact.ping().addErrback(lambda err: None)
+        # Start from the restored contacts closest to this node as well as the known nodes
+        restoredContacts = self._routingTable.findCloseNodes(self.id, constants.k)
+        if bootstrapContacts is not None and restoredContacts:
+            bootstrapContacts = restoredContacts + bootstrapContacts
         # Initiate the Kademlia joining sequence - perform a search for this node's own ID
         self._joinDeferred = self._iterativeFind(self.id, bootstrapContacts)
 #        #TODO: Refresh all k-buckets further away than this node's closest neighbour
@@ -195,7 +289,7 @@ class Node(object):
         # bad estimate of the average number of hashes per node, then multiply by the
         # approximate number of nodes to get a horrendous estimate of the total number
         # of hashes in the DHT
-        num_in_data_store = len(self._dataStore._dict)
+        num_in_data_store = len(self._dataStore)
         if num_in_data_store == 0:
             return 0
         return num_in_data_store * self.getApproximateTotalDHTNodes() / 8
@@ -203,6 +297,9 @@ class Node(object):
     def announceHaveBlob(self, key, port):
         return self.iterativeAnnounceHaveBlob(key, {'port': port, 'lbryid': self.lbryid})
 
+    def announceHaveBlobs(self, keys, port):
+        return self.iterativeAnnounceHaveBlobs(keys, {'port': port, 'lbryid': self.lbryid})
+
     def getPeersForBlob(self, blob_hash):
 
         def expand_and_filter(result):
@@ -292,6 +389,106 @@ class Node(object):
         d.addCallbacks(requestPeers)
         return d
 
+    def iterativeAnnounceHaveBlobs(self, blob_hashes, value):
+        """ Announce several blobs, sharing node lookups between nearby hashes
+
+        The hashes are announced in sorted order. A node lookup is made for
+        the first hash, and the hashes following it which are closer to it
+        than the furthest contact found are announced to those contacts
+        without being looked up again. Each contact is asked for a token once,
+        and is then sent a store request for each of its hashes without
+        waiting for the previous one to be answered.
+
+        @param blob_hashes: The hashes to announce
+        @type blob_hashes: list of str
+        @param value: The value to store for each hash, as in
+                      C{iterativeAnnounceHaveBlob}
+        @type value: dict
+
+        @return: A deferred which fires once every store request has been
+                 answered, with a dict mapping each hash to the number of
+                 contacts which stored it
+        @rtype: twisted.internet.defer.Deferred
+        """
+        blob_hashes = sorted(blob_hashes)
+        stored = dict((blob_hash, 0) for blob_hash in blob_hashes)
+        store_ds = []
+
+        def log_error(err, blob_hash, n):
+            if err.check(protocol.TimeoutError):
+                log.debug(
+                    "Timeout while storing blob_hash %s at %s",
+                    binascii.hexlify(blob_hash), n)
+            else:
+                log.error(
+                    "Unexpected error while storing blob_hash %s at %s: %s",
+                    binascii.hexlify(blob_hash), n, err.getErrorMessage())
+
+        def count_store(res, blob_hash):
+            log.debug("Response to store request: %s", str(res))
+            stored[blob_hash] += 1
+            return res
+
+        def announce_to_peer(responseTuple, contact, contact_hashes):
+            responseMsg = responseTuple[0]
+            # Make sure the responding node is valid, and abort the operation if it isn't
+            if responseMsg.nodeID != contact.id:
+                return responseMsg.nodeID
+            result = responseMsg.response
+            if 'token' not in result:
+                return False
+            # the token only depends on our address, so it is good for every hash
+            contact_value = dict(value, token=result['token'])
+            ds = []
+            for blob_hash in contact_hashes:
+                d = contact.store(blob_hash, contact_value, self.id, 0)
+                d.addCallback(count_store, blob_hash)
+                d.addErrback(log_error, blob_hash, contact)
+                ds.append(d)
+            return defer.DeferredList(ds)
+
+        def announce_group(contacts, group):
+            hashes_by_contact = {}
+            for blob_hash in group:
+                blob_contacts = list(contacts)
+                if self.externalIP is not None and len(contacts) >= constants.k:
+                    distance = Distance(blob_hash)
+                    blob_contacts.sort(key=distance.to_contact)
+                    if distance.is_closer(self.id, blob_contacts[-1].id):
+                        blob_contacts.pop()
+                        self.store(blob_hash, value, self_store=True, originalPublisherID=self.id)
+                elif self.externalIP is not None:
+                    self.store(blob_hash, value, self_store=True, originalPublisherID=self.id)
+                for contact in blob_contacts:
+                    hashes_by_contact.setdefault(contact.id, (contact, []))[1].append(blob_hash)
+            for contact, contact_hashes in hashes_by_contact.itervalues():
+                d = contact.findValue(contact_hashes[0], rawResponse=True)
+                d.addCallback(announce_to_peer, contact, contact_hashes)
+                d.addErrback(log_error, contact_hashes[0], contact)
+                store_ds.append(d)
+
+        def announce_from(index, contacts):
+            distance = Distance(blob_hashes[index])
+            end = index + 1
+            if contacts:
+                radius = max(distance.to_contact(contact) for contact in contacts)
+                while end < len(blob_hashes) and distance(blob_hashes[end]) < radius:
+                    end += 1
+            log.debug("Announcing %i hashes with one lookup", end - index)
+            announce_group(contacts, blob_hashes[index:end])
+            return lookup_from(end)
+
+        def lookup_from(index):
+            if index == len(blob_hashes):
+                return defer.DeferredList(store_ds)
+            d = self.iterativeFindNode(blob_hashes[index])
+            d.addCallback(lambda contacts: announce_from(index, contacts))
+            return d
+
+        d = lookup_from(0)
+        d.addCallback(lambda _: stored)
+        return d
+
     def change_token(self):
         self.old_token_secret = self.token_secret
         self.token_secret = self._generateID()
@@ -382,6 +579,7 @@ class Node(object):
         @param contact: The contact to add to this node's k-buckets
         @type contact: kademlia.contact.Contact
         """
+        contact.lastSeen = int(time.time())
         self._routingTable.addContact(contact)
 
     def removeContact(self, contactID):
@@ -603,11 +801,27 @@ class Node(object):
 
         outerDf = defer.Deferred()
 
+        if self.disjointLookupPaths > 0:
+            helper = _DisjointPathFindHelper(
+                self, outerDf, shortlist, key, findValue, rpc, self.disjointLookupPaths)
+            helper.start()
+            return outerDf
+
         helper = _IterativeFindHelper(self, outerDf, shortlist, key, findValue, rpc)
         # Start the iterations
         helper.searchIteration()
         return outerDf
 
+    def _recordLookupRtt(self, rtt, slow=False):
+        if self.lookupRtt is None:
+            self.lookupRtt = rtt
+            return
+        if slow:
+            # a few very slow contacts shouldn't make every probe wait for them, so
+            # the estimate is only allowed to grow gradually
+            rtt = min(rtt, self.lookupRtt * constants.lookupSlowProbeFactor)
+        self.lookupRtt += (rtt - self.lookupRtt) * constants.lookupRttSmoothing
+
     def _refreshNode(self):
         """ Periodically called to perform k-bucket refreshes and data
         replication/republishing as necessary """
@@ -637,8 +851,9 @@ class Node(object):
 
     #args put here because _refreshRoutingTable does outerDF.callback(None)
     def _removeExpiredPeers(self, *args):
-        df = twisted.internet.threads.deferToThread(self._dataStore.removeExpiredPeers)
-        return df
+        # expiring peers from the default datastore is cheap, and keeping it on the
+        # reactor means the datastore is only ever used from one thread
+        return defer.maybeDeferred(self._dataStore.removeExpiredPeers)
 
 
 # This was originally a set of nested methods in _iterativeFind
@@ -844,6 +1059,201 @@ class _IterativeFindHelper(object):
         )
 
 
+class _LookupPath(object):
+    """ The state of one of the paths followed by a C{_DisjointPathFindHelper} """
+    def __init__(self):
+        # Contacts this path may query, or has queried
+        self.shortlist = []
+        # IDs of the contacts this path has queried
+        self.queried = set()
+        # {contact ID: the call marking the probe as slow}
+        self.probes = {}
+        self.done = False
+
+    def fastProbeCount(self):
+        return len([call for call in self.probes.itervalues() if call.active()])
+
+
+class _DisjointPathFindHelper(object):
+    """ An iterative lookup which follows several disjoint paths in parallel
+
+    As in S/Kademlia, the starting contacts are dealt out between the paths,
+    each path only extends its own shortlist, and a contact is only ever
+    queried by one path. A path is finished once the k closest contacts in
+    its shortlist have all been queried and have answered (or are slow), and
+    the lookup is finished once every path is (or as soon as any path finds
+    the value being looked for). This makes it harder for a few bad nodes to
+    steer a lookup.
+
+    Rather than probing in rounds separated by C{iterativeLookupDelay}, a
+    path sends its next probe as soon as one of its probes is answered. A
+    probe which takes longer than C{lookupSlowProbeFactor} times the node's
+    smoothed round trip time stops counting towards alpha, so slow nodes
+    increase the parallelism of a path (up to C{lookupMaxAlpha} probes)
+    instead of holding it up.
+    """
+    def __init__(self, node, outer_d, shortlist, key, find_value, rpc, pathCount):
+        self.node = node
+        self.outer_d = outer_d
+        self.key = key
+        self.find_value = find_value
+        self.rpc = rpc
+        self.distance = Distance(key)
+        self.paths = [_LookupPath() for _ in range(pathCount)]
+        # IDs of the contacts that have been queried by any path
+        self.claimed = set()
+        # Contacts which have answered
+        self.active_contacts = []
+        self.find_value_result = {}
+        self.finished = False
+        shortlist = list(shortlist)
+        self.sortByDistance(shortlist)
+        for i, contact in enumerate(shortlist):
+            self.paths[i % pathCount].shortlist.append(contact)
+
+    def sortByDistance(self, contact_list):
+        """Sort the list of contacts in order by distance from key"""
+        ExpensiveSort(contact_list, self.distance.to_contact).sort()
+
+    def start(self):
+        for path in self.paths:
+            self._advance(path)
+        self._checkFinished()
+
+    def _slowProbeDelay(self):
+        if self.node.lookupRtt is None:
+            return constants.iterativeLookupDelay
+        return min(constants.iterativeLookupDelay,
+                   max(constants.lookupMinSlowProbeDelay,
+                       self.node.lookupRtt * constants.lookupSlowProbeFactor))
+
+    def _advance(self, path):
+        """ Send probes to the closest unqueried contacts of the path, as long as
+        it has fewer than alpha probes which aren't slow """
+        if self.finished or path.done:
+            return
+        for contact in self._candidates(path):
+            if (path.fastProbeCount() >= constants.alpha or
+                    len(path.probes) >= constants.lookupMaxAlpha):
+                break
+            # answers which arrive straight away advance the path from within this loop
+            if contact.id not in self.claimed:
+                self._probeContact(path, contact)
+        # the path is finished once nothing is left to query; like the original lookup,
+        # it doesn't wait for the slow probes. While slow probes fill all of its probe
+        # slots it isn't, it carries on as they are answered or time out
+        if not path.fastProbeCount() and not self._candidates(path):
+            path.done = True
+
+    def _candidates(self, path):
+        """ The contacts among the k closest of the path which it hasn't queried yet,
+        in the order to probe them """
+        # drop the contacts queried by other paths, so the paths stay disjoint
+        path.shortlist = [contact for contact in path.shortlist
+                          if contact.id in path.queried or contact.id not in self.claimed]
+        self.sortByDistance(path.shortlist)
+        # slow contacts don't count towards the k closest, the path looks past them
+        slow = set(contactID for contactID, call in path.probes.iteritems() if not call.active())
+        closest = [contact for contact in path.shortlist if contact.id not in slow]
+        candidates = [contact for contact in closest[:constants.k]
+                      if contact.id not in path.queried]
+        sortForProbing(candidates, self.distance, self.node._protocol)
+        return candidates
+
+    def _probeContact(self, path, contact):
+        self.claimed.add(contact.id)
+        path.queried.add(contact.id)
+        path.probes[contact.id] = twisted.internet.reactor.callLater(
+            self._slowProbeDelay(), self._probeIsSlow, path)
+        sent = time.time()
+        rpcMethod = getattr(contact, self.rpc)
+        df = rpcMethod(self.key, rawResponse=True)
+        df.addCallbacks(self._probeAnswered, self._probeFailed,
+                        callbackArgs=(path, contact, sent), errbackArgs=(path, contact))
+        df.addErrback(log.fail(), 'Failed to contact %s', contact)
+
+    def _probeIsSlow(self, path):
+        self._advance(path)
+        self._checkFinished()
+
+    def _probeAnswered(self, responseTuple, path, contact, sent):
+        call = path.probes.get(contact.id)
+        self.node._recordLookupRtt(time.time() - sent, slow=call is None or not call.active())
+        responseMsg, originAddress = responseTuple
+        if responseMsg.nodeID != self.node.id and not self.finished:
+            self.claimed.add(responseMsg.nodeID)
+            path.queried.add(responseMsg.nodeID)
+            if responseMsg.nodeID != contact.id:
+                # We probably used a fake ID to reach it (bootstrap contacts)
+                # - reconstruct the contact, using the real node ID this time
+                contact = Contact(responseMsg.nodeID, originAddress[0], originAddress[1],
+                                  self.node._protocol)
+            if contact not in self.active_contacts:
+                self.active_contacts.append(contact)
+            result = responseMsg.response
+            if self.find_value is True and self.key in result and not 'contacts' in result:
+                self.find_value_result[self.key] = result[self.key]
+                self.find_value_result['from_peer'] = contact.address
+            else:
+                if self.find_value is True:
+                    self._setClosestNodeValue(contact)
+                    contactTriples = result['contacts']
+                else:
+                    contactTriples = result
+                self._extendShortlist(path, contactTriples)
+        self._probeDone(path, contact)
+
+    def _probeFailed(self, failure, path, contact):
+        if not failure.check(protocol.TimeoutError):
+            log.warning("Lookup probe to %s failed: %s", contact, failure.getErrorMessage())
+        if contact in path.shortlist:
+            path.shortlist.remove(contact)
+        self._probeDone(path, contact)
+
+    def _probeDone(self, path, contact):
+        call = path.probes.pop(contact.id, None)
+        if call is not None and call.active():
+            call.cancel()
+        if self.key in self.find_value_result:
+            self._finish()
+            return
+        self._advance(path)
+        self._checkFinished()
+
+    def _setClosestNodeValue(self, contact):
+        closest = self.find_value_result.get('closestNodeNoValue')
+        if closest is None or self.distance.is_closer(contact.id, closest.id):
+            self.find_value_result['closestNodeNoValue'] = contact
+
+    def _extendShortlist(self, path, contactTriples):
+        for contactTriple in contactTriples:
+            if isinstance(contactTriple, (list, tuple)) and len(contactTriple) == 3:
+                if contactTriple[0] == self.node.id or contactTriple[0] in self.claimed:
+                    continue
+                testContact = Contact(
+                    contactTriple[0], contactTriple[1], contactTriple[2], self.node._protocol)
+                if testContact not in path.shortlist:
+                    path.shortlist.append(testContact)
+
+    def _checkFinished(self):
+        if not self.finished and all(path.done for path in self.paths):
+            self._finish()
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        for path in self.paths:
+            for call in path.probes.itervalues():
+                if call.active():
+                    call.cancel()
+        if self.key in self.find_value_result:
+            self.outer_d.callback(self.find_value_result)
+        else:
+            self.sortByDistance(self.active_contacts)
+            self.outer_d.callback(self.active_contacts[:constants.k])
+
+
 class Distance(object):
     """Calculate the XOR result between two string variables.
 
@@ -864,7 +1274,24 @@ class Distance(object):
 
     def to_contact(self, contact):
         """A convenience function for calculating the distance to a contact"""
-        return self(contact.id)
+        return self.val_key_one ^ contact.id_int
+
+
+def sortForProbing(contact_list, distance, networkProtocol):
+    """ Sort contacts in the order a disjoint path lookup should probe them: by
+    distance to the key, except that contacts which are about as far from it (the
+    highest bit set in their distance is the same) are sorted by round trip time,
+    and the contacts with no round trip time go after the others
+
+    Only disjoint path lookups, which probe as soon as a probe is answered and look
+    past slow contacts, use this. The standard lookup probes the closest contacts
+    first, so that it converges as Kademlia's does.
+    """
+    def probeOrder(contact):
+        contactDistance = distance.to_contact(contact)
+        rtt = networkProtocol.getRtt(contact.id)
+        return (contactDistance.bit_length(), rtt is None, rtt, contactDistance)
+    ExpensiveSort(contact_list, probeOrder).sort()
 
 
 class ExpensiveSort(object):
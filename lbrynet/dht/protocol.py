@@ -12,10 +12,10 @@ import binascii
 import time
 import socket
 import errno
+from collections import OrderedDict, deque
 
 from twisted.internet import protocol, defer
 from twisted.python import failure
-from twisted.internet import error
 import twisted.internet.reactor
 
 import constants
@@ -39,44 +39,265 @@ class TimeoutError(Exception):
         self.remote_contact_id = remote_contact_id
 
 
-class Delay(object):
-    maxToSendDelay = 10**-3 #0.05
-    minToSendDelay = 10**-5 #0.01
+class SendQueueFullError(Exception):
+    """ Raised when a RPC is dropped because the send queue is full """
+    def __init__(self, remote_contact_id):
+        msg = 'Send queue full, dropped RPC to {}'.format(binascii.hexlify(remote_contact_id))
+        Exception.__init__(self, msg)
+        self.remote_contact_id = remote_contact_id
 
-    def __init__(self, start=0):
-        self._next = start
 
-    # TODO: explain why this logic is like it is. And add tests that
-    #       show that it actually does what it needs to do.
-    def __call__(self):
-        ts = time.time()
-        delay = 0
-        if ts >= self._next:
-            delay = self.minToSendDelay
-            self._next = ts + self.minToSendDelay
+class SendQueue(object):
+    """ Sends UDP packets at a limited rate, in order of priority
+
+    Packets are taken from the queue as long as there are tokens in a token
+    bucket which fills up at C{packetsPerSecond}, holding up to C{burstSize}
+    tokens. When it runs dry, a single delayed call drains the queue again
+    once the next token is available. Responses to other nodes are sent
+    before our own requests, which are sent before our own store requests
+    (announces). Messages which don't fit in the queue are dropped.
+    """
+    RESPONSE, REQUEST, STORE = range(3)
+
+    def __init__(self, write, packetsPerSecond, burstSize=constants.sendBurstSize,
+                 maxSize=constants.maxSendQueueSize):
+        """
+        @param write: Called with the data and address of each packet to send it
+        @type write: callable
+        """
+        self._write = write
+        self._rate = float(packetsPerSecond)
+        self._burstSize = burstSize
+        self._maxSize = maxSize
+        self._tokens = float(burstSize)
+        self._lastRefill = time.time()
+        self._queues = [deque() for _ in range(self.STORE + 1)]
+        self._queued = 0
+        self._drainCall = None
+        self._sent = 0
+        self._dropped = 0
+
+    def __len__(self):
+        return self._queued
+
+    def put(self, packets, priority):
+        """ Queue the packets of a message, or drop them all if they don't fit
+
+        @param packets: The (data, address) tuples of the packets to send
+        @type packets: list
+        @param priority: C{SendQueue.RESPONSE}, C{SendQueue.REQUEST} or
+                         C{SendQueue.STORE}
+
+        @return: Whether the packets were queued
+        @rtype: bool
+        """
+        if self._queued + len(packets) > self._maxSize:
+            if not self._dropped:
+                log.warning("The dht send queue is full, dropping messages")
+            self._dropped += len(packets)
+            return False
+        self._queues[priority].extend(packets)
+        self._queued += len(packets)
+        if self._drainCall is None:
+            self._drain()
+        return True
+
+    def stats(self):
+        return {'queued': self._queued, 'sent': self._sent, 'dropped': self._dropped}
+
+    def stop(self):
+        if self._drainCall is not None:
+            self._drainCall.cancel()
+            self._drainCall = None
+        for queue in self._queues:
+            queue.clear()
+        self._queued = 0
+
+    def _drain(self):
+        self._drainCall = None
+        now = time.time()
+        self._tokens = min(self._burstSize, self._tokens + (now - self._lastRefill) * self._rate)
+        self._lastRefill = now
+        for queue in self._queues:
+            while queue and self._tokens >= 1:
+                data, address = queue.popleft()
+                self._queued -= 1
+                self._tokens -= 1
+                self._sent += 1
+                self._write(data, address)
+        if self._queued:
+            self._drainCall = reactor.callLater((1 - self._tokens) / self._rate, self._drain)
+
+
+class _PartialMessage(object):
+    def __init__(self, address, totalPackets, started):
+        self.address = address
+        self.packets = [None] * totalPackets
+        self.received = 0
+        self.size = 0
+        self.started = started
+
+
+class ReassemblyBuffer(object):
+    """ Puts the messages which were sent over several UDP packets back together
+
+    The packets of each message are kept in a list of the message's length,
+    and joined once they have all arrived. A message may take up to
+    C{maxMessageSize} bytes, and all the messages being received up to
+    C{maxSize} bytes; the oldest messages are dropped to make room for new
+    packets. Messages which aren't complete within C{timeout} seconds of
+    their first packet are dropped as well.
+    """
+    def __init__(self, packetSize, maxMessageSize=constants.maxMultiPacketMessageSize,
+                 maxSize=constants.maxReassemblyBufferSize, timeout=constants.reassemblyTimeout):
+        """
+        @param packetSize: The size of the data in each packet of a message
+                           but the last
+        @type packetSize: int
+        """
+        self._maxPackets = -(-maxMessageSize // packetSize)
+        self._maxMessageSize = maxMessageSize
+        self._maxSize = maxSize
+        self._timeout = timeout
+        # {message ID: _PartialMessage}, oldest first
+        self._messages = OrderedDict()
+        self._size = 0
+
+    def __contains__(self, msgID):
+        return msgID in self._messages
+
+    def __len__(self):
+        return len(self._messages)
+
+    def size(self):
+        """ The number of bytes of data held """
+        return self._size
+
+    def add(self, msgID, totalPackets, seqNumber, data, address):
+        """ Add a packet of a message
+
+        @return: The data of the message if this packet completed it,
+                 otherwise C{None}
+        @rtype: str
+        """
+        now = time.time()
+        self._expire(now)
+        if not 0 <= seqNumber < totalPackets <= self._maxPackets:
+            log.debug("Dropping a packet of an invalid message from %s", address)
+            return None
+        message = self._messages.get(msgID)
+        if message is None:
+            message = _PartialMessage(address, totalPackets, now)
+            self._messages[msgID] = message
+        elif message.address != address or len(message.packets) != totalPackets:
+            log.debug("Dropping a packet which doesn't match its message from %s", address)
+            return None
+        if message.packets[seqNumber] is not None:
+            return None
+        if message.size + len(data) > self._maxMessageSize:
+            log.debug("Dropping a message from %s which is too large", address)
+            self.discard(msgID)
+            return None
+        while self._size + len(data) > self._maxSize:
+            oldestID = next(iter(self._messages))
+            self.discard(oldestID)
+            if oldestID == msgID:
+                return None
+        message.packets[seqNumber] = data
+        message.received += 1
+        message.size += len(data)
+        self._size += len(data)
+        if message.received < totalPackets:
+            return None
+        self.discard(msgID)
+        return ''.join(message.packets)
+
+    def received(self, msgID):
+        """ Returns the number of packets of a message received so far """
+        message = self._messages.get(msgID)
+        if message is None:
+            return 0
+        return message.received
+
+    def discard(self, msgID):
+        message = self._messages.pop(msgID, None)
+        if message is not None:
+            self._size -= message.size
+
+    def clear(self):
+        self._messages.clear()
+        self._size = 0
+
+    def _expire(self, now):
+        while self._messages:
+            msgID, message = next(self._messages.iteritems())
+            if message.started + self._timeout > now:
+                break
+            self.discard(msgID)
+
+
+class ContactStats(object):
+    """ The round trip times and failures of the RPCs sent to a contact
+
+    The timeout of a RPC attempt is worked out like TCP's retransmission
+    timeout (RFC 6298), from the smoothed round trip time and its variance,
+    and it doubles for each RPC to the contact which failed in a row.
+    """
+    def __init__(self):
+        self.rtt = None
+        self.rttVariance = None
+        self.failures = 0
+
+    def addAnswer(self, rtt=None):
+        """ Record an answer from the contact
+
+        @param rtt: The round trip time of the RPC, if it is known which
+                    attempt was answered
+        @type rtt: float
+        """
+        self.failures = 0
+        if rtt is None:
+            return
+        if self.rtt is None:
+            self.rtt = rtt
+            self.rttVariance = rtt / 2
         else:
-            delay = (self._next - ts) + self.maxToSendDelay
-            self._next += self.maxToSendDelay
-        return delay
+            deviation = abs(self.rtt - rtt)
+            self.rttVariance += (deviation - self.rttVariance) * constants.rttVarianceSmoothing
+            self.rtt += (rtt - self.rtt) * constants.rttSmoothing
+
+    def addFailure(self):
+        self.failures += 1
+
+    def timeout(self):
+        """ The time to wait for the answer to the first attempt of a RPC """
+        if self.rtt is None:
+            return constants.rpcAttemptTimeout
+        timeout = max(constants.rpcMinTimeout, self.rtt + 4 * self.rttVariance)
+        return min(timeout * 2 ** self.failures, constants.rpcAttemptTimeout)
 
 
 class KademliaProtocol(protocol.DatagramProtocol):
     """ Implements all low-level network-related functions of a Kademlia node """
-    msgSizeLimit = constants.udpDatagramMaxSize-26
+    # the header of each packet of a multi-packet message ends at this offset
+    # (see C{_packets})
+    packetHeaderEnd = 5 + constants.key_bits / 8
+    msgSizeLimit = constants.udpDatagramMaxSize - packetHeaderEnd - 1
 
 
     def __init__(self, node, msgEncoder=encoding.Bencode(),
-                 msgTranslator=msgformat.DefaultFormat()):
+                 msgTranslator=msgformat.DefaultFormat(),
+                 maxPacketsPerSecond=constants.maxPacketsPerSecond):
         self._node = node
         self._encoder = msgEncoder
         self._translator = msgTranslator
         self._sentMessages = {}
-        self._partialMessages = {}
+        self._partialMessages = ReassemblyBuffer(self.msgSizeLimit)
+        # {message ID: number of packets of the response received when the RPC timed out}
         self._partialMessagesProgress = {}
-        self._delay = Delay()
-        # keep track of outstanding writes so that they
-        # can be cancelled on shutdown
-        self._call_later_list = {}
+        self._sendQueue = SendQueue(self._write, maxPacketsPerSecond)
+        # {contact ID: ContactStats}, least recently used first
+        self._contactStats = OrderedDict()
 
     def sendRPC(self, contact, method, args, rawResponse=False):
         """ Sends an RPC to the specified contact
@@ -114,35 +335,57 @@ class KademliaProtocol(protocol.DatagramProtocol):
             df._rpcRawResponse = True
 
         # Set the RPC timeout timer
-        timeoutCall = reactor.callLater(
-            constants.rpcTimeout, self._msgTimeout, msg.id) #IGNORE:E1101
+        timeout = self._getContactStats(contact.id).timeout()
+        timeoutCall = reactor.callLater(timeout, self._msgTimeout, msg.id) #IGNORE:E1101
         # Transmit the data
-        self._send(encodedMsg, msg.id, (contact.address, contact.port))
-        self._sentMessages[msg.id] = (contact.id, df, timeoutCall)
+        packets = self._packets(encodedMsg, msg.id, (contact.address, contact.port))
+        priority = SendQueue.STORE if method == 'store' else SendQueue.REQUEST
+        if not self._sendQueue.put(packets, priority):
+            # The packets were never sent, so this says nothing about the contact
+            timeoutCall.cancel()
+            df.errback(failure.Failure(SendQueueFullError(contact.id)))
+            return df
+        self._sentMessages[msg.id] = (
+            contact.id, df, timeoutCall, time.time(), 1, packets, priority, timeout)
         return df
 
+    def getSendQueueStats(self):
+        """ Returns the number of packets waiting to be sent, and the numbers
+        of packets sent and dropped so far """
+        return self._sendQueue.stats()
+
+    def getRtt(self, contactID):
+        """ Returns the smoothed round trip time of the RPCs sent to a contact,
+        or C{None} if it isn't known """
+        stats = self._contactStats.get(contactID)
+        if stats is None:
+            return None
+        return stats.rtt
+
+    def _getContactStats(self, contactID):
+        stats = self._contactStats.pop(contactID, None)
+        if stats is None:
+            stats = ContactStats()
+            if len(self._contactStats) >= constants.maxContactStats:
+                self._contactStats.popitem(last=False)
+        self._contactStats[contactID] = stats
+        return stats
+
     def datagramReceived(self, datagram, address):
         """ Handles and parses incoming RPC messages (and responses)
 
         @note: This is automatically called by Twisted when the protocol
                receives a UDP datagram
         """
-        if datagram[0] == '\x00' and datagram[25] == '\x00':
+        headerEnd = self.packetHeaderEnd
+        if (len(datagram) > headerEnd and datagram[0] == '\x00' and
+                datagram[headerEnd] == '\x00'):
             totalPackets = (ord(datagram[1]) << 8) | ord(datagram[2])
-            msgID = datagram[5:25]
+            msgID = datagram[5:headerEnd]
             seqNumber = (ord(datagram[3]) << 8) | ord(datagram[4])
-            if msgID not in self._partialMessages:
-                self._partialMessages[msgID] = {}
-            self._partialMessages[msgID][seqNumber] = datagram[26:]
-            if len(self._partialMessages[msgID]) == totalPackets:
-                keys = self._partialMessages[msgID].keys()
-                keys.sort()
-                data = ''
-                for key in keys:
-                    data += self._partialMessages[msgID][key]
-                    datagram = data
-                del self._partialMessages[msgID]
-            else:
+            datagram = self._partialMessages.add(
+                msgID, totalPackets, seqNumber, datagram[headerEnd + 1:], address)
+            if datagram is None:
                 return
         try:
             msgPrimitive = self._encoder.decode(datagram)
@@ -166,9 +409,14 @@ class KademliaProtocol(protocol.DatagramProtocol):
             # Find the message that triggered this response
             if self._sentMessages.has_key(message.id):
                 # Cancel timeout timer for this RPC
-                df, timeoutCall = self._sentMessages[message.id][1:3]
+                df, timeoutCall, sentTime, attempt = self._sentMessages[message.id][1:5]
                 timeoutCall.cancel()
                 del self._sentMessages[message.id]
+                self._partialMessagesProgress.pop(message.id, None)
+                # if the RPC was sent more than once, it isn't known which attempt
+                # was answered, so there's no round trip time
+                rtt = time.time() - sentTime if attempt == 1 else None
+                self._getContactStats(message.nodeID).addAnswer(rtt)
 
                 if hasattr(df, '_rpcRawResponse'):
                     # The RPC requested that the raw response message
@@ -202,16 +450,16 @@ class KademliaProtocol(protocol.DatagramProtocol):
                 #TODO: we should probably do something with this...
                 pass
 
-    def _send(self, data, rpcID, address):
-        """ Transmit the specified data over UDP, breaking it up into several
-        packets if necessary
+    def _packets(self, data, rpcID, address):
+        """ Break the specified data up into several UDP packets if necessary,
+        and return a list of the (data, address) tuples of the packets
 
         If the data is spread over multiple UDP datagrams, the packets have the
         following structure::
             |           |     |      |      |        ||||||||||||   0x00   |
             |Transmision|Total number|Sequence number| RPC ID   |Header end|
             | type ID   | of packets |of this packet |          | indicator|
-            | (1 byte)  | (2 bytes)  |  (2 bytes)    |(20 bytes)| (1 byte) |
+            | (1 byte)  | (2 bytes)  |  (2 bytes)    |(48 bytes)| (1 byte) |
             |           |     |      |      |        ||||||||||||          |
 
         @note: The header used for breaking up large data segments will
@@ -219,7 +467,9 @@ class KademliaProtocol(protocol.DatagramProtocol):
                future, into something similar to a message translator/encoder
                class (see C{kademlia.msgformat} and C{kademlia.encoding}).
         """
-        if len(data) > self.msgSizeLimit:
+        if len(data) <= self.msgSizeLimit:
+            return [(data, address)]
+        else:
             # We have to spread the data over multiple UDP datagrams,
             # and provide sequencing information
             #
@@ -230,28 +480,20 @@ class KademliaProtocol(protocol.DatagramProtocol):
             if len(data) % self.msgSizeLimit > 0:
                 totalPackets += 1
             encTotalPackets = chr(totalPackets >> 8) + chr(totalPackets & 0xff)
+            packets = []
             seqNumber = 0
             startPos = 0
             while seqNumber < totalPackets:
                 packetData = data[startPos:startPos+self.msgSizeLimit]
                 encSeqNumber = chr(seqNumber >> 8) + chr(seqNumber & 0xff)
                 txData = '\x00%s%s%s\x00%s' % (encTotalPackets, encSeqNumber, rpcID, packetData)
-                self._scheduleSendNext(txData, address)
+                packets.append((txData, address))
 
                 startPos += self.msgSizeLimit
                 seqNumber += 1
-        else:
-            self._scheduleSendNext(data, address)
-
-    def _scheduleSendNext(self, txData, address):
-        """Schedule the sending of the next UDP packet """
-        delay = self._delay()
-        key = object()
-        delayed_call = reactor.callLater(delay, self._write_and_remove, key, txData, address)
-        self._call_later_list[key] = delayed_call
+            return packets
 
-    def _write_and_remove(self, key, txData, address):
-        del self._call_later_list[key]
+    def _write(self, txData, address):
         if self.transport:
             try:
                 self.transport.write(txData, address)
@@ -269,7 +511,8 @@ class KademliaProtocol(protocol.DatagramProtocol):
         msg = msgtypes.ResponseMessage(rpcID, self._node.id, response)
         msgPrimitive = self._translator.toPrimitive(msg)
         encodedMsg = self._encoder.encode(msgPrimitive)
-        self._send(encodedMsg, rpcID, (contact.address, contact.port))
+        self._sendQueue.put(
+            self._packets(encodedMsg, rpcID, (contact.address, contact.port)), SendQueue.RESPONSE)
 
     def _sendError(self, contact, rpcID, exceptionType, exceptionMessage):
         """ Send an RPC error message to the specified contact
@@ -277,7 +520,8 @@ class KademliaProtocol(protocol.DatagramProtocol):
         msg = msgtypes.ErrorMessage(rpcID, self._node.id, exceptionType, exceptionMessage)
         msgPrimitive = self._translator.toPrimitive(msg)
         encodedMsg = self._encoder.encode(msgPrimitive)
-        self._send(encodedMsg, rpcID, (contact.address, contact.port))
+        self._sendQueue.put(
+            self._packets(encodedMsg, rpcID, (contact.address, contact.port)), SendQueue.RESPONSE)
 
     def _handleRPC(self, senderContact, rpcID, method, args):
         """ Executes a local function in response to an RPC request """
@@ -314,52 +558,54 @@ class KademliaProtocol(protocol.DatagramProtocol):
             # This should never be reached
             log.error("deferred timed out, but is not present in sent messages list!")
             return
-        remoteContactID, df = self._sentMessages[messageID][0:2]
-        if self._partialMessages.has_key(messageID):
+        remoteContactID, df, _, sentTime, attempt, packets, priority, timeout = \
+            self._sentMessages[messageID]
+        if messageID in self._partialMessages:
             # We are still receiving this message
             self._msgTimeoutInProgress(messageID, remoteContactID, df)
             return
+        if attempt < constants.rpcAttempts:
+            # Send the RPC again, so that a single lost packet doesn't make the
+            # contact look dead
+            timeout = min(timeout * 2, constants.rpcAttemptTimeout)
+            if not self._sendQueue.put(packets, priority):
+                del self._sentMessages[messageID]
+                self._partialMessagesProgress.pop(messageID, None)
+                df.errback(failure.Failure(SendQueueFullError(remoteContactID)))
+                return
+            timeoutCall = reactor.callLater(timeout, self._msgTimeout, messageID)
+            self._sentMessages[messageID] = (
+                remoteContactID, df, timeoutCall, sentTime, attempt + 1, packets, priority,
+                timeout)
+            return
         del self._sentMessages[messageID]
         # The message's destination node is now considered to be dead;
         # raise an (asynchronous) TimeoutError exception and update the host node
+        self._getContactStats(remoteContactID).addFailure()
         self._node.removeContact(remoteContactID)
         df.errback(failure.Failure(TimeoutError(remoteContactID)))
 
     def _msgTimeoutInProgress(self, messageID, remoteContactID, df):
         # See if any progress has been made; if not, kill the message
-        if self._hasProgressBeenMade(messageID):
+        received = self._partialMessages.received(messageID)
+        if self._partialMessagesProgress.get(messageID) != received:
             # Reset the RPC timeout timer
+            self._partialMessagesProgress[messageID] = received
             timeoutCall = reactor.callLater(constants.rpcTimeout, self._msgTimeout, messageID)
-            self._sentMessages[messageID] = (remoteContactID, df, timeoutCall)
+            self._sentMessages[messageID] = (
+                (remoteContactID, df, timeoutCall) + self._sentMessages[messageID][3:])
         else:
             # No progress has been made
+            del self._sentMessages[messageID]
             del self._partialMessagesProgress[messageID]
-            del self._partialMessages[messageID]
+            self._partialMessages.discard(messageID)
             df.errback(failure.Failure(TimeoutError(remoteContactID)))
 
-    def _hasProgressBeenMade(self, messageID):
-        return (
-            self._partialMessagesProgress.has_key(messageID) and
-            (
-                len(self._partialMessagesProgress[messageID]) !=
-                len(self._partialMessages[messageID])
-            )
-        )
-
     def stopProtocol(self):
         """ Called when the transport is disconnected.
 
         Will only be called once, after all ports are disconnected.
         """
         log.info('Stopping dht')
-        for delayed_call in self._call_later_list.values():
-            try:
-                delayed_call.cancel()
-            except (error.AlreadyCalled, error.AlreadyCancelled):
-                log.debug('Attempted to cancel a DelayedCall that was not active')
-            except Exception:
-                log.exception('Failed to cancel a DelayedCall')
-            # not sure why this is needed, but taking this out sometimes causes
-            # exceptions.AttributeError: 'Port' object has no attribute 'socket'
-            # to happen on shutdown
-            # reactor.iterate()
+        self._sendQueue.stop()
+        self._partialMessages.clear()
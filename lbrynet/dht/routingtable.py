@@ -5,6 +5,7 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+import bisect
 import time, random
 
 import constants
@@ -117,6 +118,9 @@ class TreeRoutingTable(RoutingTable):
         """
         # Create the initial (single) k-bucket covering the range of the entire n-bit ID space
         self._buckets = [kbucket.KBucket(rangeMin=0, rangeMax=2**constants.key_bits)]
+        # The rangeMin of each k-bucket, in the same (ascending) order as
+        # self._buckets, so that the k-bucket for a key can be found by bisection
+        self._bucketRangeMins = [0]
         self._parentNodeID = parentNodeID
 
     def addContact(self, contact):
@@ -129,7 +133,7 @@ class TreeRoutingTable(RoutingTable):
         if contact.id == self._parentNodeID:
             return
 
-        bucketIndex = self._kbucketIndex(contact.id)
+        bucketIndex = self._kbucketIndex(contact.id_int)
         try:
             self._buckets[bucketIndex].addContact(contact)
         except kbucket.BucketFull:
@@ -294,19 +298,14 @@ class TreeRoutingTable(RoutingTable):
         specified key (or ID)
 
         @param key: The key for which to find the appropriate k-bucket index
-        @type key: str
+        @type key: str or long
 
         @return: The index of the k-bucket responsible for the specified key
         @rtype: int
         """
-        valKey = long(key.encode('hex'), 16)
-        i = 0
-        for bucket in self._buckets:
-            if bucket.keyInRange(valKey):
-                return i
-            else:
-                i += 1
-        return i
+        if isinstance(key, str):
+            key = long(key.encode('hex'), 16)
+        return bisect.bisect_right(self._bucketRangeMins, key) - 1
 
     def _randomIDInBucketRange(self, bucketIndex):
         """ Returns a random ID in the specified k-bucket's range
@@ -341,9 +340,10 @@ class TreeRoutingTable(RoutingTable):
         oldBucket.rangeMax = splitPoint
         # Now, add the new bucket into the routing table tree
         self._buckets.insert(oldBucketIndex + 1, newBucket)
+        self._bucketRangeMins.insert(oldBucketIndex + 1, splitPoint)
         # Finally, copy all nodes that belong to the new k-bucket into it...
         for contact in oldBucket._contacts:
-            if newBucket.keyInRange(contact.id):
+            if newBucket.keyInRange(contact.id_int):
                 newBucket.addContact(contact)
         # ...and remove them from the old bucket
         for contact in newBucket._contacts:
@@ -372,7 +372,7 @@ class OptimizedTreeRoutingTable(TreeRoutingTable):
         # Initialize/reset the "successively failed RPC" counter
         contact.failedRPCs = 0
 
-        bucketIndex = self._kbucketIndex(contact.id)
+        bucketIndex = self._kbucketIndex(contact.id_int)
         try:
             self._buckets[bucketIndex].addContact(contact)
         except kbucket.BucketFull:
@@ -412,6 +412,18 @@ class IBlobSender(Interface):
         @rtype: Deferred which fires with anything
         """
 
+    def cancel_send(self, blob_hash):
+        """
+        Don't send the blob in answer to the request about to be handled, because the
+        client cancelled it after sending the request. The request is answered with an
+        error instead, so the connection can be used for the client's next request.
+
+        @param blob_hash: the hash of the blob the client cancelled
+        @type blob_hash: str
+
+        @return: None
+        """
+
 
 class IQueryHandler(Interface):
     """
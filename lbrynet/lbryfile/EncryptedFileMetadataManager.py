@@ -305,6 +305,9 @@ class TempEncryptedFileMetadataManager(object):
                                   stream_info['suggested_file_name']])
         return defer.succeed(None)
 
+    def check_if_stream_exists(self, stream_hash):
+        return defer.succeed(stream_hash in self.streams)
+
     def delete_stream(self, stream_hash):
         if stream_hash in self.streams:
             del self.streams[stream_hash]
@@ -368,3 +371,8 @@ class TempEncryptedFileMetadataManager(object):
     def get_sd_blob_hashes_for_stream(self, stream_hash):
         return defer.succeed(
             [sd_hash for sd_hash, s_h in self.sd_files.iteritems() if stream_hash == s_h])
+
+    def get_stream_hash_for_sd_hash(self, sd_hash):
+        if sd_hash in self.sd_files:
+            return defer.succeed(self.sd_files[sd_hash])
+        return defer.fail(NoSuchSDHash(sd_hash))
@@ -4,6 +4,7 @@ from lbrynet.core.cryptoutils import get_lbry_hash_obj
 from lbrynet.cryptstream.CryptBlob import CryptBlobInfo
 from twisted.internet import defer, threads
 from lbrynet.core.Error import DuplicateStreamHashError, InvalidStreamDescriptorError
+from lbrynet.core.Error import NoSuchSDHash
 from lbrynet.core.StreamDescriptor import PlainStreamDescriptorWriter, BlobStreamDescriptorWriter
 import os
 
@@ -14,6 +15,29 @@ log = logging.getLogger(__name__)
 EncryptedFileStreamType = "lbryfile"
 
 
+def get_stream_hash(hex_stream_name, key, hex_suggested_file_name, blob_infos):
+    """Calculate the hash of a stream from its metadata
+
+    @param blob_infos: iterable of (blob_hash, blob_num, iv, length), ordered by blob_num.
+        blob_hash is ignored for the zero-length terminating blob
+    """
+    h = get_lbry_hash_obj()
+    h.update(hex_stream_name)
+    h.update(key)
+    h.update(hex_suggested_file_name)
+    blobs_hashsum = get_lbry_hash_obj()
+    for blob_hash, blob_num, iv, length in blob_infos:
+        blob_hashsum = get_lbry_hash_obj()
+        if length != 0:
+            blob_hashsum.update(blob_hash)
+        blob_hashsum.update(str(blob_num))
+        blob_hashsum.update(iv)
+        blob_hashsum.update(str(length))
+        blobs_hashsum.update(blob_hashsum.digest())
+    h.update(blobs_hashsum.digest())
+    return h.hexdigest()
+
+
 def save_sd_info(stream_info_manager, sd_info, ignore_duplicate=False):
     log.debug("Saving info for %s", str(sd_info['stream_name']))
     hex_stream_name = sd_info['stream_name']
@@ -115,11 +139,79 @@ def create_plain_sd(stream_info_manager, stream_hash, file_name, overwrite_exist
     return d
 
 
+class SDValidationCache(object):
+    """Remembers which stream descriptor blobs have been validated, keyed by sd hash
+
+    Since a blob's content is fixed by its hash, a validated sd blob never has to be
+    validated again. Validated sd blobs of streams the stream info manager knows are saved
+    to lbry_file_descriptors, so they are remembered across restarts. Those of streams
+    which haven't been saved yet are only remembered in memory, the row is written along
+    with the stream when it is downloaded.
+    """
+
+    def __init__(self, stream_info_manager=None):
+        self.stream_info_manager = stream_info_manager
+        self._validated = {}  # {sd_hash: stream_hash}
+        self.hits = 0
+        self.misses = 0
+
+    @defer.inlineCallbacks
+    def is_validated(self, sd_hash, stream_hash):
+        validated = self._validated.get(sd_hash) == stream_hash
+        if not validated and self.stream_info_manager is not None:
+            try:
+                known_stream_hash = yield self.stream_info_manager.get_stream_hash_for_sd_hash(
+                    sd_hash)
+            except NoSuchSDHash:
+                known_stream_hash = None
+            if known_stream_hash == stream_hash:
+                self._validated[sd_hash] = stream_hash
+                validated = True
+        if validated:
+            self.hits += 1
+        else:
+            self.misses += 1
+        defer.returnValue(validated)
+
+    @defer.inlineCallbacks
+    def set_validated(self, sd_hash, stream_hash):
+        self._validated[sd_hash] = stream_hash
+        if self.stream_info_manager is not None:
+            # a row for a stream which isn't saved would be left behind in
+            # lbry_file_descriptors if the stream is never downloaded
+            stream_exists = yield self.stream_info_manager.check_if_stream_exists(stream_hash)
+            if stream_exists:
+                yield self.stream_info_manager.save_sd_blob_hash_to_stream(stream_hash, sd_hash)
+
+
 class EncryptedFileStreamDescriptorValidator(object):
-    def __init__(self, raw_info):
+    def __init__(self, raw_info, sd_hash=None, validation_cache=None):
+        """
+        @param sd_hash: the hash of the blob the stream descriptor was read from, if any
+        @param validation_cache: a SDValidationCache used to skip validating an sd blob
+            which has been validated before
+        """
         self.raw_info = raw_info
+        self.sd_hash = sd_hash
+        self.validation_cache = validation_cache
 
+    @defer.inlineCallbacks
     def validate(self):
+        stream_hash = self.raw_info.get('stream_hash')
+        use_cache = (self.sd_hash is not None and self.validation_cache is not None and
+                     stream_hash is not None)
+        if use_cache:
+            is_validated = yield self.validation_cache.is_validated(self.sd_hash, stream_hash)
+            if is_validated:
+                log.debug("Stream descriptor %s was validated before", self.sd_hash)
+                defer.returnValue(True)
+        # hashing the blob entries of a long stream takes a while, so keep it off the reactor
+        yield threads.deferToThread(self._validate)
+        if use_cache:
+            yield self.validation_cache.set_validated(self.sd_hash, stream_hash)
+        defer.returnValue(True)
+
+    def _validate(self):
         log.debug("Trying to validate stream descriptor for %s", str(self.raw_info['stream_name']))
         try:
             hex_stream_name = self.raw_info['stream_name']
@@ -133,37 +225,15 @@ class EncryptedFileStreamDescriptorValidator(object):
             if c not in '0123456789abcdef':
                 raise InvalidStreamDescriptorError(
                     "Suggested file name is not a hex-encoded string")
-        h = get_lbry_hash_obj()
-        h.update(hex_stream_name)
-        h.update(key)
-        h.update(hex_suggested_file_name)
-
-        def get_blob_hashsum(b):
-            length = b['length']
-            if length != 0:
-                blob_hash = b['blob_hash']
-            else:
-                blob_hash = None
-            blob_num = b['blob_num']
-            iv = b['iv']
-            blob_hashsum = get_lbry_hash_obj()
-            if length != 0:
-                blob_hashsum.update(blob_hash)
-            blob_hashsum.update(str(blob_num))
-            blob_hashsum.update(iv)
-            blob_hashsum.update(str(length))
-            return blob_hashsum.digest()
-
-        blobs_hashsum = get_lbry_hash_obj()
-        for blob in blobs:
-            blobs_hashsum.update(get_blob_hashsum(blob))
-        if blobs[-1]['length'] != 0:
+        if not blobs or blobs[-1]['length'] != 0:
             raise InvalidStreamDescriptorError("Does not end with a zero-length blob.")
-        h.update(blobs_hashsum.digest())
-        if h.hexdigest() != stream_hash:
+        blob_infos = ((b['blob_hash'] if b['length'] != 0 else None, b['blob_num'], b['iv'],
+                       b['length']) for b in blobs)
+        if get_stream_hash(hex_stream_name, key, hex_suggested_file_name,
+                           blob_infos) != stream_hash:
             raise InvalidStreamDescriptorError("Stream hash does not match stream metadata")
         log.debug("It is validated")
-        return defer.succeed(True)
+        return True
 
     def info_to_show(self):
         info = []
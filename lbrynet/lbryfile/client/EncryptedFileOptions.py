@@ -1,11 +1,19 @@
+import functools
+
 from lbrynet.lbryfile.StreamDescriptor import EncryptedFileStreamType
 from lbrynet.lbryfile.StreamDescriptor import EncryptedFileStreamDescriptorValidator
+from lbrynet.lbryfile.StreamDescriptor import SDValidationCache
 from lbrynet.core.DownloadOption import DownloadOption, DownloadOptionChoice
 
 
-def add_lbry_file_to_sd_identifier(sd_identifier):
-    sd_identifier.add_stream_type(
-        EncryptedFileStreamType, EncryptedFileStreamDescriptorValidator, EncryptedFileOptions())
+def add_lbry_file_to_sd_identifier(sd_identifier, stream_info_manager=None):
+    """
+    @param stream_info_manager: if given, the sd blobs that have been validated are saved
+        with it and are not validated again
+    """
+    validator = functools.partial(EncryptedFileStreamDescriptorValidator,
+                                  validation_cache=SDValidationCache(stream_info_manager))
+    sd_identifier.add_stream_type(EncryptedFileStreamType, validator, EncryptedFileOptions())
 
 
 class EncryptedFileOptions(object):
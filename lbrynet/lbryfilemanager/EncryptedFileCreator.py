@@ -8,8 +8,8 @@ import os
 from lbrynet.core.StreamDescriptor import PlainStreamDescriptorWriter
 from lbrynet.cryptstream.CryptStreamCreator import CryptStreamCreator
 from lbrynet import conf
-from lbrynet.lbryfile.StreamDescriptor import get_sd_info
-from lbrynet.core.cryptoutils import get_lbry_hash_obj
+from lbrynet.lbryfile.StreamDescriptor import get_sd_info, get_stream_hash
+from twisted.internet import threads
 from twisted.protocols.basic import FileSender
 
 
@@ -44,45 +44,22 @@ class EncryptedFileStreamCreator(CryptStreamCreator):
         d = CryptStreamCreator.setup(self)
         return d
 
-    def _get_blobs_hashsum(self):
-        blobs_hashsum = get_lbry_hash_obj()
-        for blob_info in sorted(self.blob_infos, key=lambda b_i: b_i.blob_num):
-            length = blob_info.length
-            if length != 0:
-                blob_hash = blob_info.blob_hash
-            else:
-                blob_hash = None
-            blob_num = blob_info.blob_num
-            iv = blob_info.iv
-            blob_hashsum = get_lbry_hash_obj()
-            if length != 0:
-                blob_hashsum.update(blob_hash)
-            blob_hashsum.update(str(blob_num))
-            blob_hashsum.update(iv)
-            blob_hashsum.update(str(length))
-            blobs_hashsum.update(blob_hashsum.digest())
-        return blobs_hashsum.digest()
-
     def _make_stream_hash(self):
-        hashsum = get_lbry_hash_obj()
-        hashsum.update(hexlify(self.name))
-        hashsum.update(hexlify(self.key))
-        hashsum.update(hexlify(self.suggested_file_name))
-        hashsum.update(self._get_blobs_hashsum())
-        self.stream_hash = hashsum.hexdigest()
+        blob_infos = [(b_i.blob_hash, b_i.blob_num, b_i.iv, b_i.length)
+                      for b_i in sorted(self.blob_infos, key=lambda b_i: b_i.blob_num)]
+        return get_stream_hash(hexlify(self.name), hexlify(self.key),
+                               hexlify(self.suggested_file_name), blob_infos)
+
+    def _set_stream_hash(self, stream_hash):
+        self.stream_hash = stream_hash
 
     def _finished(self):
-        self._make_stream_hash()
-        d = self._save_stream_info()
+        d = threads.deferToThread(self._make_stream_hash)
+        d.addCallback(self._set_stream_hash)
+        d.addCallback(lambda _: self._save_stream_info())
         return d
 
 
-# TODO: this should be run its own thread. Encrypting a large file can
-#       be very cpu intensive and there is no need to run that on the
-#       main reactor thread. The FileSender mechanism that is used is
-#       great when sending over the network, but this is all local so
-#       we can simply read the file from the disk without needing to
-#       involve reactor.
 def create_lbry_file(session, lbry_file_manager, file_name, file_handle, key=None,
                      iv_generator=None, suggested_file_name=None):
     """Turn a plain file into an LBRY File.
@@ -95,6 +72,9 @@ def create_lbry_file(session, lbry_file_manager, file_name, file_handle, key=Non
     into chunks and encrypted, and then a stream descriptor file with the stream parameters
     and other metadata is written to disk.
 
+    Unless the encryption_threads setting is 0, the chunks are encrypted and hashed in
+    threads rather than on the reactor. The resulting stream is the same either way.
+
     @param session: An Session object.
     @type session: Session
 
@@ -152,12 +132,12 @@ def create_lbry_file(session, lbry_file_manager, file_name, file_handle, key=Non
         suggested_file_name)
 
     def start_stream():
-        # TODO: Using FileSender isn't necessary, we can just read
-        #       straight from the disk. The stream creation process
-        #       should be in its own thread anyway so we don't need to
-        #       worry about interacting with the twisted reactor
-        file_sender = FileSender()
-        d = file_sender.beginFileTransfer(file_handle, lbry_file_creator)
+        encryption_threads = conf.settings['encryption_threads']
+        if encryption_threads > 0:
+            d = lbry_file_creator.write_file_in_threads(file_handle, encryption_threads)
+        else:
+            file_sender = FileSender()
+            d = file_sender.beginFileTransfer(file_handle, lbry_file_creator)
         d.addCallback(lambda _: stop_file(lbry_file_creator))
         d.addCallback(lambda _: make_stream_desc_file(lbry_file_creator.stream_hash))
         d.addCallback(lambda _: lbry_file_creator.stream_hash)
@@ -88,8 +88,9 @@ def get_sd_info(stream_info_manager, stream_hash, include_blobs):
 class LiveStreamDescriptorValidator(object):
     implements(IStreamDescriptorValidator)
 
-    def __init__(self, raw_info):
+    def __init__(self, raw_info, sd_hash=None):
         self.raw_info = raw_info
+        self.sd_hash = sd_hash
 
     def validate(self):
         log.debug("Trying to validate stream descriptor for %s", str(self.raw_info['stream_name']))
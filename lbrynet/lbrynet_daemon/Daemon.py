@@ -250,7 +250,7 @@ class Daemon(AuthJSONRPCServer):
         self.platform = None
         self.first_run = None
         self.log_file = conf.settings.get_log_filename()
-        self.current_db_revision = 2
+        self.current_db_revision = 3
         self.db_revision_file = conf.settings.get_db_revision_filename()
         self.session = None
         self.uploaded_temp_files = []
@@ -324,7 +324,7 @@ class Daemon(AuthJSONRPCServer):
         yield self._load_caches()
         yield self._get_session()
         yield self._get_analytics()
-        yield add_lbry_file_to_sd_identifier(self.sd_identifier)
+        yield add_lbry_file_to_sd_identifier(self.sd_identifier, self.stream_info_manager)
         yield self._setup_stream_identifier()
         yield self._setup_lbry_file_manager()
         yield self._setup_query_handlers()
@@ -2164,7 +2164,13 @@ class Daemon(AuthJSONRPCServer):
             Success/fail message
         """
 
-        if blob_hash not in self.session.blob_manager.blobs:
+        if not utils.is_valid_blobhash(blob_hash):
+            response = yield self._render_response("Don't have that blob")
+            defer.returnValue(response)
+        # the blob manager only keeps recently used blobs loaded, so ask for the
+        # blob rather than checking what is currently in memory
+        blob = yield self.session.blob_manager.get_blob(blob_hash)
+        if not blob.is_validated():
             response = yield self._render_response("Don't have that blob")
             defer.returnValue(response)
         try:
@@ -5,7 +5,9 @@ from twisted.protocols.basic import FileSender
 from twisted.internet.protocol import Protocol, ClientFactory
 from twisted.internet import defer, error
 
-from lbrynet.reflector.common import IncompleteResponse, REFLECTOR_V2
+from lbrynet.core.Error import InvalidMessageError
+from lbrynet.core.JSONFramer import JSONFramer
+from lbrynet.reflector.common import REFLECTOR_V2
 
 
 log = logging.getLogger(__name__)
@@ -16,7 +18,7 @@ class BlobReflectorClient(Protocol):
 
     def connectionMade(self):
         self.blob_manager = self.factory.blob_manager
-        self.response_buff = ''
+        self.response_framer = JSONFramer()
         self.outgoing_buff = ''
         self.blob_hashes_to_send = self.factory.blobs
         self.next_blob_to_send = None
@@ -33,13 +35,14 @@ class BlobReflectorClient(Protocol):
 
     def dataReceived(self, data):
         log.debug('Received %s', data)
-        self.response_buff += data
+        self.response_framer.feed(data)
         try:
-            msg = self.parse_response(self.response_buff)
-        except IncompleteResponse:
-            pass
-        else:
-            self.response_buff = ''
+            msg = self.response_framer.next_message()
+        except InvalidMessageError as err:
+            log.warning("Bad response from the reflector: %s", err)
+            self.transport.loseConnection()
+            return
+        if msg is not None:
             d = self.handle_response(msg)
             d.addCallback(lambda _: self.send_next_request())
             d.addErrback(self.response_failure_handler)
@@ -77,12 +80,6 @@ class BlobReflectorClient(Protocol):
         self.write(json.dumps({'version': self.protocol_version}))
         return defer.succeed(None)
 
-    def parse_response(self, buff):
-        try:
-            return json.loads(buff)
-        except ValueError:
-            raise IncompleteResponse()
-
     def response_failure_handler(self, err):
         log.warning("An error occurred handling the response: %s", err.getTraceback())
 
@@ -6,7 +6,9 @@ from twisted.protocols.basic import FileSender
 from twisted.internet.protocol import Protocol, ClientFactory
 from twisted.internet import defer, error
 
-from lbrynet.reflector.common import IncompleteResponse, ReflectorRequestError
+from lbrynet.core.Error import InvalidMessageError
+from lbrynet.core.JSONFramer import JSONFramer
+from lbrynet.reflector.common import ReflectorRequestError
 from lbrynet.reflector.common import REFLECTOR_V1, REFLECTOR_V2
 
 log = logging.getLogger(__name__)
@@ -16,7 +18,7 @@ class EncryptedFileReflectorClient(Protocol):
     #  Protocol stuff
     def connectionMade(self):
         log.debug("Connected to reflector")
-        self.response_buff = ''
+        self.response_framer = JSONFramer()
         self.outgoing_buff = ''
         self.blob_hashes_to_send = []
         self.failed_blob_hashes = []
@@ -59,13 +61,14 @@ class EncryptedFileReflectorClient(Protocol):
         return self.factory.stream_hash
 
     def dataReceived(self, data):
-        self.response_buff += data
+        self.response_framer.feed(data)
         try:
-            msg = self.parse_response(self.response_buff)
-        except IncompleteResponse:
-            pass
-        else:
-            self.response_buff = ''
+            msg = self.response_framer.next_message()
+        except InvalidMessageError as err:
+            log.warning("Bad response from the reflector: %s", err)
+            self.transport.loseConnection()
+            return
+        if msg is not None:
             d = self.handle_response(msg)
             d.addCallback(lambda _: self.send_next_request())
             d.addErrback(self.response_failure_handler)
@@ -159,12 +162,6 @@ class EncryptedFileReflectorClient(Protocol):
         d.addCallback(_save_descriptor_blob)
         return d
 
-    def parse_response(self, buff):
-        try:
-            return json.loads(buff)
-        except ValueError:
-            raise IncompleteResponse()
-
     def response_failure_handler(self, err):
         log.warning("An error occurred handling the response: %s", err.getTraceback())
 
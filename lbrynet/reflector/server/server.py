@@ -4,7 +4,8 @@ from twisted.python import failure
 from twisted.internet import error, defer
 from twisted.internet.protocol import Protocol, ServerFactory
 from lbrynet.core.utils import is_valid_blobhash
-from lbrynet.core.Error import DownloadCanceledError, InvalidBlobHashError
+from lbrynet.core.Error import DownloadCanceledError, InvalidBlobHashError, InvalidMessageError
+from lbrynet.core.JSONFramer import JSONFramer
 from lbrynet.reflector.common import REFLECTOR_V1, REFLECTOR_V2
 from lbrynet.reflector.common import ReflectorRequestError, ReflectorClientVersionError
 
@@ -38,7 +39,7 @@ class ReflectorServer(Protocol):
         self.blob_write = None
         self.blob_finished_d = None
         self.cancel_write = None
-        self.request_buff = ""
+        self.request_framer = JSONFramer(MAXIMUM_QUERY_SIZE)
 
     def connectionLost(self, reason=failure.Failure(error.ConnectionDone())):
         log.info("Reflector upload from %s finished" % self.peer.host)
@@ -102,38 +103,20 @@ class ReflectorServer(Protocol):
             self.blob_write(data)
         else:
             log.debug('Not yet recieving blob, data needs further processing')
-            self.request_buff += data
-            msg, extra_data = self._get_valid_response(self.request_buff)
+            self.request_framer.feed(data)
+            try:
+                msg = self.request_framer.next_message()
+            except InvalidMessageError as err:
+                self.handle_error(failure.Failure(err))
+                return
             if msg is not None:
-                self.request_buff = ''
+                extra_data = self.request_framer.pop_buffer()
                 d = self.handle_request(msg)
                 d.addErrback(self.handle_error)
                 if self.receiving_blob and extra_data:
                     log.debug('Writing extra data to blob')
                     self.blob_write(extra_data)
 
-    def _get_valid_response(self, response_msg):
-        extra_data = None
-        response = None
-        curr_pos = 0
-        while not self.receiving_blob:
-            next_close_paren = response_msg.find('}', curr_pos)
-            if next_close_paren != -1:
-                curr_pos = next_close_paren + 1
-                try:
-                    response = json.loads(response_msg[:curr_pos])
-                except ValueError:
-                    if curr_pos > MAXIMUM_QUERY_SIZE:
-                        raise ValueError("Error decoding response: %s" % str(response_msg))
-                    else:
-                        pass
-                else:
-                    extra_data = response_msg[curr_pos:]
-                    break
-            else:
-                break
-        return response, extra_data
-
     def need_handshake(self):
         return self.received_handshake is False
 
@@ -0,0 +1,98 @@
+"""Compare storing and reading many small blobs with DiskBlobManager and PackBlobManager
+
+Creates --blobs blobs of --size bytes with each blob manager in a fresh
+temporary directory, then reads them all back, and reports the rate of
+each phase along with the number of files and bytes used on disk. Run it from the
+root of the repository:
+
+    python scripts/benchmark_blob_managers.py --blobs 100000 --size 4096
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from lbrynet import conf
+from lbrynet.core import BlobManager
+from lbrynet.core import HashAnnouncer
+
+
+# number of blobs created concurrently
+BATCH_SIZE = 1000
+
+
+def disk_usage(path):
+    files = 0
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            files += 1
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+    return files, size
+
+
+@defer.inlineCallbacks
+def benchmark(manager_class, num_blobs, blob_size):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        blob_dir = os.path.join(tmp_dir, 'blobfiles')
+        os.makedirs(blob_dir)
+        announcer = HashAnnouncer.DummyHashAnnouncer()
+        blob_manager = manager_class(announcer, blob_dir, tmp_dir)
+        yield blob_manager.setup()
+
+        start = time.time()
+        blob_hashes = []
+        for batch_start in xrange(0, num_blobs, BATCH_SIZE):
+            ds = []
+            for i in xrange(batch_start, min(batch_start + BATCH_SIZE, num_blobs)):
+                creator = blob_manager.get_blob_creator()
+                creator.write(('%0' + str(blob_size) + 'i') % i)
+                ds.append(creator.close())
+            batch_hashes = yield defer.gatherResults(ds)
+            blob_hashes.extend(batch_hashes)
+        yield blob_manager._flush_writes()
+        create_time = time.time() - start
+
+        # read the blobs back through fresh blob objects
+        blob_manager.blobs = BlobManager.BlobCache(blob_manager.blobs.max_size)
+        start = time.time()
+        for blob_hash in blob_hashes:
+            blob = yield blob_manager.get_blob(blob_hash)
+            read_handle = blob.open_for_reading()
+            read_handle.read()
+            blob.close_read_handle(read_handle)
+        read_time = time.time() - start
+
+        yield blob_manager.stop()
+        files, size = disk_usage(blob_dir)
+        print("%s: created %.0f blobs/s, read %.0f blobs/s, %i files, %i bytes" % (
+            manager_class.__name__, num_blobs / create_time, num_blobs / read_time, files, size))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    for manager_class in (BlobManager.DiskBlobManager, BlobManager.PackBlobManager):
+        yield benchmark(manager_class, args.blobs, args.size)
+
+
+def main(args=None):
+    conf.initialize_settings(load_conf_file=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blobs', type=int, default=1000000)
+    parser.add_argument('--size', type=int, default=4096)
+    args = parser.parse_args(args)
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
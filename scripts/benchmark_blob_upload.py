@@ -0,0 +1,146 @@
+"""Measure the CPU time the blob server spends per GB uploaded
+
+Serves a --size MB blob over loopback to --clients connections at once, --rounds
+times, through ServerProtocol with an upload rate limiter whose limit (--limit MB/s)
+is set high enough not to slow the transfer, so the data goes through the request
+handler's queue the way a rate limited upload does. The clients run in the same
+process, so the CPU time includes receiving the data as well. Run it from the root
+of the repository:
+
+    python scripts/benchmark_blob_upload.py --clients 50 --rounds 10
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import StringIO
+import sys
+import time
+
+from twisted.internet import defer, protocol, task
+from twisted.protocols.basic import FileSender
+from zope.interface import implements
+
+from lbrynet import conf
+from lbrynet.core.PeerManager import PeerManager
+from lbrynet.core.RateLimiter import RateLimiter
+from lbrynet.core.server.ServerProtocol import ServerProtocolFactory
+from lbrynet.interfaces import IQueryHandlerFactory, IQueryHandler, IBlobSender
+
+
+MB = 2**20
+
+
+class BlobQueryHandlerFactory(object):
+    implements(IQueryHandlerFactory)
+
+    def __init__(self, blob):
+        self.blob = blob
+
+    def build_query_handler(self):
+        return BlobQueryHandler(self.blob)
+
+
+class BlobQueryHandler(object):
+    """Answers every blob request with the same blob, read from memory"""
+    implements(IQueryHandler, IBlobSender)
+
+    def __init__(self, blob):
+        self.blob = blob
+        self.requested = False
+
+    def register_with_request_handler(self, request_handler, peer):
+        request_handler.register_query_handler(self, ['requested_blob'])
+        request_handler.register_blob_sender(self)
+
+    def handle_queries(self, queries):
+        self.requested = 'requested_blob' in queries
+        return defer.succeed({'incoming_blob': {'blob_hash': queries['requested_blob'],
+                                                'length': len(self.blob)}})
+
+    def send_blob_if_requested(self, consumer):
+        if not self.requested:
+            return defer.succeed(True)
+        self.requested = False
+        return FileSender().beginFileTransfer(StringIO.StringIO(self.blob), consumer)
+
+    def cancel_send(self, blob_hash):
+        pass
+
+
+class BlobClient(protocol.Protocol):
+    def connectionMade(self):
+        self.received = 0
+        self.transport.write(json.dumps({'requested_blob': 'a' * 96}))
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.received >= self.factory.expected:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.finished.callback(self.received)
+
+
+class BlobClientFactory(protocol.ClientFactory):
+    protocol = BlobClient
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.finished = defer.Deferred()
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    blob = os.urandom(args.size * MB)
+    # the response which comes before the blob
+    expected = len(blob) + len(json.dumps(
+        {'incoming_blob': {'blob_hash': 'a' * 96, 'length': len(blob)}}))
+    rate_limiter = RateLimiter()
+    if args.limit:
+        rate_limiter.set_ul_limit(args.limit * MB)
+    rate_limiter.start()
+    factory = ServerProtocolFactory(
+        rate_limiter, {'blob': BlobQueryHandlerFactory(blob)}, PeerManager())
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    received = 0
+    start, start_cpu = time.time(), cpu_time()
+    for _ in range(args.rounds):
+        clients = []
+        for _ in range(args.clients):
+            client_factory = BlobClientFactory(expected)
+            reactor.connectTCP('127.0.0.1', port.getHost().port, client_factory)
+            clients.append(client_factory.finished)
+        results = yield defer.gatherResults(clients)
+        received += sum(results)
+    elapsed, cpu = time.time() - start, cpu_time() - start_cpu
+    yield port.stopListening()
+    rate_limiter.stop()
+    if received != expected * args.clients * args.rounds:
+        print("only %i of %i bytes were received" % (
+            received, expected * args.clients * args.rounds))
+    gb = float(received) / 2**30
+    print("served %.2f GB in %.1f s, %.1f s of CPU per GB" % (gb, elapsed, cpu / gb))
+
+
+def main(args=None):
+    conf.initialize_settings(load_conf_file=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2, help='size of the blob in MB')
+    parser.add_argument('--clients', type=int, default=50, help='concurrent downloads')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--limit', type=int, default=100000,
+                        help='upload limit in MB/s, 0 for no limit')
+    args = parser.parse_args(args)
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Measure the rate at which create_lbry_file turns a plain file into an encrypted stream
+
+Streams --size MB of random data through create_lbry_file into a DiskBlobManager
+in a fresh temporary directory and reports the rate in MB/s, along with the worst
+delay of a call scheduled on the reactor every 10ms. Run it from the root of the
+repository:
+
+    python scripts/benchmark_create_lbry_file.py --size 1024 --threads 4
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from lbrynet import conf
+from lbrynet.core import BlobManager
+from lbrynet.core import HashAnnouncer
+from lbrynet.lbryfile.EncryptedFileMetadataManager import DBEncryptedFileMetadataManager
+from lbrynet.lbryfilemanager import EncryptedFileCreator
+
+
+MB = 2**20
+
+
+class RepeatedFile(object):
+    """A file-like object which reads the same chunk of random data over and over"""
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+        self.chunk = os.urandom(MB)
+
+    def read(self, n):
+        n = min(n, self.size - self.position)
+        start = self.position % len(self.chunk)
+        data = self.chunk[start:start + n]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class ReactorLatency(object):
+    """Measures how late a call scheduled every interval seconds runs"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.max_delay = 0
+        self._last = None
+        self._call = task.LoopingCall(self._tick)
+
+    def start(self):
+        self._last = time.time()
+        self._call.start(self.interval, now=False)
+
+    def stop(self):
+        self._call.stop()
+
+    def _tick(self):
+        now = time.time()
+        self.max_delay = max(self.max_delay, now - self._last - self.interval)
+        self._last = now
+
+
+class FakeSession(object):
+    def __init__(self, blob_manager, db_dir):
+        self.blob_manager = blob_manager
+        self.db_dir = db_dir
+
+
+class FakeLBRYFileManager(object):
+    def __init__(self, stream_info_manager):
+        self.stream_info_manager = stream_info_manager
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        blob_dir = os.path.join(tmp_dir, 'blobfiles')
+        os.makedirs(blob_dir)
+        blob_manager = BlobManager.DiskBlobManager(
+            HashAnnouncer.DummyHashAnnouncer(), blob_dir, tmp_dir)
+        yield blob_manager.setup()
+        stream_info_manager = DBEncryptedFileMetadataManager(tmp_dir)
+        yield stream_info_manager.setup()
+        session = FakeSession(blob_manager, tmp_dir)
+
+        conf.settings['encryption_threads'] = args.threads
+        latency = ReactorLatency()
+        latency.start()
+        start = time.time()
+        yield EncryptedFileCreator.create_lbry_file(
+            session, FakeLBRYFileManager(stream_info_manager), 'benchmark.file',
+            RepeatedFile(args.size * MB))
+        elapsed = time.time() - start
+        latency.stop()
+
+        yield blob_manager.stop()
+        print("create_lbry_file: %i MB in %.1f s, %.1f MB/s, max reactor delay %.0f ms" % (
+            args.size, elapsed, args.size / elapsed, latency.max_delay * 1000))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main(args=None):
+    conf.initialize_settings(load_conf_file=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1024, help='size of the file in MB')
+    parser.add_argument('--threads', type=int, default=conf.ADJUSTABLE_SETTINGS['encryption_threads'][1],
+                        help='blobs encrypted at once, 0 to encrypt on the reactor')
+    args = parser.parse_args(args)
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
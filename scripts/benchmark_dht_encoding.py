@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+""" Measures the rate of Bencode encoding and decoding of DHT responses
+
+The messages are findValue responses carrying compact peer addresses and
+findNode responses carrying contact triples, as sent by Node (k of each by
+default). Each rate is the best of --repeat runs.
+
+Run it from the root of the repository:
+
+    python scripts/benchmark_dht_encoding.py --messages 20000
+"""
+
+import argparse
+import os
+import time
+
+from lbrynet.dht import constants
+from lbrynet.dht import encoding
+from lbrynet.dht import msgformat
+from lbrynet.dht import msgtypes
+
+
+def randomID():
+    return os.urandom(constants.key_bits / 8)
+
+
+def findValueResponse(peers):
+    key = randomID()
+    # compact ip (4 bytes) + compact port (2 bytes) + lbryid
+    compactAddresses = [os.urandom(6) + randomID() for _ in range(peers)]
+    return {key: compactAddresses, 'token': randomID()}
+
+
+def findNodeResponse(contacts):
+    return [(randomID(), '192.168.%i.%i' % (i, i), 4444) for i in range(contacts)]
+
+
+def bestTime(func, items, repeat):
+    """ Returns the shortest time taken to call func on every item """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for item in items:
+            func(item)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def benchmark(name, responses, repeat):
+    encoder = encoding.Bencode()
+    translator = msgformat.DefaultFormat()
+    primitives = [
+        translator.toPrimitive(msgtypes.ResponseMessage(os.urandom(20), randomID(), response))
+        for response in responses
+    ]
+
+    datagrams = [encoder.encode(primitive) for primitive in primitives]
+    encode_time = bestTime(encoder.encode, primitives, repeat)
+    decode_time = bestTime(encoder.decode, datagrams, repeat)
+
+    print "%s (%i bytes): encoded %.0f/s, decoded %.0f/s" % (
+        name, len(datagrams[0]), len(datagrams) / encode_time, len(datagrams) / decode_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--peers', type=int, default=constants.k,
+                        help='number of peers or contacts in each response')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    benchmark('findValue', [findValueResponse(args.peers) for _ in xrange(args.messages)],
+              args.repeat)
+    benchmark('findNode', [findNodeResponse(args.peers) for _ in xrange(args.messages)],
+              args.repeat)
+
+
+if __name__ == '__main__':
+    main()
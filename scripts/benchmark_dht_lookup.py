@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+""" Measures the latency of iterativeFindNode with the original lookup and with
+disjoint path lookups
+
+A network of nodes is started in this process, listening on localhost. Each
+node delays its responses by a few milliseconds, and --slow-fraction of them
+by up to --slow-delay seconds. The same random keys are looked up from a
+client node in each mode, one at a time.
+
+Run it from the root of the repository:
+
+    python scripts/benchmark_dht_lookup.py --nodes 50 --lookups 20
+"""
+
+import argparse
+import os
+import random
+import time
+
+from twisted.internet import defer, reactor, task
+
+from lbrynet.core import log_support  # pylint: disable=unused-import; adds log.fail()
+from lbrynet.dht import constants
+from lbrynet.dht import protocol
+from lbrynet.dht.node import Node
+
+
+class DelayedResponseProtocol(protocol.KademliaProtocol):
+    """ Sends each response after a delay, to simulate network latency """
+    def __init__(self, node, delay):
+        protocol.KademliaProtocol.__init__(self, node)
+        self.delay = delay
+
+    def _sendResponse(self, contact, rpcID, response):
+        reactor.callLater(self.delay(), protocol.KademliaProtocol._sendResponse,
+                          self, contact, rpcID, response)
+
+
+def randomID():
+    return os.urandom(constants.key_bits / 8)
+
+
+def makeNode(port, delay):
+    node = Node(udpPort=port)
+    node._protocol = DelayedResponseProtocol(node, delay)
+    return node
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@defer.inlineCallbacks
+def benchmark(args):
+    rand = random.Random(args.seed)
+
+    def fastDelay():
+        return rand.uniform(0.002, 0.02)
+
+    def slowDelay():
+        return rand.uniform(args.slow_delay / 2, args.slow_delay)
+
+    nodes = [makeNode(args.port, fastDelay)]
+    nodes[0].joinNetwork(None)
+    seed = [('127.0.0.1', args.port)]
+    for i in range(1, args.nodes):
+        delay = slowDelay if rand.random() < args.slow_fraction else fastDelay
+        node = makeNode(args.port + i, delay)
+        nodes.append(node)
+        yield node.joinNetwork(seed)
+
+    client = makeNode(args.port + args.nodes, fastDelay)
+    nodes.append(client)
+    yield client.joinNetwork(seed)
+    # let the routing tables settle
+    yield task.deferLater(reactor, 1, lambda: None)
+
+    keys = [randomID() for _ in range(args.lookups)]
+    modes = [('original', 0)] + [('%i paths' % paths, paths) for paths in args.paths]
+    for name, paths in modes:
+        client.disjointLookupPaths = paths
+        latencies = []
+        for key in keys:
+            start = time.time()
+            yield client.iterativeFindNode(key)
+            latencies.append(time.time() - start)
+        print "%s: p50 %.3fs, p99 %.3fs, max %.3fs" % (
+            name, percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies))
+
+    for node in nodes:
+        node.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--lookups', type=int, default=20)
+    parser.add_argument('--paths', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--slow-fraction', type=float, default=0.1)
+    parser.add_argument('--slow-delay', type=float, default=3.0,
+                        help='slow nodes respond after half to all of this many seconds')
+    parser.add_argument('--port', type=int, default=14000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    d = benchmark(args)
+    d.addErrback(lambda err: err.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
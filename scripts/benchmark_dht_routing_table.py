@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+""" Measures the rate of TreeRoutingTable.addContact and findCloseNodes
+
+Run it from the root of the repository:
+
+    python scripts/benchmark_dht_routing_table.py --contacts 10000
+"""
+
+import argparse
+import os
+import time
+
+from lbrynet.dht import constants
+from lbrynet.dht import routingtable
+from lbrynet.dht.contact import Contact
+
+
+class FakeRPCProtocol(object):
+    """ Fake RPC protocol; allows contacts to "send" RPCs """
+    def sendRPC(self, *args, **kwargs):
+        return FakeDeferred()
+
+
+class FakeDeferred(object):
+    """ Fake Twisted Deferred object; allows the routing table to add callbacks that do nothing """
+    def addCallback(self, *args, **kwargs):
+        return
+
+    def addErrback(self, *args, **kwargs):
+        return
+
+
+def randomID():
+    return os.urandom(constants.key_bits / 8)
+
+
+def benchmark(num_contacts, num_lookups):
+    protocol = FakeRPCProtocol()
+    table = routingtable.TreeRoutingTable(randomID())
+    contacts = [Contact(randomID(), '127.0.0.1', 4444, protocol) for _ in xrange(num_contacts)]
+    keys = [randomID() for _ in xrange(num_lookups)]
+
+    start = time.time()
+    for contact in contacts:
+        table.addContact(contact)
+    # adding contacts again only refreshes them, which is what most datagrams do
+    for contact in contacts:
+        table.addContact(contact)
+    add_time = time.time() - start
+
+    start = time.time()
+    for key in keys:
+        table.findCloseNodes(key, constants.k)
+    find_time = time.time() - start
+
+    print "%i buckets, %i contacts" % (
+        len(table._buckets), sum(len(bucket) for bucket in table._buckets))
+    print "addContact: %.0f/s" % (2 * num_contacts / add_time)
+    print "findCloseNodes: %.0f/s" % (num_lookups / find_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--contacts', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+    benchmark(args.contacts, args.lookups)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Measure how fast peer messages are split off a connection which delivers them in pieces
+
+Feeds a --size KB JSON message to the JSONFramer --chunk bytes at a time, the way a
+slow or malicious peer could send it, and compares it with what the protocols used to
+do: append each piece to a buffer and try json.loads at every closing brace received so
+far. Run it from the root of the repository:
+
+    python scripts/benchmark_json_framer.py --size 16 --chunk 64
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+from lbrynet.core.JSONFramer import JSONFramer
+
+
+def make_message(size):
+    """A message shaped like the blob infos of a stream descriptor"""
+    blobs = []
+    while len(blobs) * 200 < size * 1024:
+        blobs.append({'blob_hash': '%096x' % len(blobs), 'blob_num': len(blobs),
+                      'iv': '%032x' % len(blobs), 'length': 2097152})
+    return json.dumps({'stream_name': 'benchmark', 'blobs': blobs})
+
+
+def split(message, chunk_size):
+    return [message[i:i + chunk_size] for i in range(0, len(message), chunk_size)]
+
+
+def parse_with_buffer(chunks):
+    buff = ''
+    for chunk in chunks:
+        buff += chunk
+        curr_pos = 0
+        while True:
+            next_close_paren = buff.find('}', curr_pos)
+            if next_close_paren == -1:
+                break
+            curr_pos = next_close_paren + 1
+            try:
+                return json.loads(buff[:curr_pos])
+            except ValueError:
+                pass
+
+
+def parse_with_framer(chunks):
+    framer = JSONFramer()
+    for chunk in chunks:
+        framer.feed(chunk)
+        message = framer.next_message()
+        if message is not None:
+            return message
+
+
+def measure(parse, chunks, message_size, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        parse(chunks)
+    elapsed = time.time() - start
+    return repeat * message_size / elapsed / 2**20
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=16, help="size of the message in KB")
+    parser.add_argument('--chunk', type=int, default=64, help="bytes received at a time")
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args(args)
+    message = make_message(args.size)
+    chunks = split(message, args.chunk)
+    assert parse_with_buffer(chunks) == parse_with_framer(chunks) == json.loads(message)
+    for name, parse in (('buffer', parse_with_buffer), ('framer', parse_with_framer)):
+        print("%s: %.2f MB/s" % (name, measure(parse, chunks, len(message), args.repeat)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
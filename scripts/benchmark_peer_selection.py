@@ -0,0 +1,132 @@
+"""Measure how long streams take to download when peers are picked by score
+
+Serves blobs from one ServerProtocol through a proxy per peer, each limiting the
+upload to one of the --bandwidth values in MB/s. --streams streams of --blobs blobs
+of --size MB are then downloaded one after another, each by a ConnectionManager of
+its own which connects to up to --connections of the peers, as a stream download
+does. This is done once picking peers at random, which is what picking the first
+of the peers found in the DHT amounts to, and once picking them by their scores
+with peer_selection_epsilon set to --epsilon. Run it from the root of the repository:
+
+    python scripts/benchmark_peer_selection.py --bandwidth 1 2 4 8 16 32
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from lbrynet import conf
+from lbrynet.core.Peer import Peer
+from lbrynet.core.PeerManager import PeerManager
+from lbrynet.core.RateLimiter import DummyRateLimiter, RateLimiter
+from lbrynet.core.client.BlobRequester import BlobDownloadDetails
+from lbrynet.core.client.ClientRequest import ClientBlobRequest
+from lbrynet.core.client.ConnectionManager import ConnectionManager
+from lbrynet.core.server.ServerProtocol import ServerProtocolFactory
+from benchmark_blob_upload import BlobQueryHandlerFactory
+from benchmark_pipelining import Blob, ProxyFactory
+
+
+MB = 2**20
+
+
+class Downloader(object):
+    stream_name = 'benchmark'
+
+    def insufficient_funds(self, err):
+        pass
+
+
+class StreamRequestCreator(object):
+    """Hands out the blobs of a stream to whichever connection asks first"""
+
+    def __init__(self, blobs, peers):
+        self.blobs = list(blobs)
+        self.peers = peers
+
+    def get_new_peers(self):
+        peers = list(self.peers)
+        random.shuffle(peers)
+        return defer.succeed(peers)
+
+    def send_next_request(self, peer, protocol):
+        if not self.blobs:
+            return defer.succeed(False)
+        blob = self.blobs.pop(0)
+        details = BlobDownloadDetails(blob, blob.finished_deferred, blob.write, blob.cancel, peer)
+        request = ClientBlobRequest({'requested_blob': blob.blob_hash}, 'incoming_blob',
+                                    details.counting_write_func, blob.finished_deferred,
+                                    blob.cancel, blob)
+        blob.finished_deferred.addCallback(lambda _: peer.update_stats('blobs_downloaded', 1))
+        d = protocol.add_blob_request(request)
+        d.addCallback(lambda response: blob.set_length(response['incoming_blob']['length']))
+        return defer.succeed(True)
+
+
+@defer.inlineCallbacks
+def download_stream(peers, args):
+    blobs = [Blob('%096x' % i) for i in range(args.blobs)]
+    connection_manager = ConnectionManager(
+        Downloader(), DummyRateLimiter(), [StreamRequestCreator(blobs, peers)], [])
+    start = time.time()
+    yield connection_manager.start()
+    yield defer.gatherResults([blob.finished_deferred for blob in blobs])
+    elapsed = time.time() - start
+    yield connection_manager.stop()
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    rate_limiter = RateLimiter()
+    rate_limiter.start()
+    server_factory = ServerProtocolFactory(
+        rate_limiter, {'blob': BlobQueryHandlerFactory(os.urandom(args.size * MB))},
+        PeerManager())
+    server_port = reactor.listenTCP(0, server_factory, interface='127.0.0.1')
+    proxy_ports = [
+        reactor.listenTCP(0, ProxyFactory(server_port.getHost().port, args.rtt / 1000.0,
+                                          bandwidth * MB), interface='127.0.0.1')
+        for bandwidth in args.bandwidth]
+    conf.settings['max_connections_per_stream'] = args.connections
+    for name, epsilon in (('random', 1.0), ('scored', args.epsilon)):
+        conf.settings['peer_selection_epsilon'] = epsilon
+        # the peers start out unknown for each way of picking them
+        peers = [Peer('127.0.0.1', port.getHost().port) for port in proxy_ports]
+        times = []
+        for _ in range(args.streams):
+            elapsed = yield download_stream(peers, args)
+            times.append(elapsed)
+        later = times[len(times) / 2:]
+        print("%s peers: %.1f s in all, %.2f s per stream, %.2f s per stream in the "
+              "second half" % (name, sum(times), sum(times) / len(times),
+                               sum(later) / len(later)))
+    for port in proxy_ports:
+        yield port.stopListening()
+    yield server_port.stopListening()
+    rate_limiter.stop()
+
+
+def main(args=None):
+    conf.initialize_settings(load_conf_file=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bandwidth', type=float, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='upload bandwidth of each peer in MB/s')
+    parser.add_argument('--rtt', type=int, default=20, help='round trip time in ms')
+    parser.add_argument('--streams', type=int, default=20, help='streams to download')
+    parser.add_argument('--blobs', type=int, default=16, help='blobs per stream')
+    parser.add_argument('--size', type=int, default=1, help='size of the blobs in MB')
+    parser.add_argument('--connections', type=int, default=2,
+                        help='most connections per stream')
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    args = parser.parse_args(args)
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""Measure the download rate of blob requests over a link with a high round trip time
+
+Downloads --blobs blobs of --size MB each from a ServerProtocol over one connection,
+through a loopback proxy which delays the data by half of --rtt ms in each direction and
+limits the server's upload to --bandwidth MB/s. The download is run once without and
+once with pipelined requests, for each round trip time given. Run it from the root of
+the repository:
+
+    python scripts/benchmark_pipelining.py --rtt 100 200 300
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+from twisted.internet import defer, protocol, task
+
+from lbrynet import conf
+from lbrynet.core.Peer import Peer
+from lbrynet.core.PeerManager import PeerManager
+from lbrynet.core.RateLimiter import DummyRateLimiter, RateLimiter
+from lbrynet.core.client.ClientProtocol import ClientProtocolFactory
+from lbrynet.core.client.ClientRequest import ClientBlobRequest
+from lbrynet.core.server.ServerProtocol import ServerProtocolFactory
+from benchmark_blob_upload import BlobQueryHandlerFactory
+
+
+MB = 2**20
+
+
+class DelayedLink(object):
+    """Delivers the data written to it after a delay, no faster than the bandwidth"""
+
+    def __init__(self, reactor, deliver, delay, bandwidth=None):
+        self.reactor = reactor
+        self.deliver = deliver
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self._free_at = 0
+
+    def write(self, data):
+        sent_at = max(self.reactor.seconds(), self._free_at)
+        if self.bandwidth:
+            sent_at += float(len(data)) / self.bandwidth
+        self._free_at = sent_at
+        self.reactor.callLater(sent_at + self.delay - self.reactor.seconds(), self._deliver, data)
+
+    def _deliver(self, data):
+        self.deliver(data)
+
+
+class ProxyServerSide(protocol.Protocol):
+    """The proxy's connection to the blob server"""
+
+    def connectionMade(self):
+        self.client_side = self.factory.client_side
+        self.client_side.server_side = self
+        self.client_side.to_server.deliver = self.transport.write
+        for data in self.client_side.pending:
+            self.transport.write(data)
+
+    def dataReceived(self, data):
+        self.client_side.to_client.write(data)
+
+    def connectionLost(self, reason):
+        from twisted.internet import reactor
+        # let the data on its way reach the client first
+        reactor.callLater(self.client_side.to_client.delay + 0.1,
+                          self.client_side.transport.loseConnection)
+
+
+class ProxyClientSide(protocol.Protocol):
+    """The proxy's connection from the downloading client"""
+
+    def connectionMade(self):
+        from twisted.internet import reactor
+        self.server_side = None
+        self.pending = []
+        delay = self.factory.rtt / 2
+        self.to_server = DelayedLink(reactor, self.pending.append, delay)
+        self.to_client = DelayedLink(reactor, self.transport.write, delay, self.factory.bandwidth)
+        server_factory = protocol.ClientFactory()
+        server_factory.protocol = ProxyServerSide
+        server_factory.client_side = self
+        reactor.connectTCP('127.0.0.1', self.factory.server_port, server_factory)
+
+    def dataReceived(self, data):
+        self.to_server.write(data)
+
+    def connectionLost(self, reason):
+        if self.server_side is not None:
+            self.server_side.transport.loseConnection()
+
+
+class ProxyFactory(protocol.ServerFactory):
+    protocol = ProxyClientSide
+
+    def __init__(self, server_port, rtt, bandwidth):
+        self.server_port = server_port
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+
+
+class Blob(object):
+    def __init__(self, blob_hash):
+        self.blob_hash = blob_hash
+        self.length = None
+        self.received = 0
+        self.finished_deferred = defer.Deferred()
+
+    def set_length(self, length):
+        self.length = length
+        return True
+
+    def write(self, data):
+        self.received += len(data)
+        if self.received == self.length:
+            self.finished_deferred.callback(self)
+
+    def cancel(self, err):
+        if not self.finished_deferred.called:
+            self.finished_deferred.errback(err)
+
+
+class BlobConnectionManager(object):
+    """Requests each of the blobs from the peer in turn"""
+
+    def __init__(self, blobs):
+        self.blobs = list(blobs)
+
+    def get_next_request(self, peer, protocol):
+        if not self.blobs:
+            return defer.succeed(False)
+        blob = self.blobs.pop(0)
+        request = ClientBlobRequest({'requested_blob': blob.blob_hash}, 'incoming_blob',
+                                    blob.write, blob.finished_deferred, blob.cancel, blob)
+        d = protocol.add_blob_request(request)
+        d.addCallback(lambda response: blob.set_length(response['incoming_blob']['length']))
+        return defer.succeed(True)
+
+
+@defer.inlineCallbacks
+def download(reactor, proxy_port, args):
+    blobs = [Blob('%096x' % i) for i in range(args.blobs)]
+    factory = ClientProtocolFactory(
+        Peer('127.0.0.1', proxy_port), DummyRateLimiter(), BlobConnectionManager(blobs))
+    start = time.time()
+    reactor.connectTCP('127.0.0.1', proxy_port, factory)
+    yield defer.gatherResults([blob.finished_deferred for blob in blobs])
+    elapsed = time.time() - start
+    yield factory.connection_was_made_deferred
+    defer.returnValue(args.blobs * args.size / elapsed)
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    rate_limiter = RateLimiter()
+    rate_limiter.start()
+    server_factory = ServerProtocolFactory(
+        rate_limiter, {'blob': BlobQueryHandlerFactory(os.urandom(args.size * MB))},
+        PeerManager())
+    server_port = reactor.listenTCP(0, server_factory, interface='127.0.0.1')
+    for rtt in args.rtt:
+        proxy_port = reactor.listenTCP(
+            0, ProxyFactory(server_port.getHost().port, rtt / 1000.0, args.bandwidth * MB),
+            interface='127.0.0.1')
+        rates = []
+        for pipelining in (False, True):
+            conf.settings['pipeline_blob_requests'] = pipelining
+            rate = yield download(reactor, proxy_port.getHost().port, args)
+            rates.append(rate)
+        yield proxy_port.stopListening()
+        print("rtt %i ms: %.2f MB/s without pipelining, %.2f MB/s with pipelining" % (
+            rtt, rates[0], rates[1]))
+    yield server_port.stopListening()
+    rate_limiter.stop()
+
+
+def main(args=None):
+    conf.initialize_settings(load_conf_file=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rtt', type=int, nargs='+', default=[100, 200, 300],
+                        help='round trip times to test, in ms')
+    parser.add_argument('--bandwidth', type=int, default=10, help='link bandwidth in MB/s')
+    parser.add_argument('--size', type=int, default=2, help='size of the blobs in MB')
+    parser.add_argument('--blobs', type=int, default=20, help='blobs to download')
+    args = parser.parse_args(args)
+    task.react(run, (args,))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -122,6 +122,9 @@ class Announcer(object):
     def hash_queue_size(self):
         return 0
 
+    def hash_announce_duration(self):
+        return 0
+
     def add_supplier(self, supplier):
         pass
 
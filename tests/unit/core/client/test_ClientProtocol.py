@@ -0,0 +1,185 @@
+import json
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from lbrynet.core import utils
+from lbrynet.core.JSONFramer import JSONFramer
+from lbrynet.core.Error import DownloadCanceledError
+from lbrynet.core.Peer import Peer
+from lbrynet.core.client.ClientProtocol import ClientProtocol
+from lbrynet.core.client.ClientRequest import ClientBlobRequest
+from tests.mocks import mock_conf_settings
+
+
+class FakeBlob(object):
+    def __init__(self, blob_hash):
+        self.blob_hash = blob_hash
+        self.length = None
+        self.data = ''
+        self.finished_deferred = defer.Deferred()
+
+    def set_length(self, length):
+        self.length = length
+        return True
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) == self.length:
+            self.finished_deferred.callback(self)
+
+    def cancel(self, err):
+        self.finished_deferred.errback(err)
+
+
+class FakeRateLimiter(object):
+    def report_dl_bytes(self, num_bytes):
+        pass
+
+
+class FakeConnectionManager(object):
+    """Hands out a request for each blob, in order"""
+    def __init__(self, blobs):
+        self.blobs = list(blobs)
+
+    def get_next_request(self, peer, protocol):
+        if not self.blobs:
+            return defer.succeed(False)
+        blob = self.blobs.pop(0)
+        request = ClientBlobRequest({'requested_blob': blob.blob_hash}, 'incoming_blob',
+                                    blob.write, blob.finished_deferred, blob.cancel, blob)
+        d = protocol.add_blob_request(request)
+        d.addCallback(self._set_length, blob)
+        return defer.succeed(True)
+
+    def _set_length(self, response, blob):
+        if 'error' not in response['incoming_blob']:
+            blob.set_length(response['incoming_blob']['length'])
+
+
+class FakeFactory(object):
+    def __init__(self, connection_manager):
+        self.connection_manager = connection_manager
+        self.rate_limiter = FakeRateLimiter()
+        self.peer = Peer('127.0.0.1', 3333)
+        self.connection_was_made_deferred = defer.Deferred()
+
+
+class ClientProtocolPipeliningTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.clock = task.Clock()
+        call_later = utils.call_later
+        utils.call_later = self.clock.callLater
+        self.addCleanup(setattr, utils, 'call_later', call_later)
+        self.blobs = [FakeBlob('a'), FakeBlob('b')]
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = ClientProtocol()
+        self.protocol.factory = FakeFactory(FakeConnectionManager(self.blobs))
+        self.protocol.makeConnection(self.transport)
+
+    def _sent_requests(self):
+        framer = JSONFramer()
+        framer.feed(self.transport.value())
+        requests = []
+        while len(framer):
+            requests.append(framer.next_message())
+        return requests
+
+    def _response(self, blob_hash, length, **kwargs):
+        kwargs['incoming_blob'] = {'blob_hash': blob_hash, 'length': length}
+        return json.dumps(kwargs)
+
+    def test_next_request_is_sent_while_blob_downloads(self):
+        self.assertEqual(self._sent_requests(), [
+            {'requested_blob': 'a', 'pipelining': True, 'blob_cancelling': True}])
+        self.protocol.dataReceived(self._response('a', 10, pipelining=True) + 'a' * 4)
+        self.assertEqual(self._sent_requests()[1:], [{'requested_blob': 'b'}])
+        self.protocol.dataReceived('a' * 6 + self._response('b', 5) + 'b' * 5)
+        self.assertEqual(self.blobs[0].data, 'a' * 10)
+        self.assertEqual(self.blobs[1].data, 'b' * 5)
+        self.successResultOf(self.blobs[1].finished_deferred)
+        # there is nothing left to download
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_server_without_pipelining(self):
+        self.protocol.dataReceived(self._response('a', 10) + 'a' * 4)
+        self.assertEqual(len(self._sent_requests()), 1)
+        self.protocol.dataReceived('a' * 6)
+        self.assertEqual(self._sent_requests()[1:], [{'requested_blob': 'b'}])
+        self.protocol.dataReceived(self._response('b', 5) + 'b' * 5)
+        self.assertEqual(self.blobs[1].data, 'b' * 5)
+        self.assertTrue(self.transport.disconnecting)
+
+
+class ClientProtocolCancelTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.clock = task.Clock()
+        call_later = utils.call_later
+        utils.call_later = self.clock.callLater
+        self.addCleanup(setattr, utils, 'call_later', call_later)
+        self.blobs = [FakeBlob('a'), FakeBlob('b'), FakeBlob('c')]
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = ClientProtocol()
+        self.protocol.factory = FakeFactory(FakeConnectionManager(self.blobs))
+        self.protocol.makeConnection(self.transport)
+        response = {'incoming_blob': {'blob_hash': 'a', 'length': 100}, 'pipelining': True,
+                    'blob_cancelling': True}
+        self.protocol.dataReceived(json.dumps(response) + 'a' * 4)
+        self.transport.clear()
+
+    def _sent_requests(self):
+        framer = JSONFramer()
+        framer.feed(self.transport.value())
+        requests = []
+        while len(framer):
+            requests.append(framer.next_message())
+        return requests
+
+    def _response(self, blob_hash, length):
+        return json.dumps({'incoming_blob': {'blob_hash': blob_hash, 'length': length}})
+
+    def test_downloading_blob_is_skipped_by_its_length(self):
+        self.blobs[0].cancel(failure.Failure(DownloadCanceledError()))
+        # the server sends all of the blob, so it isn't asked to stop
+        self.assertEqual(self.transport.value(), '')
+        self.assertFalse(self.transport.disconnecting)
+        # blob data which looks like a response isn't mistaken for one
+        fake_response = json.dumps({'cancelled_blob': 'a'}) + self._response('c', 1)
+        self.protocol.dataReceived(fake_response)
+        self.protocol.dataReceived('a' * (96 - len(fake_response)))
+        self.protocol.dataReceived(self._response('b', 5) + 'b' * 5)
+        self.assertEqual(self.blobs[0].data, 'a' * 4)
+        self.assertEqual(self.blobs[1].data, 'b' * 5)
+        self.successResultOf(self.blobs[1].finished_deferred)
+
+    def test_acknowledgement_is_ignored(self):
+        self.blobs[0].cancel(failure.Failure(DownloadCanceledError()))
+        self.protocol.dataReceived('a' * 96 + json.dumps({'cancelled_blob': 'a'}))
+        self.protocol.dataReceived(self._response('b', 5) + 'b' * 5)
+        self.assertEqual(self.blobs[1].data, 'b' * 5)
+        self.successResultOf(self.blobs[1].finished_deferred)
+
+    def test_cancel_before_the_response(self):
+        self.blobs[1].cancel(failure.Failure(DownloadCanceledError()))
+        self.assertEqual(json.loads(self.transport.value()), {'cancel_blob': {'blob_hash': 'b'}})
+        cancelled = json.dumps({'incoming_blob': {'error': 'BLOB_CANCELLED'}})
+        self.protocol.dataReceived('a' * 96 + cancelled)
+        self.assertEqual(self.blobs[0].data, 'a' * 100)
+        self.assertEqual(self.blobs[1].data, '')
+        self.assertFalse(self.transport.disconnecting)
+        # the connection is used for the next blob
+        self.assertEqual(self._sent_requests()[1:], [{'requested_blob': 'c'}])
+        self.protocol.dataReceived(json.dumps({'cancelled_blob': 'b'}) + self._response('c', 5) +
+                                   'c' * 5)
+        self.assertEqual(self.blobs[2].data, 'c' * 5)
+        self.successResultOf(self.blobs[2].finished_deferred)
+
+    def test_cancelled_blob_is_skipped_if_the_server_sends_it(self):
+        self.blobs[1].cancel(failure.Failure(DownloadCanceledError()))
+        self.protocol.dataReceived('a' * 96 + self._response('b', 5) + 'b' * 5)
+        self.assertEqual(self.blobs[1].data, '')
+        self.assertFalse(self.transport.disconnecting)
@@ -0,0 +1,91 @@
+import binascii
+
+import mock
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from lbrynet.core.PeerManager import PeerManager
+from lbrynet.core.client.DHTPeerFinder import DHTPeerFinder
+
+
+class MocDHTNode(object):
+    def __init__(self):
+        self.lookups = []
+
+    def getPeersForBlob(self, bin_hash):
+        d = defer.Deferred()
+        self.lookups.append((bin_hash, d))
+        return d
+
+
+class DHTPeerFinderTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        time_patcher = mock.patch('time.time', lambda: self.now)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.dht_node = MocDHTNode()
+        self.peer_finder = DHTPeerFinder(self.dht_node, PeerManager())
+        self.blob_hash = 'aa' * 48
+        self.bin_hash = binascii.unhexlify(self.blob_hash)
+
+    def _finish_lookup(self, peers):
+        bin_hash, d = self.dht_node.lookups[-1]
+        d.callback(peers)
+
+    def _hosts(self, peers):
+        return [(peer.host, peer.port) for peer in peers]
+
+    def test_concurrent_searches_share_a_lookup(self):
+        first = self.peer_finder.find_peers_for_blob(self.blob_hash)
+        second = self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self.assertEqual(len(self.dht_node.lookups), 1)
+        self._finish_lookup([('1.2.3.4', 3333)])
+        self.assertEqual(self._hosts(self.successResultOf(first)), [('1.2.3.4', 3333)])
+        self.assertEqual(self._hosts(self.successResultOf(second)), [('1.2.3.4', 3333)])
+        stats = self.peer_finder.get_cache_stats()
+        self.assertEqual((stats['misses'], stats['coalesced'], stats['hits']), (1, 1, 0))
+
+    def test_results_are_cached(self):
+        self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self._finish_lookup([('1.2.3.4', 3333)])
+        self.now += DHTPeerFinder.PEER_CACHE_TIME - 1
+        d = self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self.assertEqual(self._hosts(self.successResultOf(d)), [('1.2.3.4', 3333)])
+        self.assertEqual(len(self.dht_node.lookups), 1)
+        self.assertEqual(self.peer_finder.get_cache_stats()['hit_rate'], 0.5)
+
+        self.now += 2
+        self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self.assertEqual(len(self.dht_node.lookups), 2)
+
+    def test_empty_results_expire_sooner(self):
+        self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self._finish_lookup([])
+        self.now += DHTPeerFinder.EMPTY_PEER_CACHE_TIME - 1
+        self.assertEqual(self.successResultOf(
+            self.peer_finder.find_peers_for_blob(self.blob_hash)), [])
+        self.assertEqual(len(self.dht_node.lookups), 1)
+        self.now += 2
+        self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self.assertEqual(len(self.dht_node.lookups), 2)
+
+    def test_failed_lookups_are_cached_as_empty(self):
+        d = self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self.dht_node.lookups[-1][1].errback(Exception('lookup failed'))
+        self.assertEqual(self.successResultOf(d), [])
+        self.now += DHTPeerFinder.EMPTY_PEER_CACHE_TIME - 1
+        self.assertEqual(self.successResultOf(
+            self.peer_finder.find_peers_for_blob(self.blob_hash)), [])
+        self.assertEqual(len(self.dht_node.lookups), 1)
+        self.now += 2
+        self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self.assertEqual(len(self.dht_node.lookups), 2)
+
+    def test_expired_entries_are_purged(self):
+        self.peer_finder.find_peers_for_blob(self.blob_hash)
+        self._finish_lookup([('1.2.3.4', 3333)])
+        self.assertEqual(self.peer_finder.get_cache_stats()['cached_blobs'], 1)
+        self.now += DHTPeerFinder.PEER_CACHE_TIME
+        self.peer_finder._manage_peers()
+        self.assertEqual(self.peer_finder.get_cache_stats()['cached_blobs'], 0)
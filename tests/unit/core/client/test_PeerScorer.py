@@ -0,0 +1,51 @@
+import mock
+from twisted.trial import unittest
+
+from lbrynet.core.Peer import Peer
+from lbrynet.core.client.PeerScorer import PeerScorer
+
+
+class PeerScorerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        time_patcher = mock.patch('time.time', lambda: self.now)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.scorer = PeerScorer()
+        self.slow = Peer('10.0.0.1', 3333)
+        self.fast = Peer('10.0.0.2', 3333)
+        self.new = Peer('10.0.0.3', 3333)
+        self.slow.report_download_rate(100.0)
+        self.fast.report_download_rate(300.0)
+
+    def test_fastest_peer_is_picked(self):
+        peers = [self.slow, self.new, self.fast]
+        self.assertEqual(self.scorer.pick(peers, 0), self.fast)
+        self.assertEqual(self.scorer.average_rate(peers), 200.0)
+        self.assertEqual(self.scorer.expected_rate(self.new, 200.0), 200.0)
+        self.assertEqual(self.scorer.pick([], 0), None)
+
+    def test_rate_is_averaged(self):
+        self.slow.report_download_rate(200.0)
+        self.assertAlmostEqual(self.slow.download_rate, 130.0)
+
+    def test_old_measurements_count_less(self):
+        self.now += PeerScorer.RATE_HALF_LIFE
+        self.assertEqual(self.scorer.expected_rate(self.slow, 200.0), 150.0)
+        self.slow.report_download_rate(100.0)
+        self.assertEqual(self.scorer.expected_rate(self.slow, 200.0), 100.0)
+
+    def test_failures_lower_the_score(self):
+        self.fast.update_stats('blobs_downloaded', 1)
+        self.fast.update_stats('blob_downloads_failed', 5)
+        self.assertAlmostEqual(self.scorer.reliability(self.fast), 2 / 7.0)
+        self.assertEqual(self.scorer.pick([self.slow, self.fast], 0), self.slow)
+        self.slow.update_stats('price_disagreements', 2)
+        self.assertEqual(self.scorer.pick([self.slow, self.fast], 0), self.fast)
+
+    def test_random_peer_with_probability_epsilon(self):
+        with mock.patch('random.random', lambda: 0.05):
+            with mock.patch('random.choice', lambda peers: peers[0]):
+                self.assertEqual(self.scorer.pick([self.slow, self.fast], 0.1), self.slow)
+        with mock.patch('random.random', lambda: 0.5):
+            self.assertEqual(self.scorer.pick([self.slow, self.fast], 0.1), self.fast)
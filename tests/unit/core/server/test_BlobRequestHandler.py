@@ -1,4 +1,7 @@
+import os
+import shutil
 import StringIO
+import tempfile
 
 import mock
 from twisted.internet import defer
@@ -83,6 +86,37 @@ class TestBlobRequestHandlerQueries(unittest.TestCase):
         }
         self.assertEqual(response, self.successResultOf(deferred))
 
+    def test_error_set_when_blob_was_cancelled(self):
+        self.handler.cancel_send('blob')
+        query = {
+            'blob_data_payment_rate': 1.0,
+            'requested_blob': 'blob'
+        }
+        deferred = self.handler.handle_queries(query)
+        response = {
+            'blob_data_payment_rate': 'RATE_ACCEPTED',
+            'incoming_blob': {'error': 'BLOB_CANCELLED'}
+        }
+        self.assertEqual(response, self.successResultOf(deferred))
+        self.assertFalse(self.blob_manager.get_blob.called)
+
+    def test_cancel_only_applies_to_the_next_request(self):
+        self.handler.cancel_send('blob')
+        self.handler.send_blob_if_requested(None)
+        blob = mock.Mock()
+        blob.is_validated.return_value = False
+        self.blob_manager.get_blob.return_value = defer.succeed(blob)
+        query = {
+            'blob_data_payment_rate': 1.0,
+            'requested_blob': 'blob'
+        }
+        deferred = self.handler.handle_queries(query)
+        response = {
+            'blob_data_payment_rate': 'RATE_ACCEPTED',
+            'incoming_blob': {'error': 'BLOB_UNAVAILABLE'}
+        }
+        self.assertEqual(response, self.successResultOf(deferred))
+
     def test_blob_details_are_set_when_all_conditions_are_met(self):
         blob = mock.Mock()
         blob.is_validated.return_value = True
@@ -129,3 +163,56 @@ class TestBlobRequestHandlerSender(unittest.TestCase):
         while consumer.producer:
             consumer.producer.resumeProducing()
         self.assertEqual(consumer.value(), 'test')
+
+
+class DirectWriteConsumer(proto_helpers.StringTransport):
+    def __init__(self, can_write_directly):
+        proto_helpers.StringTransport.__init__(self)
+        self._can_write_directly = can_write_directly
+
+    def can_write_directly(self):
+        return self._can_write_directly
+
+
+class TestBlobRequestHandlerMappedSender(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = os.urandom(BlobRequestHandler.MappedFileSender.CHUNK_SIZE * 2 + 10)
+        self.file_path = os.path.join(self.tmp_dir, 'blob')
+        with open(self.file_path, 'wb') as f:
+            f.write(self.data)
+        self.handler = BlobRequestHandler.BlobRequestHandler(None, None, None, analytics.Track())
+        self.handler.peer = mock.create_autospec(Peer.Peer)
+        self.handler.currently_uploading = mock.Mock()
+        self.handler.currently_uploading.length = len(self.data)
+        self.read_handle = open(self.file_path, 'rb')
+        self.handler.read_handle = self.read_handle
+
+    def tearDown(self):
+        self.read_handle.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _send(self, consumer):
+        self.handler.send_blob_if_requested(consumer)
+        sender = self.handler.file_sender
+        writes = 0
+        while consumer.producer:
+            consumer.producer.resumeProducing()
+            writes += 1
+        return sender, writes
+
+    def test_file_is_mapped_when_consumer_can_take_it(self):
+        consumer = DirectWriteConsumer(True)
+        sender, writes = self._send(consumer)
+        self.assertIsInstance(sender, BlobRequestHandler.MappedFileSender)
+        self.assertEqual(4, writes)
+        self.assertEqual(self.data, consumer.value())
+        uploaded = sum(call[0][1] for call in self.handler.peer.update_stats.call_args_list
+                       if call[0][0] == 'blob_bytes_uploaded')
+        self.assertEqual(len(self.data), uploaded)
+
+    def test_file_sender_is_used_when_upload_is_limited(self):
+        consumer = DirectWriteConsumer(False)
+        sender, _ = self._send(consumer)
+        self.assertNotIsInstance(sender, BlobRequestHandler.MappedFileSender)
+        self.assertEqual(self.data, consumer.value())
@@ -1,5 +1,6 @@
 import os
 import binascii
+import mock
 from twisted.trial import unittest
 from twisted.internet import defer,task
 from lbrynet.core import log_support, utils
@@ -9,10 +10,17 @@ class MocDHTNode(object):
     def __init__(self):
         self.blobs_announced = 0
 
+        self.calls = 0
+
     def announceHaveBlob(self,blob,port):
         self.blobs_announced += 1
         return defer.succeed(True)
 
+    def announceHaveBlobs(self, blobs, port):
+        self.blobs_announced += len(blobs)
+        self.calls += 1
+        return defer.succeed(dict((blob, 1) for blob in blobs))
+
 class MocSupplier(object):
     def __init__(self, blobs_to_announce):
         self.blobs_to_announce = blobs_to_announce
@@ -24,6 +32,17 @@ class MocSupplier(object):
         else:
             return defer.succeed([])
 
+class BatchedMocSupplier(object):
+    def __init__(self, blobs_to_announce, batch_size):
+        self.blobs_to_announce = list(blobs_to_announce)
+        self.batch_size = batch_size
+        self.calls = 0
+    def hashes_to_announce(self):
+        self.calls += 1
+        batch = self.blobs_to_announce[:self.batch_size]
+        del self.blobs_to_announce[:self.batch_size]
+        return defer.succeed(batch)
+
 class DHTHashAnnouncerTest(unittest.TestCase):
 
     def setUp(self):
@@ -36,6 +55,7 @@ class DHTHashAnnouncerTest(unittest.TestCase):
         utils.call_later = self.clock.callLater
         from lbrynet.core.server.DHTHashAnnouncer import DHTHashAnnouncer,DHTHashSupplier
         self.announcer = DHTHashAnnouncer(self.dht_node, peer_port=3333)
+        self.announcer.ANNOUNCE_GROUP_SIZE = 1
         self.supplier = MocSupplier(self.blobs_to_announce)
         self.announcer.add_supplier(self.supplier)
 
@@ -54,3 +74,69 @@ class DHTHashAnnouncerTest(unittest.TestCase):
         self.assertEqual(self.announcer.hash_queue_size(),self.announcer.CONCURRENT_ANNOUNCERS+1)
         self.assertEqual(blob_hash, self.announcer.hash_queue[0][0])
 
+
+    def test_groups(self):
+        self.announcer.ANNOUNCE_GROUP_SIZE = 4
+        d = self.announcer._announce_available_hashes()
+        self.assertEqual(self.dht_node.blobs_announced, self.num_blobs)
+        self.assertEqual(self.dht_node.calls, 3)
+        self.assertEqual(self.announcer.hash_queue_size(), 0)
+        return d
+
+    def test_next_batch_is_fetched_when_the_queue_runs_low(self):
+        self.announcer.suppliers = []
+        self.announcer.CONCURRENT_ANNOUNCERS = 1
+        self.announcer.ANNOUNCE_QUEUE_REFILL_SIZE = 2
+        supplier = BatchedMocSupplier(self.blobs_to_announce, 3)
+        self.announcer.add_supplier(supplier)
+        d = self.announcer._announce_available_hashes()
+        # only one batch is fetched at a time
+        self.assertEqual(supplier.calls, 1)
+        self.assertEqual(self.announcer.hash_queue_size(), 2)
+        self.clock.advance(0)
+        self.assertEqual(self.dht_node.blobs_announced, self.num_blobs)
+        self.assertEqual(supplier.calls, 5)
+        return d
+
+    @mock.patch('time.time')
+    def test_announce_duration_is_measured(self, time_mock):
+        time_mock.side_effect = self.clock.seconds
+        self.assertEqual(self.announcer.hash_announce_duration(),
+                         self.announcer.SINGLE_HASH_ANNOUNCE_DURATION)
+        self.announcer.ANNOUNCE_GROUP_SIZE = 5
+        self.announcer.CONCURRENT_ANNOUNCERS = 1
+        self.dht_node.announceHaveBlobs = lambda blobs, port: task.deferLater(
+            self.clock, 2, lambda: dict((blob, 1) for blob in blobs))
+        self.announcer._announce_available_hashes()
+        self.clock.pump([2, 0, 2])
+        self.assertAlmostEqual(self.announcer.hash_announce_duration(), 0.4)
+
+    @mock.patch('lbrynet.core.server.DHTHashAnnouncer.log')
+    def test_queue_length_warning_is_logged_once_per_cycle(self, log_mock):
+        self.announcer.CONCURRENT_ANNOUNCERS = 0
+        with mock.patch('lbrynet.dht.constants.dataExpireTimeout', 1):
+            for _ in range(3):
+                self.announcer.immediate_announce([binascii.b2a_hex(os.urandom(32))])
+            self.assertEqual(log_mock.warning.call_count, 1)
+            self.announcer._announce_available_hashes()
+            self.assertEqual(log_mock.warning.call_count, 2)
+
+    def test_sorted(self):
+        self.announcer.CONCURRENT_ANNOUNCERS = 0
+        self.announcer._announce_available_hashes()
+        queued = [h for h, _ in self.announcer.hash_queue]
+        self.assertEqual(queued, sorted(self.blobs_to_announce))
+
+    @mock.patch('time.time')
+    def test_announce_rate(self, time_mock):
+        time_mock.side_effect = self.clock.seconds
+        self.announcer.announce_rate = 2
+        self.announcer.CONCURRENT_ANNOUNCERS = 1
+        self.announcer._announce_available_hashes()
+        self.assertEqual(self.dht_node.blobs_announced, 1)
+        self.clock.advance(0)
+        self.assertEqual(self.dht_node.blobs_announced, 1)
+        self.clock.advance(0.5)
+        self.assertEqual(self.dht_node.blobs_announced, 2)
+        self.clock.advance(1)
+        self.assertEqual(self.dht_node.blobs_announced, 4)
@@ -0,0 +1,170 @@
+import json
+
+import mock
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from lbrynet.core.server.ServerRequestHandler import ServerRequestHandler
+from tests.mocks import mock_conf_settings
+
+
+class FakeConsumer(object):
+    def __init__(self, upload_limited=False):
+        self.upload_limited = upload_limited
+        self.written = []
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_upload_limited(self):
+        return self.upload_limited
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.resumed = 0
+
+    def resumeProducing(self):
+        self.resumed += 1
+
+    def stopProducing(self):
+        pass
+
+
+class TestServerRequestHandlerQueue(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.clock = task.Clock()
+        reactor_patcher = mock.patch('twisted.internet.reactor', self.clock)
+        reactor_patcher.start()
+        self.addCleanup(reactor_patcher.stop)
+
+    def _make_handler(self, upload_limited=False):
+        consumer = FakeConsumer(upload_limited)
+        handler = ServerRequestHandler(consumer)
+        handler.CHUNK_SIZE = 4
+        producer = FakeProducer()
+        handler.producer = producer
+        return handler, consumer, producer
+
+    def test_queued_data_is_written_in_one_piece(self):
+        handler, consumer, producer = self._make_handler()
+        handler.pauseProducing()
+        handler.write('abcdefghij')
+        handler.write('klm')
+        self.clock.advance(0)
+        self.assertEqual(consumer.written, [])
+        self.assertEqual(producer.resumed, 0)
+        handler.resumeProducing()
+        self.assertEqual(consumer.written, ['abcdefghij', 'klm'])
+        self.clock.advance(0)
+        self.assertEqual(producer.resumed, 1)
+
+    def test_limited_upload_is_written_a_chunk_per_turn(self):
+        handler, consumer, producer = self._make_handler(upload_limited=True)
+        handler.write('abcdefghij')
+        self.assertEqual(consumer.written, ['abcd'])
+        # the rest is written later, and the producer isn't asked for more until then
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(consumer.written, ['abcd', 'efgh', 'ij'])
+        self.assertEqual(producer.resumed, 1)
+
+    def test_pause_stops_writing(self):
+        handler, consumer, producer = self._make_handler(upload_limited=True)
+        handler.write('abcdefghij')
+        handler.pauseProducing()
+        self.clock.advance(0)
+        self.assertEqual(consumer.written, ['abcd'])
+        handler.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(''.join(consumer.written), 'abcdefghij')
+
+    def test_stop_clears_the_queue(self):
+        handler, consumer, producer = self._make_handler(upload_limited=True)
+        handler.write('abcdefghij')
+        handler.stopProducing()
+        self.clock.advance(0)
+        self.assertEqual(consumer.written, ['abcd'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class FakeQueryHandler(object):
+    def __init__(self):
+        self.queries = []
+
+    def handle_queries(self, queries):
+        self.queries.append(queries)
+        return defer.succeed({'incoming_blob': {'blob_hash': queries['requested_blob']}})
+
+
+class FakeBlobSender(object):
+    def __init__(self):
+        self.sending = None
+        self.cancelled = []
+
+    def send_blob_if_requested(self, consumer):
+        self.sending = defer.Deferred()
+        return self.sending
+
+    def cancel_send(self, blob_hash):
+        self.cancelled.append(blob_hash)
+
+
+class TestServerRequestHandlerPipelining(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.consumer = FakeConsumer()
+        self.handler = ServerRequestHandler(self.consumer)
+        self.query_handler = FakeQueryHandler()
+        self.blob_sender = FakeBlobSender()
+        self.handler.register_query_handler(self.query_handler, ['requested_blob'])
+        self.handler.register_blob_sender(self.blob_sender)
+
+    def test_requests_are_handled_in_turn(self):
+        self.handler.data_received(
+            json.dumps({'requested_blob': 'a', 'pipelining': True}) +
+            json.dumps({'requested_blob': 'b'}))
+        self.assertEqual(self.query_handler.queries, [{'requested_blob': 'a'}])
+        self.assertEqual(json.loads(self.consumer.written[0]),
+                         {'incoming_blob': {'blob_hash': 'a'}, 'pipelining': True})
+        self.blob_sender.sending.callback(True)
+        self.assertEqual(self.query_handler.queries,
+                         [{'requested_blob': 'a'}, {'requested_blob': 'b'}])
+        self.assertEqual(json.loads(self.consumer.written[1]),
+                         {'incoming_blob': {'blob_hash': 'b'}})
+
+    def test_cancel_applies_to_the_requests_received_before_it(self):
+        self.handler.data_received(
+            json.dumps({'requested_blob': 'a'}) + json.dumps({'requested_blob': 'b'}))
+        self.handler.write('aaaa')
+        self.handler.data_received(json.dumps({'cancel_blob': {'blob_hash': 'b'}}))
+        self.assertEqual(self.blob_sender.cancelled, [])
+        self.blob_sender.sending.callback(True)
+        # the sender is told before the request for the blob is handled
+        self.assertEqual(self.blob_sender.cancelled, ['b'])
+        self.assertEqual(self.consumer.written[1], 'aaaa')
+        self.assertEqual(json.loads(self.consumer.written[2]),
+                         {'incoming_blob': {'blob_hash': 'b'}})
+        self.blob_sender.sending.callback(True)
+        self.assertEqual(self.consumer.written[3:], [json.dumps({'cancelled_blob': 'b'})])
+
+    def test_blob_being_sent_is_sent_in_full(self):
+        self.handler.data_received(json.dumps({'requested_blob': 'a'}))
+        self.handler.data_received(json.dumps({'cancel_blob': {'blob_hash': 'a'}}))
+        self.assertEqual(len(self.consumer.written), 1)
+        self.handler.write('aaaa')
+        self.blob_sender.sending.callback(True)
+        self.assertEqual(self.blob_sender.cancelled, [])
+        self.assertEqual(self.consumer.written[1:], ['aaaa', json.dumps({'cancelled_blob': 'a'})])
+
+    def test_invalid_cancel(self):
+        self.handler.data_received(json.dumps({'cancel_blob': {'blob_hash': 1}}))
+        self.assertEqual(self.consumer.written, [])
+        self.assertTrue(self.handler.production_paused)
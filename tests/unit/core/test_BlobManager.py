@@ -0,0 +1,487 @@
+import gc
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from lbrynet.core import BlobManager, utils
+from lbrynet.core.cryptoutils import get_lbry_hash_obj
+from lbrynet.core.server.DHTHashAnnouncer import DHTHashAnnouncer
+
+from tests.mocks import mock_conf_settings
+from lbrynet.core.HashBlob import TempBlob
+
+
+def make_blob_hash(n):
+    return ('%02x' % n) * 48
+
+
+class BlobCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = BlobManager.BlobCache(3)
+
+    def add_blobs(self, count):
+        blobs = [TempBlob(make_blob_hash(i)) for i in range(count)]
+        for blob in blobs:
+            self.cache.add(blob)
+        return blobs
+
+    def test_evicts_least_recently_used(self):
+        blobs = self.add_blobs(3)
+        self.assertEqual(blobs[0], self.cache.get(blobs[0].blob_hash))
+        self.cache.add(TempBlob(make_blob_hash(3)))
+        self.assertEqual(3, len(self.cache))
+        self.assertIn(blobs[0].blob_hash, self.cache)
+        self.assertNotIn(blobs[1].blob_hash, self.cache)
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_pinned_blobs_are_not_evicted(self):
+        blobs = self.add_blobs(3)
+        blobs[0].readers = 1
+        blobs[1].writers['peer'] = (None, None)
+        self.cache.add(TempBlob(make_blob_hash(3)))
+        self.assertIn(blobs[0].blob_hash, self.cache)
+        self.assertIn(blobs[1].blob_hash, self.cache)
+        self.assertNotIn(blobs[2].blob_hash, self.cache)
+
+    def test_grows_past_max_size_when_everything_is_pinned(self):
+        blobs = self.add_blobs(3)
+        for blob in blobs:
+            blob.readers = 1
+        self.cache.add(TempBlob(make_blob_hash(3)))
+        self.assertEqual(4, len(self.cache))
+        self.assertEqual(0, self.cache.evictions)
+        for blob in blobs:
+            blob.readers = 0
+        self.cache.add(TempBlob(make_blob_hash(4)))
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual(2, self.cache.evictions)
+
+    def test_evicted_blob_which_is_still_referenced_is_returned(self):
+        blobs = self.add_blobs(4)
+        self.assertNotIn(blobs[0].blob_hash, self.cache)
+        self.assertIs(blobs[0], self.cache.get(blobs[0].blob_hash))
+        self.assertIn(blobs[0].blob_hash, self.cache)
+        self.assertEqual(3, len(self.cache))
+
+    def test_hit_and_miss_counters(self):
+        blobs = self.add_blobs(1)
+        self.cache.get(blobs[0].blob_hash)
+        self.cache.get(make_blob_hash(9))
+        stats = self.cache.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['size'])
+
+
+class DiskBlobManagerCacheTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.blob_dir = tempfile.mkdtemp()
+        self.db_dir = tempfile.mkdtemp()
+        self.blob_manager = BlobManager.DiskBlobManager(
+            None, self.blob_dir, self.db_dir, blob_cache_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.blob_dir)
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def test_get_blob_reuses_cached_blob(self):
+        blob_hash = make_blob_hash(1)
+        blob_1 = yield self.blob_manager.get_blob(blob_hash)
+        blob_2 = yield self.blob_manager.get_blob(blob_hash)
+        self.assertIs(blob_1, blob_2)
+        stats = self.blob_manager.get_blob_cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    @defer.inlineCallbacks
+    def test_evicted_blob_in_use_is_not_duplicated(self):
+        blob_hash = make_blob_hash(1)
+        blob = yield self.blob_manager.get_blob(blob_hash)
+        for i in range(2, 5):
+            yield self.blob_manager.get_blob(make_blob_hash(i))
+        self.assertNotIn(blob_hash, self.blob_manager.blobs)
+        blob_again = yield self.blob_manager.get_blob(blob_hash)
+        self.assertIs(blob, blob_again)
+
+    @defer.inlineCallbacks
+    def test_get_blob_is_bounded(self):
+        for i in range(5):
+            yield self.blob_manager.get_blob(make_blob_hash(i))
+        self.assertEqual(2, len(self.blob_manager.blobs))
+        self.assertEqual(3, self.blob_manager.get_blob_cache_stats()['evictions'])
+
+
+class DiskBlobManagerWriteBatchTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.blob_dir = tempfile.mkdtemp()
+        self.db_dir = tempfile.mkdtemp()
+        self.clock = task.Clock()
+        self.original_call_later = utils.call_later
+        utils.call_later = self.clock.callLater
+        self.blob_manager = BlobManager.DiskBlobManager(
+            None, self.blob_dir, self.db_dir, blob_cache_size=10)
+        return self.blob_manager._open_db()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.blob_manager.stop()
+        utils.call_later = self.original_call_later
+        shutil.rmtree(self.blob_dir)
+        shutil.rmtree(self.db_dir)
+
+    def _count_rows(self, table):
+        d = self.blob_manager.db_conn.runQuery("select count(*) from %s" % table)
+        d.addCallback(lambda r: r[0][0])
+        return d
+
+    @defer.inlineCallbacks
+    def test_writes_are_committed_in_one_transaction(self):
+        ds = []
+        for i in range(10):
+            ds.append(self.blob_manager._add_completed_blob(make_blob_hash(i), 10, 0))
+            ds.append(self.blob_manager.add_blob_to_upload_history(make_blob_hash(i), 'host', 1))
+        self.assertEqual(20, self.blob_manager.get_db_write_stats()['pending'])
+        self.clock.advance(self.blob_manager.WRITE_BATCH_DELAY)
+        yield defer.gatherResults(ds)
+        stats = self.blob_manager.get_db_write_stats()
+        self.assertEqual(1, stats['transactions'])
+        self.assertEqual(20, stats['rows_written'])
+        blob_count = yield self._count_rows('blobs')
+        upload_count = yield self._count_rows('upload')
+        self.assertEqual(10, blob_count)
+        self.assertEqual(10, upload_count)
+
+    @defer.inlineCallbacks
+    def test_full_batch_is_written_immediately(self):
+        self.blob_manager.WRITE_BATCH_SIZE = 5
+        ds = [self.blob_manager._add_completed_blob(make_blob_hash(i), 10, 0) for i in range(5)]
+        yield defer.gatherResults(ds)
+        self.assertEqual(1, self.blob_manager.get_db_write_stats()['transactions'])
+
+    @defer.inlineCallbacks
+    def test_duplicate_blob_does_not_fail_the_batch(self):
+        ds = [self.blob_manager._add_completed_blob(make_blob_hash(1), 10, 0) for _ in range(2)]
+        ds.append(self.blob_manager._add_completed_blob(make_blob_hash(2), 10, 0))
+        yield self.blob_manager._flush_writes()
+        yield defer.gatherResults(ds)
+        blob_count = yield self._count_rows('blobs')
+        self.assertEqual(2, blob_count)
+
+    @defer.inlineCallbacks
+    def test_stop_flushes_pending_writes(self):
+        d = self.blob_manager.add_blob_to_download_history(make_blob_hash(1), 'host', 1)
+        db_conn = self.blob_manager.db_conn
+        yield self.blob_manager.stop()
+        yield d
+        result = yield db_conn.runQuery("select count(*) from download")
+        self.assertEqual(1, result[0][0])
+
+
+    @defer.inlineCallbacks
+    def test_stop_waits_for_a_flush_in_progress(self):
+        d = self.blob_manager._add_completed_blob(make_blob_hash(1), 10, 0)
+        order = []
+        d.addCallback(lambda _: order.append('written'))
+        self.clock.advance(self.blob_manager.WRITE_BATCH_DELAY)
+        stopped = self.blob_manager.stop()
+        stopped.addCallback(lambda _: order.append('stopped'))
+        yield stopped
+        self.assertEqual(['written', 'stopped'], order)
+
+    @defer.inlineCallbacks
+    def test_failed_batch_fails_its_writes(self):
+        self.blob_manager._commit_writes = lambda writes: defer.fail(IOError('disk full'))
+        d = self.blob_manager._add_completed_blob(make_blob_hash(1), 10, 0)
+        self.clock.advance(self.blob_manager.WRITE_BATCH_DELAY)
+        yield self.assertFailure(d, IOError)
+        # the timer's flush consumes the failure rather than leaving it unhandled
+        gc.collect()
+        self.assertEqual([], self.flushLoggedErrors(IOError))
+
+
+class DiskBlobManagerAnnounceTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.blob_dir = tempfile.mkdtemp()
+        self.db_dir = tempfile.mkdtemp()
+        self.blob_manager = BlobManager.DiskBlobManager(
+            DHTHashAnnouncer(None, None), self.blob_dir, self.db_dir, blob_cache_size=10)
+        self.blob_manager.ANNOUNCE_BATCH_SIZE = 3
+        return self.blob_manager._open_db()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.blob_manager.stop()
+        shutil.rmtree(self.blob_dir)
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def test_db_uses_wal(self):
+        result = yield self.blob_manager.db_conn.runQuery("pragma journal_mode")
+        self.assertEqual('wal', result[0][0])
+
+    @defer.inlineCallbacks
+    def test_hashes_to_announce_are_returned_in_batches(self):
+        for i in range(5):
+            self.blob_manager._add_completed_blob(make_blob_hash(i), 10, i)
+        yield self.blob_manager._flush_writes()
+        first_batch = yield self.blob_manager.hashes_to_announce()
+        second_batch = yield self.blob_manager.hashes_to_announce()
+        third_batch = yield self.blob_manager.hashes_to_announce()
+        self.assertEqual([make_blob_hash(i) for i in range(3)], first_batch)
+        self.assertEqual([make_blob_hash(i) for i in range(3, 5)], second_batch)
+        self.assertEqual([], third_batch)
+
+
+class DiskBlobManagerReconcileTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.blob_dir = tempfile.mkdtemp()
+        self.db_dir = tempfile.mkdtemp()
+        self.blob_manager = BlobManager.DiskBlobManager(
+            None, self.blob_dir, self.db_dir, blob_cache_size=10)
+        return self.blob_manager._open_db()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.blob_manager.stop()
+        shutil.rmtree(self.blob_dir)
+        shutil.rmtree(self.db_dir)
+
+    def _write_blob_file(self, blob_hash, data='blob'):
+        with open(os.path.join(self.blob_dir, blob_hash), 'wb') as blob_file:
+            blob_file.write(data)
+
+    @defer.inlineCallbacks
+    def test_reconcile_reports_differences(self):
+        self._write_blob_file(make_blob_hash(1))
+        self._write_blob_file(make_blob_hash(2))
+        self._write_blob_file('tmpabcdef')
+        self.blob_manager._add_completed_blob(make_blob_hash(1), 4, 0)
+        self.blob_manager._add_completed_blob(make_blob_hash(3), 4, 0)
+        yield self.blob_manager._flush_writes()
+
+        report = yield self.blob_manager.reconcile_blob_dir()
+        self.assertEqual([make_blob_hash(2)], report['files_without_rows'])
+        self.assertEqual([make_blob_hash(3)], report['rows_without_files'])
+        verified = yield self.blob_manager._get_all_verified_blob_hashes()
+        self.assertEqual([make_blob_hash(1)], verified)
+
+    @defer.inlineCallbacks
+    def test_blobs_are_made_from_the_index(self):
+        self._write_blob_file(make_blob_hash(1))
+        self._write_blob_file(make_blob_hash(2))
+        self.blob_manager._add_completed_blob(make_blob_hash(1), 4, 0)
+        yield self.blob_manager._flush_writes()
+        yield self.blob_manager.reconcile_blob_dir()
+
+        blob_1 = yield self.blob_manager.get_blob(make_blob_hash(1))
+        blob_2 = yield self.blob_manager.get_blob(make_blob_hash(2))
+        blob_3 = yield self.blob_manager.get_blob(make_blob_hash(3))
+        self.assertTrue(blob_1.verified)
+        self.assertEqual(4, blob_1.length)
+        self.assertTrue(blob_2.verified)
+        self.assertFalse(blob_3.verified)
+        completed = yield self.blob_manager.completed_blobs(
+            [make_blob_hash(i) for i in range(1, 4)])
+        self.assertEqual([make_blob_hash(1), make_blob_hash(2)], completed)
+
+
+class DiskBlobManagerShardingTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.blob_dir = tempfile.mkdtemp()
+        self.db_dir = tempfile.mkdtemp()
+        self.clock = task.Clock()
+        self.original_call_later = utils.call_later
+        utils.call_later = self.clock.callLater
+        self.blob_manager = BlobManager.DiskBlobManager(
+            DHTHashAnnouncer(None, None), self.blob_dir, self.db_dir, blob_cache_size=10,
+            sharded_blob_dir=True)
+        # commit each write right away instead of on the clock
+        self.blob_manager.WRITE_BATCH_SIZE = 1
+        return self.blob_manager._open_db()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.blob_manager.stop()
+        utils.call_later = self.original_call_later
+        shutil.rmtree(self.blob_dir)
+        shutil.rmtree(self.db_dir)
+
+    def _shard_path(self, blob_hash):
+        return os.path.join(self.blob_dir, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    @defer.inlineCallbacks
+    def _add_flat_blobs(self, count):
+        for i in range(count):
+            with open(os.path.join(self.blob_dir, make_blob_hash(i)), 'wb') as blob_file:
+                blob_file.write('blob')
+            self.blob_manager._add_completed_blob(make_blob_hash(i), 4, 0)
+        yield self.blob_manager._flush_writes()
+        yield self.blob_manager.reconcile_blob_dir()
+
+    @defer.inlineCallbacks
+    def test_new_blobs_are_sharded(self):
+        yield self.blob_manager.reconcile_blob_dir()
+        blob_creator = self.blob_manager.get_blob_creator()
+        blob_creator.write('some data')
+        blob_hash = yield blob_creator.close()
+        self.assertTrue(os.path.isfile(self._shard_path(blob_hash)))
+        blob = yield self.blob_manager.get_blob(blob_hash)
+        self.assertEqual(self._shard_path(blob_hash), blob.file_path)
+
+    @defer.inlineCallbacks
+    def test_blobs_are_migrated_in_batches(self):
+        self.blob_manager.MIGRATION_BATCH_SIZE = 2
+        yield self._add_flat_blobs(3)
+        self.assertEqual(3, self.blob_manager.get_migration_status()['blobs_to_move'])
+
+        blob = yield self.blob_manager.get_blob(make_blob_hash(0))
+        self.assertEqual(os.path.join(self.blob_dir, make_blob_hash(0)), blob.file_path)
+        self.blob_manager._migrate_blob_files()
+        self.assertEqual(1, self.blob_manager.get_migration_status()['blobs_to_move'])
+        self.blob_manager._migrate_blob_files()
+        self.assertEqual(0, self.blob_manager.get_migration_status()['blobs_to_move'])
+
+        for i in range(3):
+            self.assertTrue(os.path.isfile(self._shard_path(make_blob_hash(i))))
+        # the blob object which was already loaded follows its file
+        self.assertEqual(self._shard_path(make_blob_hash(0)), blob.file_path)
+        read_handle = blob.open_for_reading()
+        self.assertEqual('blob', read_handle.read())
+        blob.close_read_handle(read_handle)
+
+    @defer.inlineCallbacks
+    def test_blobs_being_read_are_not_migrated(self):
+        yield self._add_flat_blobs(1)
+        blob = yield self.blob_manager.get_blob(make_blob_hash(0))
+        read_handle = blob.open_for_reading()
+        self.blob_manager._migrate_blob_files()
+        self.assertEqual(1, self.blob_manager.get_migration_status()['blobs_to_move'])
+        blob.close_read_handle(read_handle)
+        self.blob_manager._migrate_blob_files()
+        self.assertEqual(0, self.blob_manager.get_migration_status()['blobs_to_move'])
+
+
+class PackBlobManagerTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.blob_dir = tempfile.mkdtemp()
+        self.db_dir = tempfile.mkdtemp()
+        self.clock = task.Clock()
+        self.original_call_later = utils.call_later
+        utils.call_later = self.clock.callLater
+        self.blob_manager = self._make_blob_manager()
+        return self._setup_blob_manager()
+
+    def _make_blob_manager(self):
+        blob_manager = BlobManager.PackBlobManager(
+            DHTHashAnnouncer(None, None), self.blob_dir, self.db_dir, blob_cache_size=10)
+        # commit each write right away instead of on the clock
+        blob_manager.WRITE_BATCH_SIZE = 1
+        return blob_manager
+
+    @defer.inlineCallbacks
+    def _setup_blob_manager(self):
+        yield self.blob_manager._open_db()
+        yield self.blob_manager.reconcile_blob_dir()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.blob_manager.stop()
+        utils.call_later = self.original_call_later
+        shutil.rmtree(self.blob_dir)
+        shutil.rmtree(self.db_dir)
+
+    @defer.inlineCallbacks
+    def _create_blob(self, data):
+        blob_creator = self.blob_manager.get_blob_creator()
+        blob_creator.write(data)
+        blob_hash = yield blob_creator.close()
+        defer.returnValue(blob_hash)
+
+    def _read_blob(self, blob):
+        read_handle = blob.open_for_reading()
+        data = read_handle.read()
+        blob.close_read_handle(read_handle)
+        return data
+
+    @defer.inlineCallbacks
+    def test_blobs_share_a_segment(self):
+        blob_hashes = []
+        for i in range(3):
+            blob_hash = yield self._create_blob('blob %i' % i)
+            blob_hashes.append(blob_hash)
+        self.assertEqual(['segment-000000.pack'], os.listdir(self.blob_dir))
+        for i, blob_hash in enumerate(blob_hashes):
+            blob = yield self.blob_manager.get_blob(blob_hash)
+            self.assertTrue(blob.verified)
+            self.assertEqual('blob %i' % i, self._read_blob(blob))
+
+    @defer.inlineCallbacks
+    def test_downloaded_blob_is_packed(self):
+        blob_hash = get_lbry_hash_obj()
+        blob_hash.update('some data')
+        blob = yield self.blob_manager.get_blob(blob_hash.hexdigest(), len('some data'))
+        self.assertFalse(blob.verified)
+        finished_deferred, write, _ = blob.open_for_writing('peer')
+        write('some data')
+        yield finished_deferred
+        self.assertTrue(blob.verified)
+        self.assertEqual('some data', self._read_blob(blob))
+
+    @defer.inlineCallbacks
+    def test_locations_survive_restart(self):
+        blob_hash = yield self._create_blob('some data')
+        yield self.blob_manager.stop()
+        self.blob_manager = self._make_blob_manager()
+        yield self._setup_blob_manager()
+        blob = yield self.blob_manager.get_blob(blob_hash)
+        self.assertTrue(blob.verified)
+        self.assertEqual('some data', self._read_blob(blob))
+
+    @defer.inlineCallbacks
+    def test_compaction_reclaims_deleted_blobs(self):
+        self.blob_manager.pack_store.SEGMENT_SIZE = 20
+        kept = yield self._create_blob('a' * 10)
+        deleted = yield self._create_blob('b' * 10)
+        yield self._create_blob('c' * 10)
+        self.assertEqual([], self.blob_manager.pack_store.segments_to_compact())
+
+        blob = yield self.blob_manager.get_blob(deleted)
+        yield blob.delete()
+        self.assertEqual([0], self.blob_manager.pack_store.segments_to_compact())
+        reclaimed = yield self.blob_manager._compact_pack_store()
+        self.assertEqual(10, reclaimed)
+        self.assertFalse(os.path.isfile(self.blob_manager.pack_store.segment_path(0)))
+
+        blob = yield self.blob_manager.get_blob(kept)
+        self.assertEqual('a' * 10, self._read_blob(blob))
+        yield self.blob_manager._flush_writes()
+        rows = yield self.blob_manager.db_conn.runQuery(
+            "select segment from blob_packs where blob_hash = ?", (kept,))
+        self.assertEqual(1, rows[0][0])
+
+    @defer.inlineCallbacks
+    def test_segment_is_kept_when_new_locations_fail_to_persist(self):
+        self.blob_manager.pack_store.SEGMENT_SIZE = 20
+        kept = yield self._create_blob('a' * 10)
+        deleted = yield self._create_blob('b' * 10)
+        blob = yield self.blob_manager.get_blob(deleted)
+        yield blob.delete()
+        self.blob_manager.pack_store.location_changed_cb = \
+            lambda blob_hash, location: defer.fail(IOError("disk full"))
+        reclaimed = yield self.blob_manager._compact_pack_store()
+        self.assertEqual(0, reclaimed)
+        self.assertTrue(os.path.isfile(self.blob_manager.pack_store.segment_path(0)))
+        self.assertEqual([], self.blob_manager.pack_store.segments_to_compact())
+        rows = yield self.blob_manager.db_conn.runQuery(
+            "select segment from blob_packs where blob_hash = ?", (kept,))
+        self.assertEqual(0, rows[0][0])
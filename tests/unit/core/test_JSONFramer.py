@@ -0,0 +1,63 @@
+import json
+
+from twisted.trial import unittest
+
+from lbrynet.core.Error import InvalidMessageError
+from lbrynet.core.JSONFramer import JSONFramer
+
+
+class JSONFramerTest(unittest.TestCase):
+    def setUp(self):
+        self.framer = JSONFramer()
+
+    def test_split_message(self):
+        message = json.dumps({'blob_data_payment_rate': 0.0, 'requested_blob': 'a' * 96})
+        for character in message[:-1]:
+            self.framer.feed(character)
+            self.assertEqual(self.framer.next_message(), None)
+        self.framer.feed(message[-1])
+        self.assertEqual(self.framer.next_message(), json.loads(message))
+        self.assertEqual(len(self.framer), 0)
+
+    def test_coalesced_messages(self):
+        self.framer.feed('{"a": {"b": 1}}{"c": 2}blob data')
+        self.assertEqual(self.framer.next_message(), {'a': {'b': 1}})
+        self.assertEqual(self.framer.next_message(), {'c': 2})
+        self.assertEqual(self.framer.pop_buffer(), 'blob data')
+        self.assertEqual(len(self.framer), 0)
+
+    def test_pop_buffer_after_message(self):
+        self.framer.feed('{"incoming_blob": {}}')
+        self.framer.feed('\x00\x01}"')
+        self.assertEqual(self.framer.next_message(), {'incoming_blob': {}})
+        self.assertEqual(self.framer.pop_buffer(), '\x00\x01}"')
+
+    def test_braces_and_quotes_in_strings(self):
+        message = json.dumps({'error': 'a } brace, a { brace and a " quote\\'})
+        self.framer.feed(message[:len(message) / 2])
+        self.assertEqual(self.framer.next_message(), None)
+        self.framer.feed(message[len(message) / 2:])
+        self.assertEqual(self.framer.next_message(), json.loads(message))
+
+    def test_escape_split_across_chunks(self):
+        self.framer.feed('{"a": "\\')
+        self.assertEqual(self.framer.next_message(), None)
+        self.framer.feed('"}"}')
+        self.assertEqual(self.framer.next_message(), {'a': '"}'})
+
+    def test_leading_whitespace(self):
+        self.framer.feed(' \r\n{"a": 1}')
+        self.assertEqual(self.framer.next_message(), {'a': 1})
+
+    def test_not_an_object(self):
+        self.framer.feed('[1, 2]')
+        self.assertRaises(InvalidMessageError, self.framer.next_message)
+
+    def test_invalid_json(self):
+        self.framer.feed('{"a": nope}')
+        self.assertRaises(InvalidMessageError, self.framer.next_message)
+
+    def test_max_size(self):
+        self.framer = JSONFramer(max_size=10)
+        self.framer.feed('{"a": "bcdef')
+        self.assertRaises(InvalidMessageError, self.framer.next_message)
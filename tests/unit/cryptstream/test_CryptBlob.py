@@ -0,0 +1,110 @@
+import os
+
+from Crypto.Cipher import AES
+import mock
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from lbrynet.cryptstream import CryptBlob
+from tests.mocks import mock_conf_settings
+
+
+KEY = '2' * AES.block_size
+IV = '3' * AES.block_size
+
+
+def encrypt(data):
+    pad_len = AES.block_size - len(data) % AES.block_size
+    return AES.new(KEY, AES.MODE_CBC, IV).encrypt(data + chr(pad_len) * pad_len)
+
+
+def chunks(data, sizes):
+    offset = 0
+    i = 0
+    while offset < len(data):
+        size = sizes[i % len(sizes)]
+        yield data[offset:offset + size]
+        offset += size
+        i += 1
+
+
+class BlockBufferTest(unittest.TestCase):
+    def test_only_whole_blocks_are_processed(self):
+        processed = []
+        buff = CryptBlob.BlockBuffer(4, lambda data: processed.append(str(data)))
+        for data in ('ab', 'cdefg', 'hijklmnop', 'q'):
+            buff.write(data)
+        self.assertEqual(['abcd', 'efgh', 'ijklmnop'], processed)
+        self.assertEqual(1, len(buff))
+        self.assertEqual('q', buff.flush())
+        self.assertEqual(0, len(buff))
+
+    def test_last_block_is_held(self):
+        processed = []
+        buff = CryptBlob.BlockBuffer(4, lambda data: processed.append(str(data)),
+                                     hold_last_block=True)
+        for data in ('abcd', 'efgh', 'ijklmnop'):
+            buff.write(data)
+        self.assertEqual(['abcd', 'efgh', 'ijkl'], processed)
+        self.assertEqual('mnop', buff.flush())
+
+    def test_strings_are_passed_on_when_the_cipher_takes_no_buffers(self):
+        self.patch(CryptBlob, 'CIPHER_ACCEPTS_BUFFERS', False)
+        processed = []
+        buff = CryptBlob.BlockBuffer(4, processed.append)
+        for data in ('ab', 'cdefghij', buffer('klmnopqrstu', 1, 8)):
+            buff.write(data)
+        self.assertEqual(['abcd', 'efgh', 'ijlm', 'nopq'], processed)
+        self.assertTrue(all(type(data) is str for data in processed))
+        self.assertEqual('rs', buff.flush())
+
+
+class CryptBlobTest(unittest.TestCase):
+    def setUp(self):
+        mock_conf_settings(self)
+        self.data = os.urandom(100003)
+
+    def make_blob(self, write_sizes):
+        blob = mock.Mock()
+        written = []
+        blob.write.side_effect = written.append
+        blob.close.return_value = defer.succeed('blob hash')
+        maker = CryptBlob.CryptStreamBlobMaker(KEY, IV, 0, blob)
+        for data in chunks(self.data, write_sizes):
+            done, num_bytes_written = maker.write(data)
+            self.assertFalse(done)
+            self.assertEqual(len(data), num_bytes_written)
+        info = self.successResultOf(maker.close())
+        self.assertEqual(len(self.data) + AES.block_size - len(self.data) % AES.block_size,
+                         info.length)
+        return ''.join(written)
+
+    def test_encrypted_blob_is_independent_of_write_sizes(self):
+        expected = encrypt(self.data)
+        for write_sizes in ([len(self.data)], [1, 15, 16, 17], [2**14], [7, 4096, 33]):
+            self.assertEqual(expected, self.make_blob(write_sizes))
+
+    def test_writes_stop_at_the_blob_size(self):
+        blob = mock.Mock()
+        blob.close.return_value = defer.succeed('blob hash')
+        maker = CryptBlob.CryptStreamBlobMaker(KEY, IV, 0, blob)
+        self.patch(CryptBlob.conf, 'settings', {'BLOB_SIZE': 64})
+        done, num_bytes_written = maker.write(self.data)
+        self.assertTrue(done)
+        self.assertEqual(63, num_bytes_written)
+
+    def test_decrypt_is_independent_of_read_sizes(self):
+        encrypted = encrypt(self.data)
+        for read_sizes in ([len(encrypted)], [1, 15, 16, 17], [2**14], [7, 4096, 33]):
+            blob = mock.Mock()
+
+            def read(write_func):
+                for data in chunks(encrypted, read_sizes):
+                    write_func(data)
+                return defer.succeed(True)
+
+            blob.read.side_effect = read
+            decryptor = CryptBlob.StreamBlobDecryptor(blob, KEY, IV, len(encrypted))
+            decrypted = []
+            self.successResultOf(decryptor.decrypt(decrypted.append))
+            self.assertEqual(self.data, ''.join(decrypted))
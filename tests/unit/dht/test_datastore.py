@@ -4,6 +4,10 @@
 # the GNU Lesser General Public License Version 3, or any later version.
 # See the COPYING file included in this archive
 
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import time
 import datetime
@@ -13,6 +17,8 @@ import lbrynet.dht.datastore
 import lbrynet.dht.constants
 
 import hashlib
+import mock
+from twisted.internet import defer
 
 class DictDataStoreTest(unittest.TestCase):
     """ Basic tests case for the reference DataStore API and implementation """
@@ -111,9 +117,125 @@ class DictDataStoreTest(unittest.TestCase):
 
 
 
+class PeerDataStoreTest(DictDataStoreTest):
+    def setUp(self):
+        DictDataStoreTest.setUp(self)
+        self.ds = lbrynet.dht.datastore.PeerDataStore()
+
+    def testDeduplicates(self):
+        now = int(time.time())
+        self.ds.addPeerToBlob('key1', 'peer1', now - 10, now - 10, 'node1')
+        self.ds.addPeerToBlob('key1', 'peer1', now, now, 'node1')
+        self.ds.addPeerToBlob('key1', 'peer1', now, now, 'node2')
+        self.failUnlessEqual(self.ds.getPeersForBlob('key1'), ['peer1', 'peer1'])
+        self.failUnlessEqual(self.ds.peerCount(), 2)
+
+    def testRefreshedPeerDoesNotExpire(self):
+        now = int(time.time())
+        old = now - lbrynet.dht.constants.dataExpireTimeout - 100
+        self.ds.addPeerToBlob('key1', 'peer1', old, old, 'node1')
+        self.ds.addPeerToBlob('key1', 'peer1', now, now, 'node1')
+        self.ds.addPeerToBlob('key2', 'peer2', old, old, 'node1')
+        self.ds.removeExpiredPeers()
+        self.failUnlessEqual(self.ds.getPeersForBlob('key1'), ['peer1'])
+        self.failIf(self.ds.hasPeersForBlob('key2'))
+        self.failUnlessEqual(self.ds.keys(), ['key1'])
+        self.failUnlessEqual(len(self.ds), 1)
+
+    def testPerBlobLimit(self):
+        self.ds = lbrynet.dht.datastore.PeerDataStore(maxPeersPerBlob=3)
+        now = int(time.time())
+        for i in range(4):
+            self.ds.addPeerToBlob('key1', 'peer%i' % i, now, now, 'node1')
+        self.failUnlessEqual(self.ds.getPeersForBlob('key1'), ['peer1', 'peer2', 'peer3'])
+
+    def testTotalLimit(self):
+        self.ds = lbrynet.dht.datastore.PeerDataStore(maxPeers=5)
+        now = int(time.time())
+        for i in range(6):
+            self.ds.addPeerToBlob('key%i' % i, 'peer', now - 100 + i, now - 100 + i, 'node1')
+        self.failUnlessEqual(self.ds.peerCount(), 5)
+        self.failIf(self.ds.hasPeersForBlob('key0'))
+        self.failUnless(self.ds.hasPeersForBlob('key5'))
+
+    def testNodeState(self):
+        self.failIf('nodeState' in self.ds)
+
+
+class SQLitePeerDataStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.db_dir, 'dht_peers.db')
+        self.ds = lbrynet.dht.datastore.SQLitePeerDataStore(self.db_file)
+
+    def tearDown(self):
+        self.ds.stop()
+        shutil.rmtree(self.db_dir)
+
+    def _reopen(self, **kwargs):
+        self.ds.stop()
+        self.ds = lbrynet.dht.datastore.SQLitePeerDataStore(self.db_file, **kwargs)
+
+    def testSurvivesRestart(self):
+        now = int(time.time())
+        old = now - lbrynet.dht.constants.dataExpireTimeout - 100
+        key = hashlib.sha384('blob').digest()
+        peer = '\x00\xff\x10\x01' + '\x0d\x05' + hashlib.sha384('peer').digest()
+        self.ds.addPeerToBlob(key, peer, now, now, 'node1')
+        self.ds.addPeerToBlob(key, 'peer2', now, now, 'node1')
+        self.ds.addPeerToBlob('key2', 'peer3', old, old, 'node1')
+        self._reopen()
+        self.failUnlessEqual(self.ds.getPeersForBlob(key), [peer, 'peer2'])
+        self.failIf(self.ds.hasPeersForBlob('key2'))
+
+    def testRemovedPeersStayRemoved(self):
+        now = int(time.time())
+        self.ds.addPeerToBlob('key1', 'peer1', now, now, 'node1')
+        self._reopen(maxPeersPerBlob=1)
+        self.ds.addPeerToBlob('key1', 'peer2', now, now, 'node1')
+        self._reopen()
+        self.failUnlessEqual(self.ds.getPeersForBlob('key1'), ['peer2'])
+
+    def _storedPeers(self):
+        db = sqlite3.connect(self.db_file)
+        try:
+            return [str(value) for value, in db.execute("select value from peers")]
+        finally:
+            db.close()
+
+    def testFlushWritesInAThread(self):
+        writes = []
+        def deferToThread(f, *args):
+            writes.append((f, args))
+            return defer.Deferred()
+        now = int(time.time())
+        with mock.patch('lbrynet.dht.datastore.threads.deferToThread', deferToThread):
+            self.ds.addPeerToBlob('key1', 'peer1', now, now, 'node1')
+            self.ds.flush()
+            self.ds.addPeerToBlob('key1', 'peer2', now, now, 'node1')
+            self.ds.flush()
+        self.failUnlessEqual(len(writes), 1)
+        self.failUnlessEqual(self._storedPeers(), [])
+        f, args = writes[0]
+        f(*args)
+        self.failUnlessEqual(self._storedPeers(), ['peer1'])
+
+    def testStopWritesChangesBeingFlushed(self):
+        now = int(time.time())
+        with mock.patch('lbrynet.dht.datastore.threads.deferToThread',
+                        lambda f, *args: defer.Deferred()):
+            self.ds.addPeerToBlob('key1', 'peer1', now, now, 'node1')
+            self.ds.flush()
+            self.ds.addPeerToBlob('key1', 'peer2', now, now, 'node1')
+        self._reopen()
+        self.failUnlessEqual(sorted(self.ds.getPeersForBlob('key1')), ['peer1', 'peer2'])
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(DictDataStoreTest))
+    suite.addTest(unittest.makeSuite(PeerDataStoreTest))
+    suite.addTest(unittest.makeSuite(SQLitePeerDataStoreTest))
     return suite
 
 
@@ -4,10 +4,65 @@
 # the GNU Lesser General Public License Version 3, or any later version.
 # See the COPYING file included in this archive
 
+import os
+import random
 import unittest
 
 import lbrynet.dht.encoding
 
+
+def legacyEncode(data):
+    """ The string concatenating Bencode encoder which the codec replaced """
+    if type(data) in (int, long):
+        return 'i%de' % data
+    elif type(data) == str:
+        return '%d:%s' % (len(data), data)
+    elif type(data) in (list, tuple):
+        encodedListItems = ''
+        for item in data:
+            encodedListItems += legacyEncode(item)
+        return 'l%se' % encodedListItems
+    elif type(data) == dict:
+        encodedDictItems = ''
+        keys = data.keys()
+        keys.sort()
+        for key in keys:
+            encodedDictItems += legacyEncode(key)
+            encodedDictItems += legacyEncode(data[key])
+        return 'd%se' % encodedDictItems
+    elif type(data) == float:
+        return 'f%fe' % data
+    elif data == None:
+        return 'n'
+
+
+def randomValue(rand, depth=0):
+    """ Returns a random value which doesn't contain dicts """
+    choice = rand.randint(0, 6 if depth < 3 else 4)
+    if choice == 0:
+        return rand.randint(-2**40, 2**40)
+    elif choice == 1:
+        return rand.randint(2**64, 2**80)
+    elif choice == 2:
+        return os.urandom(rand.randint(0, 60))
+    elif choice == 3:
+        return rand.choice([0.5, -1.25, 3.0, 1000000.125])
+    elif choice == 4:
+        return None
+    elif choice == 5:
+        return [randomValue(rand, depth+1) for _ in range(rand.randint(0, 5))]
+    else:
+        return tuple(randomValue(rand, depth+1) for _ in range(rand.randint(0, 5)))
+
+
+def listified(data):
+    if type(data) in (list, tuple):
+        return [listified(item) for item in data]
+    elif type(data) == dict:
+        return dict((key, listified(value)) for key, value in data.iteritems())
+    return data
+
+
 class BencodeTest(unittest.TestCase):
     """ Basic tests case for the Bencode implementation """
     def setUp(self):
@@ -37,9 +92,59 @@ class BencodeTest(unittest.TestCase):
         for encodedValue in self.badDecoderCases:
             self.failUnlessRaises(lbrynet.dht.encoding.DecodeError, self.encoding.decode, encodedValue)
 
+    def testStringWithoutColon(self):
+        """ Tests that a string length which isn't followed by a colon is rejected """
+        for encodedValue in ('12', 'l4e', 'd3:foo5e'):
+            self.failUnlessRaises(lbrynet.dht.encoding.DecodeError, self.encoding.decode,
+                                  encodedValue)
+
+    def testFindValueResponse(self):
+        """ Tests encoding and decoding a findValue response carrying k peers """
+        response = ['r', os.urandom(20), os.urandom(48),
+                    {os.urandom(48): [os.urandom(54) for _ in range(8)], 'token': os.urandom(48)}]
+        encodedValue = self.encoding.encode(response)
+        self.failUnlessEqual(encodedValue, legacyEncode(response))
+        self.failUnlessEqual(self.encoding.decode(encodedValue), response)
+
+    def testNestedDictEndsContainer(self):
+        """ Tests that a dict ends the list containing it, as the decoder always did """
+        self.failUnlessEqual(self.encoding.decode('ld3:fooi1eei2ee'), [{'foo': 1}])
+
+    def testCannotEncode(self):
+        """ Tests that unsupported types are rejected """
+        self.failUnlessRaises(TypeError, self.encoding.encode, object())
+        self.failUnlessRaises(TypeError, self.encoding.encode, [1, set()])
+
+
+class BencodeFuzzTest(unittest.TestCase):
+    """ Compares the codec with the legacy encoder on random values """
+    def setUp(self):
+        self.encoding = lbrynet.dht.encoding.Bencode()
+        self.rand = random.Random(1234)
+
+    def testRoundTrip(self):
+        for _ in range(500):
+            value = {'value': randomValue(self.rand), 'id': os.urandom(48)}
+            encodedValue = self.encoding.encode(value)
+            self.failUnlessEqual(encodedValue, legacyEncode(value))
+            self.failUnlessEqual(self.encoding.decode(encodedValue), listified(value))
+
+    def testTruncatedData(self):
+        """ Tests that truncated data never decodes silently to the whole value """
+        value = [randomValue(self.rand) for _ in range(20)]
+        encodedValue = self.encoding.encode(value)
+        for end in range(1, len(encodedValue)):
+            try:
+                result = self.encoding.decode(encodedValue[:end])
+            except (lbrynet.dht.encoding.DecodeError, IndexError):
+                continue
+            self.failIfEqual(result, listified(value))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(BencodeTest))
+    suite.addTest(unittest.makeSuite(BencodeFuzzTest))
     return suite
 
 if __name__ == '__main__':
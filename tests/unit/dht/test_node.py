@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from lbrynet.dht import constants
+from lbrynet.dht import node
+from lbrynet.dht import protocol
+from lbrynet.dht.contact import Contact
+
+
+def make_key(prefix, i):
+    return chr(prefix) + chr(i) + '\x00' * (constants.key_bits / 8 - 2)
+
+
+class FakeResponseMessage(object):
+    def __init__(self, nodeID, response):
+        self.nodeID = nodeID
+        self.response = response
+
+
+class FakeContact(object):
+    """ A contact which answers findValue with a token and records store requests """
+    def __init__(self, id):
+        self.id = id
+        self.id_int = long(id.encode('hex'), 16)
+        self.find_value_calls = 0
+        self.stored = []
+
+    def findValue(self, key, rawResponse=False):
+        self.find_value_calls += 1
+        return defer.succeed((FakeResponseMessage(self.id, {'token': 'token'}), None))
+
+    def store(self, key, value, originalPublisherID, self_store):
+        self.stored.append((key, value['token']))
+        return defer.succeed('OK')
+
+
+class NodeAnnounceTest(unittest.TestCase):
+    def setUp(self):
+        self.node = node.Node()
+        self.lookups = []
+        # every key in the 0x01 and 0x02 ranges is close to its own group of contacts
+        self.contacts = {
+            1: [FakeContact(make_key(1, 200 + i)) for i in range(constants.k)],
+            2: [FakeContact(make_key(2, 200 + i)) for i in range(constants.k)],
+        }
+        self.node.iterativeFindNode = self._find_node
+
+    def tearDown(self):
+        self.node.stop()
+
+    def _find_node(self, key):
+        self.lookups.append(key)
+        return defer.succeed(list(self.contacts[ord(key[0])]))
+
+    def test_nearby_hashes_share_lookups(self):
+        keys = [make_key(2, 1), make_key(1, 2), make_key(1, 1), make_key(2, 2), make_key(1, 3)]
+        d = self.node.iterativeAnnounceHaveBlobs(keys, {'port': 3333, 'lbryid': 'lbryid'})
+        stored = self.successResultOf(d)
+        self.assertEqual(stored, dict((key, constants.k) for key in keys))
+        self.assertEqual(self.lookups, [make_key(1, 1), make_key(2, 1)])
+        for contact in self.contacts[1]:
+            self.assertEqual(contact.find_value_calls, 1)
+            self.assertEqual(contact.stored, [(make_key(1, i), 'token') for i in (1, 2, 3)])
+        for contact in self.contacts[2]:
+            self.assertEqual(contact.find_value_calls, 1)
+            self.assertEqual(contact.stored, [(make_key(2, i), 'token') for i in (1, 2)])
+
+
+class FakeProtocol(object):
+    """ Records the RPCs sent by the node without sending them """
+    def __init__(self):
+        self.sent = []
+
+    def sendRPC(self, contact, method, args, **kwargs):
+        self.sent.append((contact.id, method))
+        return defer.Deferred()
+
+    def getRtt(self, contactID):
+        return None
+
+
+class NodeRoutingTableSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.tmp_dir, 'dht_routing_table.json')
+        self.nodes = []
+
+    def tearDown(self):
+        for n in self.nodes:
+            n.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_node(self, **kwargs):
+        n = node.Node(udpPort=None, routingTableSnapshot=self.snapshot, **kwargs)
+        self.nodes.append(n)
+        return n
+
+    def _contact_ids(self, n):
+        return sorted(c.id for bucket in n._routingTable._buckets for c in bucket._contacts)
+
+    def test_restore(self):
+        first = self._make_node()
+        for i in range(20):
+            first.addContact(Contact(make_key(i, 1), '10.0.0.%i' % i, 4444, first._protocol))
+        first.stop()
+        self.nodes.remove(first)
+
+        second = self._make_node()
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(self._contact_ids(second), self._contact_ids(first))
+        self.assertEqual(second._staleContacts, [])
+
+    def test_stale_contacts_are_pinged(self):
+        now = int(time.time())
+        contacts = [
+            (make_key(1, 1).encode('hex'), '10.0.0.1', 4444, now),
+            (make_key(2, 1).encode('hex'), '10.0.0.2', 4444, now - constants.refreshTimeout - 1),
+            (make_key(3, 1).encode('hex'), '10.0.0.3', 4444,
+             now - constants.snapshotContactMaxAge - 1),
+        ]
+        with open(self.snapshot, 'w') as snapshot_file:
+            json.dump({'id': make_key(4, 1).encode('hex'), 'contacts': contacts}, snapshot_file)
+
+        protocol = FakeProtocol()
+        n = self._make_node(networkProtocol=protocol)
+        n._iterativeFind = lambda key, shortlist=None: defer.succeed([])
+        self.assertEqual(n.id, make_key(4, 1))
+        self.assertEqual(self._contact_ids(n), [make_key(1, 1)])
+        n.joinNetwork()
+        self.assertEqual(protocol.sent, [(make_key(2, 1), 'ping')])
+
+    def test_unwritable_snapshot_does_not_stop_shutdown(self):
+        self.snapshot = os.path.join(self.tmp_dir, 'missing', 'dht_routing_table.json')
+        n = self._make_node()
+        self.nodes.remove(n)
+        n._dataStore.stop = mock.Mock()
+        n.stop()
+        self.assertTrue(n._dataStore.stop.called)
+        self.assertFalse(os.path.exists(self.snapshot))
+
+    def test_failed_write_keeps_the_previous_snapshot(self):
+        first = self._make_node()
+        first.addContact(Contact(make_key(1, 1), '10.0.0.1', 4444, first._protocol))
+        first.stop()
+        self.nodes.remove(first)
+
+        second = self._make_node()
+        second.addContact(Contact(make_key(2, 1), '10.0.0.2', 4444, second._protocol))
+        with mock.patch.object(node.json, 'dump', side_effect=IOError("No space left on device")):
+            second.stop()
+        self.nodes.remove(second)
+
+        third = self._make_node()
+        self.assertEqual(self._contact_ids(third), [make_key(1, 1)])
+
+
+class FakeNetwork(object):
+    """ Answers the lookup RPCs sent by a node, each remote node returning the
+    k contacts closest to the key it knows of """
+    def __init__(self, node_ids, unresponsive=(), rtts=None):
+        self.node_ids = node_ids
+        self.unresponsive = unresponsive
+        self.rtts = rtts or {}
+        self.queried = []
+        # the deferreds of the RPCs sent to unresponsive nodes
+        self.waiting = []
+
+    def getRtt(self, contactID):
+        return self.rtts.get(contactID)
+
+    def sendRPC(self, contact, method, args, rawResponse=False):
+        self.queried.append(contact.id)
+        if contact.id in self.unresponsive:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        distance = node.Distance(args[0])
+        closest = sorted(self.node_ids, key=distance)[:constants.k]
+        triples = [(node_id, '10.0.0.1', 4444) for node_id in closest]
+        return defer.succeed((FakeResponseMessage(contact.id, triples), ('10.0.0.1', 4444)))
+
+
+class NodeDisjointLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.node_ids = [make_key(i, j) for i in range(10) for j in range(10)]
+        self.key = make_key(5, 5)
+        self.closest = sorted(self.node_ids, key=node.Distance(self.key))[:constants.k]
+
+    def _make_node(self, network):
+        n = node.Node(udpPort=None, networkProtocol=network, disjointLookupPaths=3)
+        self.addCleanup(n.stop)
+        shortlist = [Contact(node_id, '10.0.0.1', 4444, network)
+                     for node_id in self.node_ids[::25]]
+        return n, shortlist
+
+    def test_finds_closest_contacts(self):
+        network = FakeNetwork(self.node_ids)
+        n, shortlist = self._make_node(network)
+        d = n._iterativeFind(self.key, shortlist)
+        contacts = self.successResultOf(d)
+        self.assertEqual([contact.id for contact in contacts], self.closest)
+        # no contact is queried by more than one path
+        self.assertEqual(len(network.queried), len(set(network.queried)))
+
+    @defer.inlineCallbacks
+    def test_does_not_wait_for_slow_contacts(self):
+        network = FakeNetwork(self.node_ids, unresponsive=self.closest[1:3])
+        n, shortlist = self._make_node(network)
+        n.lookupRtt = 0.01
+        start = time.time()
+        contacts = yield n._iterativeFind(self.key, shortlist)
+        self.assertTrue(time.time() - start < constants.rpcTimeout)
+        responsive = [node_id for node_id in self.closest if node_id not in self.closest[1:3]]
+        self.assertEqual([contact.id for contact in contacts][:len(responsive)], responsive)
+
+    def test_slow_probes_filling_the_probe_slots_do_not_finish_a_path(self):
+        clock = task.Clock()
+        patcher = mock.patch('twisted.internet.reactor.callLater', clock.callLater)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        shortlist_ids = sorted(self.node_ids, key=node.Distance(self.key))[:10]
+        unresponsive = shortlist_ids[:constants.lookupMaxAlpha]
+        network = FakeNetwork(self.node_ids, unresponsive=unresponsive)
+        n = node.Node(udpPort=None, networkProtocol=network, disjointLookupPaths=1)
+        self.addCleanup(n.stop)
+        n.lookupRtt = 0.01
+        shortlist = [Contact(node_id, '10.0.0.1', 4444, network) for node_id in shortlist_ids]
+        d = n._iterativeFind(self.key, shortlist)
+        clock.pump([constants.lookupMinSlowProbeDelay] * 3)
+        self.assertEqual(network.queried, unresponsive)
+        self.assertNoResult(d)
+        network.waiting[0].errback(protocol.TimeoutError(unresponsive[0]))
+        contacts = self.successResultOf(d)
+        self.assertEqual([contact.id for contact in contacts],
+                         shortlist_ids[constants.lookupMaxAlpha:])
+
+
+class NodeProbeOrderTest(unittest.TestCase):
+    def test_standard_lookup_probes_closest_first(self):
+        key = make_key(0, 0)
+        ids = [make_key(0, i) for i in range(8, 16)]
+        # the further contacts of the band are the faster ones
+        network = FakeNetwork(ids, rtts=dict((node_id, 1.0 / i)
+                                             for i, node_id in enumerate(ids, 1)))
+        n = node.Node(udpPort=None, networkProtocol=network)
+        self.addCleanup(n.stop)
+        shortlist = [Contact(node_id, '10.0.0.1', 4444, network) for node_id in reversed(ids)]
+        n._iterativeFind(key, shortlist)
+        self.assertEqual(network.queried[:constants.alpha], ids[:constants.alpha])
+
+    def test_fast_contacts_are_probed_first(self):
+        key = make_key(0, 0)
+        ids = [make_key(0, 2), make_key(0, 3), make_key(0, 1), make_key(1, 0), make_key(0, 128)]
+        network = FakeNetwork(ids, rtts={make_key(0, 3): 0.05, make_key(0, 2): 0.5,
+                                         make_key(1, 0): 0.01})
+        contacts = [Contact(node_id, '10.0.0.1', 4444, network) for node_id in ids]
+        node.sortForProbing(contacts, node.Distance(key), network)
+        # 0x0001 is alone at its distance; 0x0002 and 0x0003 are as far as each other, so
+        # the faster one goes first; 0x0100 is further away however fast it is
+        self.assertEqual([contact.id for contact in contacts],
+                         [make_key(0, 1), make_key(0, 3), make_key(0, 2), make_key(0, 128),
+                          make_key(1, 0)])
@@ -0,0 +1,278 @@
+import mock
+from twisted.internet import task
+from twisted.trial import unittest
+
+from lbrynet.dht import constants
+from lbrynet.dht import encoding
+from lbrynet.dht import msgformat
+from lbrynet.dht import msgtypes
+from lbrynet.dht import protocol
+from lbrynet.dht.contact import Contact
+
+
+class FakeNode(object):
+    def __init__(self):
+        self.id = 'a' * 48
+        self.removed = []
+
+    def addContact(self, contact):
+        pass
+
+    def removeContact(self, contactID):
+        self.removed.append(contactID)
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, address):
+        self.written.append((data, address))
+
+
+class ContactStatsTest(unittest.TestCase):
+    def test_unknown_contact(self):
+        stats = protocol.ContactStats()
+        self.assertEqual(stats.timeout(), constants.rpcAttemptTimeout)
+
+    def test_timeout_follows_rtt(self):
+        stats = protocol.ContactStats()
+        for _ in range(20):
+            stats.addAnswer(0.2)
+        self.assertAlmostEqual(stats.rtt, 0.2)
+        self.assertEqual(stats.timeout(), constants.rpcMinTimeout)
+        stats.addAnswer(1.0)
+        self.assertAlmostEqual(stats.rtt, 0.3)
+        self.assertAlmostEqual(stats.timeout(), 0.3 + 4 * stats.rttVariance)
+
+    def test_failures_back_off(self):
+        stats = protocol.ContactStats()
+        stats.addAnswer(0.1)
+        stats.addFailure()
+        self.assertEqual(stats.timeout(), 2 * constants.rpcMinTimeout)
+        stats.addFailure()
+        stats.addFailure()
+        self.assertEqual(stats.timeout(), constants.rpcAttemptTimeout)
+        stats.addAnswer()
+        self.assertEqual(stats.timeout(), constants.rpcMinTimeout)
+
+
+class KademliaProtocolTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        for patcher in (mock.patch('lbrynet.dht.protocol.reactor', self.clock),
+                        mock.patch('time.time', self.clock.seconds)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.node = FakeNode()
+        self.protocol = protocol.KademliaProtocol(self.node)
+        self.protocol.transport = FakeTransport()
+        self.contact = Contact('b' * 48, '10.0.0.1', 4444, self.protocol)
+
+    def _respond(self, rpcID):
+        msg = msgtypes.ResponseMessage(rpcID, self.contact.id, 'pong')
+        datagram = encoding.Bencode().encode(msgformat.DefaultFormat().toPrimitive(msg))
+        self.protocol.datagramReceived(datagram, ('10.0.0.1', 4444))
+
+    def _sentRPCIDs(self):
+        return [encoding.Bencode().decode(data)[msgformat.DefaultFormat.headerMsgID]
+                for data, _ in self.protocol.transport.written]
+
+    def test_lost_packet_is_sent_again(self):
+        d = self.contact.ping()
+        self.clock.pump([constants.rpcAttemptTimeout, 0.01])
+        self.assertNoResult(d)
+        self.assertEqual(self.node.removed, [])
+        rpcIDs = self._sentRPCIDs()
+        self.assertEqual(len(rpcIDs), 2)
+        self.assertEqual(rpcIDs[0], rpcIDs[1])
+        self._respond(rpcIDs[0])
+        self.assertEqual(self.successResultOf(d), 'pong')
+        # it isn't known which of the packets was answered
+        self.assertEqual(self.protocol.getRtt(self.contact.id), None)
+
+    def test_timeout(self):
+        d = self.contact.ping()
+        self.clock.pump([constants.rpcAttemptTimeout] * constants.rpcAttempts)
+        self.failureResultOf(d, protocol.TimeoutError)
+        self.assertEqual(self.node.removed, [self.contact.id])
+        self.assertEqual(len(self.protocol.transport.written), constants.rpcAttempts)
+
+    def test_full_send_queue_fails_at_once(self):
+        with mock.patch.object(self.protocol._sendQueue, 'put', return_value=False):
+            d = self.contact.ping()
+        self.failureResultOf(d, protocol.SendQueueFullError)
+        self.assertEqual(self.protocol._sentMessages, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.protocol._getContactStats(self.contact.id).failures, 0)
+        self.assertEqual(self.node.removed, [])
+
+    def test_full_send_queue_fails_retransmit(self):
+        d = self.contact.ping()
+        with mock.patch.object(self.protocol._sendQueue, 'put', return_value=False):
+            self.clock.advance(constants.rpcAttemptTimeout)
+        self.failureResultOf(d, protocol.SendQueueFullError)
+        self.assertEqual(self.protocol._sentMessages, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.protocol._getContactStats(self.contact.id).failures, 0)
+        self.assertEqual(self.node.removed, [])
+
+    def test_timeout_adapts_to_rtt(self):
+        d = self.contact.ping()
+        self.clock.advance(0.1)
+        self._respond(self._sentRPCIDs()[0])
+        self.successResultOf(d)
+        self.assertAlmostEqual(self.protocol.getRtt(self.contact.id), 0.1)
+
+        d = self.contact.ping()
+        self.clock.pump([constants.rpcMinTimeout, 2 * constants.rpcMinTimeout])
+        self.failureResultOf(d, protocol.TimeoutError)
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        for patcher in (mock.patch('lbrynet.dht.protocol.reactor', self.clock),
+                        mock.patch('time.time', self.clock.seconds)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.written = []
+        self.queue = protocol.SendQueue(lambda data, address: self.written.append(data),
+                                        packetsPerSecond=10, burstSize=2, maxSize=5)
+
+    def test_rate_limit(self):
+        self.queue.put([('a', None), ('b', None), ('c', None), ('d', None)],
+                       protocol.SendQueue.REQUEST)
+        self.assertEqual(self.written, ['a', 'b'])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.written, ['a', 'b', 'c'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.written, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.queue.stats(), {'queued': 0, 'sent': 4, 'dropped': 0})
+
+    def test_priorities(self):
+        self.queue.put([('a', None), ('b', None)], protocol.SendQueue.REQUEST)
+        self.queue.put([('store', None)], protocol.SendQueue.STORE)
+        self.queue.put([('request', None)], protocol.SendQueue.REQUEST)
+        self.queue.put([('response', None)], protocol.SendQueue.RESPONSE)
+        self.clock.pump([0.1] * 3)
+        self.assertEqual(self.written, ['a', 'b', 'response', 'request', 'store'])
+
+    def test_full_queue_drops_whole_messages(self):
+        self.queue.put([('a', None), ('b', None)], protocol.SendQueue.REQUEST)
+        self.assertTrue(self.queue.put([('c', None)] * 5, protocol.SendQueue.REQUEST))
+        self.assertFalse(self.queue.put([('d', None)] * 2, protocol.SendQueue.RESPONSE))
+        self.assertEqual(self.queue.stats(), {'queued': 5, 'sent': 2, 'dropped': 2})
+
+    def test_stop(self):
+        self.queue.put([('a', None)] * 4, protocol.SendQueue.REQUEST)
+        self.queue.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.queue), 0)
+
+
+class ReassemblyBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        time_patcher = mock.patch('time.time', lambda: self.now)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.address = ('10.0.0.1', 4444)
+        self.buffer = protocol.ReassemblyBuffer(
+            packetSize=10, maxMessageSize=40, maxSize=100, timeout=10)
+
+    def _msgID(self, i):
+        return str(i).zfill(20)
+
+    def test_out_of_order_and_duplicate_packets(self):
+        msgID = self._msgID(1)
+        for seqNumber, data in ((2, 'c' * 5), (0, 'a' * 10), (0, 'x' * 10)):
+            self.assertEqual(self.buffer.add(msgID, 3, seqNumber, data, self.address), None)
+        self.assertEqual(self.buffer.received(msgID), 2)
+        self.assertEqual(self.buffer.add(msgID, 3, 1, 'b' * 10, self.address),
+                         'a' * 10 + 'b' * 10 + 'c' * 5)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(self.buffer.size(), 0)
+
+    def test_invalid_headers(self):
+        msgID = self._msgID(1)
+        # more packets than a message may have, sequence numbers out of range
+        for totalPackets, seqNumber in ((5, 0), (65535, 0), (0, 0), (2, 2), (2, 65535)):
+            self.assertEqual(self.buffer.add(msgID, totalPackets, seqNumber, 'a', self.address),
+                             None)
+        self.assertEqual(len(self.buffer), 0)
+        # packets which don't match the rest of their message
+        self.buffer.add(msgID, 2, 0, 'a', self.address)
+        self.buffer.add(msgID, 3, 1, 'b', self.address)
+        self.buffer.add(msgID, 2, 1, 'b', ('10.0.0.2', 4444))
+        self.assertEqual(self.buffer.received(msgID), 1)
+
+    def test_message_size_limit(self):
+        msgID = self._msgID(1)
+        for seqNumber in range(3):
+            self.buffer.add(msgID, 4, seqNumber, 'a' * 15, self.address)
+        self.assertFalse(msgID in self.buffer)
+        self.assertEqual(self.buffer.size(), 0)
+
+    def test_buffer_size_limit(self):
+        # a flood of first packets of messages which are never finished
+        for i in range(1000):
+            self.buffer.add(self._msgID(i), 4, 0, 'a' * 10, self.address)
+            self.assertTrue(self.buffer.size() <= 100)
+        self.assertEqual(len(self.buffer), 10)
+        # the oldest messages were dropped to make room
+        self.assertFalse(self._msgID(989) in self.buffer)
+        self.assertTrue(self._msgID(990) in self.buffer)
+
+    def test_timeout(self):
+        self.buffer.add(self._msgID(1), 2, 0, 'a', self.address)
+        self.now += 5
+        self.buffer.add(self._msgID(2), 2, 0, 'a', self.address)
+        self.now += 5
+        self.assertEqual(self.buffer.add(self._msgID(1), 2, 1, 'b', self.address), None)
+        self.assertEqual(self.buffer.add(self._msgID(2), 2, 1, 'b', self.address), 'ab')
+        self.assertEqual(self.buffer.received(self._msgID(1)), 1)
+
+
+class KademliaProtocolMultiPacketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        for patcher in (mock.patch('lbrynet.dht.protocol.reactor', self.clock),
+                        mock.patch('time.time', self.clock.seconds)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.protocol = protocol.KademliaProtocol(FakeNode())
+        self.protocol.transport = FakeTransport()
+        self.contact = Contact('b' * 48, '10.0.0.1', 4444, self.protocol)
+
+    def test_large_response(self):
+        d = self.contact.findValue('c' * 48)
+        rpcID = self.protocol._sentMessages.keys()[0]
+        msg = msgtypes.ResponseMessage(rpcID, self.contact.id, 'x' * 20000)
+        datagram = encoding.Bencode().encode(msgformat.DefaultFormat().toPrimitive(msg))
+        packets = self.protocol._packets(datagram, rpcID, None)
+        self.assertEqual(len(packets), 3)
+        for data, _ in reversed(packets):
+            self.protocol.datagramReceived(data, ('10.0.0.1', 4444))
+        self.assertEqual(self.successResultOf(d), 'x' * 20000)
+        self.assertEqual(len(self.protocol._partialMessages), 0)
+
+    def test_short_datagram(self):
+        self.protocol.datagramReceived('\x00\x00\x02', ('10.0.0.1', 4444))
+        self.assertEqual(len(self.protocol._partialMessages), 0)
+
+    def test_stalled_response_times_out(self):
+        d = self.contact.findValue('c' * 48)
+        rpcID = self.protocol._sentMessages.keys()[0]
+        header = '\x00\x00\x03\x00\x00%s\x00' % rpcID
+        self.protocol.datagramReceived(header + 'x' * 10, ('10.0.0.1', 4444))
+        self.assertTrue(rpcID in self.protocol._partialMessages)
+        self.clock.advance(constants.rpcAttemptTimeout)
+        self.assertNoResult(d)
+        self.clock.advance(constants.rpcTimeout)
+        self.failureResultOf(d, protocol.TimeoutError)
+        self.assertEqual(self.protocol._sentMessages, {})
+        self.assertEqual(self.protocol._partialMessagesProgress, {})
+        self.assertEqual(len(self.protocol._partialMessages), 0)
@@ -0,0 +1,64 @@
+import hashlib
+
+from twisted.trial import unittest
+
+from lbrynet.dht import constants
+from lbrynet.dht import routingtable
+from lbrynet.dht.contact import Contact
+
+
+class FakeRPCProtocol(object):
+    """ Fake RPC protocol; allows contacts to "send" RPCs """
+    def sendRPC(self, *args, **kwargs):
+        return FakeDeferred()
+
+
+class FakeDeferred(object):
+    """ Fake Twisted Deferred object; allows the routing table to add callbacks that do nothing """
+    def addCallback(self, *args, **kwargs):
+        return
+
+    def addErrback(self, *args, **kwargs):
+        return
+
+
+def make_id(i):
+    return hashlib.sha384('node %i' % i).digest()
+
+
+class TreeRoutingTableBucketIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FakeRPCProtocol()
+        self.routing_table = routingtable.TreeRoutingTable(make_id(0))
+        for i in range(1, 500):
+            self.routing_table.addContact(Contact(make_id(i), '127.0.0.1', 4444, self.protocol))
+
+    def _scan_for_bucket(self, key):
+        for i, bucket in enumerate(self.routing_table._buckets):
+            if bucket.keyInRange(key):
+                return i
+
+    def test_range_mins_follow_splits(self):
+        self.assertTrue(len(self.routing_table._buckets) > 1)
+        self.assertEqual([bucket.rangeMin for bucket in self.routing_table._buckets],
+                         self.routing_table._bucketRangeMins)
+
+    def test_bucket_index_matches_bucket_ranges(self):
+        for i in range(1000):
+            key = make_id(i)
+            self.assertEqual(self._scan_for_bucket(key), self.routing_table._kbucketIndex(key))
+        last_index = len(self.routing_table._buckets) - 1
+        self.assertEqual(0, self.routing_table._kbucketIndex('\x00' * (constants.key_bits / 8)))
+        self.assertEqual(
+            last_index, self.routing_table._kbucketIndex('\xff' * (constants.key_bits / 8)))
+
+    def test_bucket_index_accepts_numeric_keys(self):
+        key = make_id(1)
+        self.assertEqual(self.routing_table._kbucketIndex(key),
+                         self.routing_table._kbucketIndex(long(key.encode('hex'), 16)))
+
+    def test_contacts_are_in_their_buckets(self):
+        for bucket in self.routing_table._buckets:
+            for contact in bucket._contacts:
+                self.assertTrue(bucket.keyInRange(contact.id))
+                self.assertEqual(long(contact.id.encode('hex'), 16), contact.id_int)
@@ -0,0 +1,104 @@
+import binascii
+
+import mock
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from lbrynet.core.Error import InvalidStreamDescriptorError
+from lbrynet.lbryfile import StreamDescriptor
+from lbrynet.lbryfile.EncryptedFileMetadataManager import TempEncryptedFileMetadataManager
+
+
+def make_sd_info(num_blobs=3):
+    blobs = [{'blob_hash': '%096x' % i, 'blob_num': i, 'iv': '%032x' % i, 'length': 2**21}
+             for i in range(num_blobs)]
+    blobs.append({'blob_num': num_blobs, 'iv': '%032x' % num_blobs, 'length': 0})
+    sd_info = {
+        'stream_type': StreamDescriptor.EncryptedFileStreamType,
+        'stream_name': binascii.hexlify('test.file'),
+        'key': '%032x' % 42,
+        'suggested_file_name': binascii.hexlify('test.file'),
+        'blobs': blobs,
+    }
+    blob_infos = [(b.get('blob_hash'), b['blob_num'], b['iv'], b['length']) for b in blobs]
+    sd_info['stream_hash'] = StreamDescriptor.get_stream_hash(
+        sd_info['stream_name'], sd_info['key'], sd_info['suggested_file_name'], blob_infos)
+    return sd_info
+
+
+class EncryptedFileStreamDescriptorValidatorTest(unittest.TestCase):
+    def test_valid_descriptor(self):
+        validator = StreamDescriptor.EncryptedFileStreamDescriptorValidator(make_sd_info())
+        return validator.validate()
+
+    @defer.inlineCallbacks
+    def test_wrong_stream_hash_is_invalid(self):
+        sd_info = make_sd_info()
+        sd_info['stream_hash'] = '0' * 96
+        validator = StreamDescriptor.EncryptedFileStreamDescriptorValidator(sd_info)
+        yield self.assertFailure(validator.validate(), InvalidStreamDescriptorError)
+
+    @defer.inlineCallbacks
+    def test_missing_terminator_is_invalid(self):
+        sd_info = make_sd_info()
+        sd_info['blobs'].pop()
+        validator = StreamDescriptor.EncryptedFileStreamDescriptorValidator(sd_info)
+        yield self.assertFailure(validator.validate(), InvalidStreamDescriptorError)
+
+
+class SDValidationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.stream_info_manager = TempEncryptedFileMetadataManager()
+        self.cache = StreamDescriptor.SDValidationCache(self.stream_info_manager)
+        self.sd_info = make_sd_info()
+
+    def validate(self, sd_info, cache, sd_hash='sd hash'):
+        validator = StreamDescriptor.EncryptedFileStreamDescriptorValidator(
+            sd_info, sd_hash, cache)
+        validator._validate = mock.Mock(wraps=validator._validate)
+        d = validator.validate()
+        d.addCallback(lambda _: validator._validate.call_count)
+        return d
+
+    @defer.inlineCallbacks
+    def test_validated_descriptor_is_not_validated_again(self):
+        validate_count = yield self.validate(self.sd_info, self.cache)
+        self.assertEqual(1, validate_count)
+        validate_count = yield self.validate(self.sd_info, self.cache)
+        self.assertEqual(0, validate_count)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    @defer.inlineCallbacks
+    def test_validated_descriptor_is_saved(self):
+        yield self.stream_info_manager.save_stream(
+            self.sd_info['stream_hash'], self.sd_info['stream_name'], self.sd_info['key'],
+            self.sd_info['suggested_file_name'], [])
+        yield self.validate(self.sd_info, self.cache)
+        stream_hash = yield self.stream_info_manager.get_stream_hash_for_sd_hash('sd hash')
+        self.assertEqual(self.sd_info['stream_hash'], stream_hash)
+        new_cache = StreamDescriptor.SDValidationCache(self.stream_info_manager)
+        validate_count = yield self.validate(self.sd_info, new_cache)
+        self.assertEqual(0, validate_count)
+
+    @defer.inlineCallbacks
+    def test_descriptor_of_unsaved_stream_is_not_saved(self):
+        yield self.validate(self.sd_info, self.cache)
+        self.assertEqual({}, self.stream_info_manager.sd_files)
+        validate_count = yield self.validate(self.sd_info, self.cache)
+        self.assertEqual(0, validate_count)
+
+    @defer.inlineCallbacks
+    def test_invalid_descriptor_is_not_saved(self):
+        self.sd_info['stream_hash'] = '0' * 96
+        yield self.assertFailure(self.validate(self.sd_info, self.cache),
+                                 InvalidStreamDescriptorError)
+        yield self.assertFailure(self.validate(self.sd_info, self.cache),
+                                 InvalidStreamDescriptorError)
+        self.assertEqual({}, self.stream_info_manager.sd_files)
+
+    @defer.inlineCallbacks
+    def test_descriptor_without_sd_hash_is_always_validated(self):
+        yield self.validate(self.sd_info, self.cache, None)
+        validate_count = yield self.validate(self.sd_info, self.cache, None)
+        self.assertEqual(1, validate_count)
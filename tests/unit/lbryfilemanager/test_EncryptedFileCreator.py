@@ -4,8 +4,10 @@ import tempfile
 
 from Crypto.Cipher import AES
 import mock
+from twisted.internet import defer
 from twisted.trial import unittest
 
+from lbrynet import conf
 from lbrynet.core import BlobManager
 from lbrynet.core import Session
 from lbrynet.core.server import DHTHashAnnouncer
@@ -32,13 +34,13 @@ class CreateEncryptedFileTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmp_dir)
 
-    def create_file(self, filename):
+    def create_file(self, filename, size=3*MB):
         session = mock.Mock(spec=Session.Session)(None, None)
         hash_announcer = DHTHashAnnouncer.DHTHashAnnouncer(None, None)
         session.blob_manager = BlobManager.TempBlobManager(hash_announcer)
         session.db_dir = self.tmp_dir
         manager = mock.Mock(spec=EncryptedFileManager.EncryptedFileManager)()
-        handle = mocks.GenFile(3*MB, '1')
+        handle = mocks.GenFile(size, '1')
         key = '2'*AES.block_size
         return EncryptedFileCreator.create_lbry_file(
             session, manager, filename, handle, key, iv_generator())
@@ -58,3 +60,20 @@ class CreateEncryptedFileTest(unittest.TestCase):
         d = self.create_file(filename)
         d.addCallback(self.assertEqual, expected_stream_hash)
         return d
+
+    def test_stream_is_the_same_when_encrypted_on_the_reactor(self):
+        expected_stream_hash = ('41e6b247d923d191b154fb6f1b8529d6ddd6a73d65c357b1acb7'
+                                '42dd83151fb66393a7709e9f346260a4f4db6de10c25')
+        conf.settings['encryption_threads'] = 0
+        d = self.create_file('test.file')
+        d.addCallback(self.assertEqual, expected_stream_hash)
+        return d
+
+    @defer.inlineCallbacks
+    def test_stream_is_the_same_when_file_ends_on_a_blob_boundary(self):
+        size = conf.settings['BLOB_SIZE'] - 1
+        conf.settings['encryption_threads'] = 0
+        expected_stream_hash = yield self.create_file('test.file', size)
+        conf.settings['encryption_threads'] = 2
+        stream_hash = yield self.create_file('test.file', size)
+        self.assertEqual(expected_stream_hash, stream_hash)